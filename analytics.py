@@ -0,0 +1,300 @@
+# analytics.py
+#
+# Columnar aggregation of sale and expense records (models.Sale and
+# models.Expense). Records are loaded once
+# into NumPy columns (day number, float64 amount, paid flag) and bucketed by
+# day, week or month with np.bincount instead of per-row strptime/strftime.
+#
+# Rows are summed in input order, so the totals are bit-for-bit the same as
+# the per-row loops they replace.
+#
+# The chart data can be bucketed by day, week, month or year. A bucket is
+# summed from its rows like a day is, never from rounded daily totals, and
+# buckets are clipped to the requested range, so every row in range counts
+# in exactly one bucket. Long daily series can instead be downsampled with
+# Largest-Triangle-Three-Buckets, which keeps a subset of the days (peaks
+# and dips included) but no longer adds up to the totals.
+
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from operator import attrgetter
+
+import numpy as np
+
+# Status codes stored in Columns.status; anything other than 'Paid' counts as pending
+PAID = 0
+PENDING = 1
+
+_EPOCH = date(1970, 1, 1)
+
+Columns = namedtuple('Columns', ['day', 'amount', 'status'])
+
+
+def _parse_days(date_strings):
+    """Parse 'YYYY-MM-DD' strings into day numbers; returns (days, valid mask)."""
+    raw = np.asarray(date_strings, dtype=object)
+    if raw.size == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=bool)
+    text = np.array([value if isinstance(value, str) else '' for value in raw], dtype=str)
+    try:
+        parsed = text.astype('datetime64[D]')
+    except ValueError:
+        # At least one malformed value: fall back to parsing one by one
+        parsed = np.empty(text.shape, dtype='datetime64[D]')
+        for i, value in enumerate(text):
+            try:
+                parsed[i] = np.datetime64(value, 'D')
+            except ValueError:
+                parsed[i] = np.datetime64('NaT')
+    # Reject partial dates such as '2024-01', which NumPy would accept
+    valid = ~np.isnat(parsed) & (np.datetime_as_string(parsed) == text)
+    return parsed.astype(np.int64), valid
+
+
+def _parse_amounts(values):
+    """Amounts decoded by the models; None marks a stored value that was not a number."""
+    valid = np.array([value is not None for value in values], dtype=bool)
+    amounts = np.array([value if value is not None else 0.0 for value in values], dtype=np.float64)
+    return amounts, valid
+
+
+def load(records, date_attr, amount_attr):
+    """Build Columns from an iterable of model records.
+
+    Rows with an unparseable date or amount are dropped, as the route loops
+    skipped them.
+    """
+    fields = attrgetter(date_attr, amount_attr, 'status')
+    rows = [fields(record) for record in records]
+    dates = [day for day, _, _ in rows]
+    amounts = [amount for _, amount, _ in rows]
+    statuses = [PAID if status == 'Paid' else PENDING for _, _, status in rows]
+    days, valid_days = _parse_days(dates)
+    amount_column, valid_amounts = _parse_amounts(amounts)
+    keep = valid_days & valid_amounts
+    return Columns(days[keep], amount_column[keep], np.asarray(statuses, dtype=np.int8)[keep])
+
+
+def load_sales(records):
+    return load(records, 'sale_date', 'sale_amount')
+
+
+def load_expenses(records):
+    return load(records, 'date', 'amount')
+
+
+def day_number(value):
+    """Day number (days since 1970-01-01) of a date or datetime."""
+    if isinstance(value, datetime):
+        value = value.date()
+    return (value - _EPOCH).days
+
+
+def day_label(number):
+    return (_EPOCH + timedelta(days=int(number))).strftime('%Y-%m-%d')
+
+
+def _bucket_sums(keys, columns, size):
+    """Sum amounts per bucket key, split into (paid, pending, paid_count, pending_count)."""
+    paid = columns.status == PAID
+    pending = ~paid
+    return (np.bincount(keys[paid], weights=columns.amount[paid], minlength=size),
+            np.bincount(keys[pending], weights=columns.amount[pending], minlength=size),
+            np.bincount(keys[paid], minlength=size),
+            np.bincount(keys[pending], minlength=size))
+
+
+def _as_list(sums, counts):
+    # Buckets without rows are the int 0 the dict-based routes returned
+    return [value if count else 0 for value, count in zip(sums.tolist(), counts.tolist())]
+
+
+# Chart buckets, finest first
+GRANULARITIES = ('day', 'week', 'month', 'year')
+
+
+def _bucket_keys(days, granularity):
+    """Bucket numbers of an array of day numbers; consecutive buckets have consecutive numbers."""
+    if granularity == 'day':
+        return days
+    if granularity == 'week':
+        # 1970-01-01 was a Thursday, so shift by 3 days to start weeks on Monday
+        return (days + 3) // 7
+    months = _month_numbers(days)
+    return months if granularity == 'month' else months // 12
+
+
+def _bucket_key(number, granularity):
+    return int(_bucket_keys(np.array([number], dtype=np.int64), granularity)[0])
+
+
+def _bucket_label(key, granularity, first):
+    """Label of bucket `key`: its first day in the range, 'YYYY-MM' or 'YYYY'."""
+    if granularity == 'day':
+        return day_label(key)
+    if granularity == 'week':
+        return day_label(max(key * 7 - 3, first))
+    if granularity == 'month':
+        year, month = divmod(key, 12)
+        return f'{1970 + year:04d}-{month + 1:02d}'
+    return f'{1970 + key:04d}'
+
+
+def bucket_count(start, end, granularity):
+    """Number of `granularity` buckets that [start, end] touches."""
+    first, last = day_number(start), day_number(end)
+    if last < first:
+        return 0
+    return _bucket_key(last, granularity) - _bucket_key(first, granularity) + 1
+
+
+def auto_granularity(start, end, max_points):
+    """The finest granularity with at most max_points buckets over [start, end]; 'year' if none has."""
+    for granularity in GRANULARITIES:
+        if bucket_count(start, end, granularity) <= max_points:
+            return granularity
+    return GRANULARITIES[-1]
+
+
+def bucketed(columns, start, end, granularity='day'):
+    """Paid and pending totals per day, week, month or year of [start, end].
+
+    Returns (labels, paid, pending) with an entry for every bucket the range
+    touches, empty ones included; the first and last week, month or year
+    only count the days inside the range.
+    """
+    first, last = day_number(start), day_number(end)
+    size = bucket_count(start, end, granularity)
+    in_range = (columns.day >= first) & (columns.day <= last)
+    window = Columns(columns.day[in_range], columns.amount[in_range], columns.status[in_range])
+    base = _bucket_key(first, granularity)
+    keys = _bucket_keys(window.day, granularity) - base
+    paid, pending, paid_count, pending_count = _bucket_sums(keys, window, size)
+    labels = [_bucket_label(base + i, granularity, first) for i in range(size)]
+    return labels, _as_list(paid, paid_count), _as_list(pending, pending_count)
+
+
+def daily(columns, start, end):
+    """Per-day paid and pending totals for every day in [start, end].
+
+    Returns (labels, paid, pending) with one entry per calendar day.
+    """
+    return bucketed(columns, start, end, 'day')
+
+
+def weekly(columns):
+    """Per-week (Monday start) totals for weeks that have rows.
+
+    Returns (labels, paid, pending); labels are the Monday of each week.
+    """
+    return _grouped(_bucket_keys(columns.day, 'week'), columns, lambda week: day_label(week * 7 - 3))
+
+
+def _month_numbers(days):
+    return days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+
+
+def month_label(number):
+    year, month = divmod(int(number), 12)
+    return datetime(1970 + year, month + 1, 1).strftime('%b %Y')
+
+
+def monthly(columns):
+    """Per-month totals for months that have rows, oldest first.
+
+    Returns (labels, paid, pending) with '%b %Y' labels.
+    """
+    return _grouped(_month_numbers(columns.day), columns, month_label)
+
+
+def _grouped(keys, columns, label):
+    if keys.size == 0:
+        return [], [], []
+    groups, inverse = np.unique(keys, return_inverse=True)
+    paid, pending, paid_count, pending_count = _bucket_sums(inverse, columns, groups.size)
+    return ([label(group) for group in groups.tolist()],
+            _as_list(paid, paid_count), _as_list(pending, pending_count))
+
+
+def monthly_chart(columns, status=None):
+    """Month labels and totals for the sales/expenses trend charts.
+
+    With status=PAID only paid rows are counted and only months with a paid
+    row are listed; with status=None every row counts.
+    """
+    if status is not None:
+        keep = columns.status == status
+        columns = Columns(columns.day[keep], columns.amount[keep], columns.status[keep])
+    months = _month_numbers(columns.day)
+    if months.size == 0:
+        return [], []
+    groups, inverse = np.unique(months, return_inverse=True)
+    totals = np.bincount(inverse, weights=columns.amount, minlength=groups.size)
+    return [month_label(month) for month in groups.tolist()], totals.tolist()
+
+
+def chart_data(sales, expenses, start, end, granularity='day'):
+    """The /api/chart-data payload for sales and expenses Columns.
+
+    The daily_* series hold one total per `granularity` bucket; the names
+    predate the other granularities.
+    """
+    labels, daily_sales, daily_pending = bucketed(sales, start, end, granularity)
+    _, expenses_paid, expenses_pending = bucketed(expenses, start, end, granularity)
+    return {
+        'labels': labels,
+        'daily_sales': daily_sales,
+        'daily_pending': daily_pending,
+        'daily_expenses_paid': expenses_paid,
+        'daily_expenses_pending': expenses_pending,
+    }
+
+
+# The value series of a chart_data payload
+CHART_SERIES = ('daily_sales', 'daily_pending', 'daily_expenses_paid', 'daily_expenses_pending')
+
+
+def lttb(values, threshold):
+    """Indices of `threshold` points of `values` chosen by Largest-Triangle-Three-Buckets.
+
+    The first and last points are always kept; every bucket in between keeps
+    the point that forms the largest triangle with the previously kept point
+    and the mean of the next bucket, which preserves peaks and dips.
+    """
+    if threshold < 3:
+        raise ValueError('LTTB keeps at least 3 points')
+    y = np.asarray(values, dtype=np.float64)
+    n = y.size
+    if threshold >= n:
+        return np.arange(n)
+    # Bucket i holds the points [edges[i], edges[i + 1]); each has at least one
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i + 2 < edges.size:
+            next_lo, next_hi = edges[i + 1], edges[i + 2]
+        else:
+            next_lo, next_hi = n - 1, n
+        mean_x = (next_lo + next_hi - 1) / 2
+        mean_y = y[next_lo:next_hi].mean()
+        xs = np.arange(lo, hi)
+        area = np.abs((a - mean_x) * (y[lo:hi] - y[a]) - (a - xs) * (mean_y - y[a]))
+        a = lo + int(area.argmax())
+        selected[i + 1] = a
+    return selected
+
+
+def downsample(payload, max_points):
+    """A chart_data payload reduced to max_points of its buckets.
+
+    The buckets are chosen by LTTB over the largest of the four series at
+    each bucket, so a spike in any one of them is kept. The kept values are
+    unchanged, so they no longer add up to the range's totals.
+    """
+    stacked = np.array([payload[name] for name in CHART_SERIES], dtype=np.float64)
+    keep = lttb(stacked.max(axis=0), max_points).tolist()
+    reduced = {name: [payload[name][i] for i in keep] for name in CHART_SERIES}
+    return dict(payload, labels=[payload['labels'][i] for i in keep], **reduced)
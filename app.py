@@ -1,22 +1,43 @@
 # app.py
 
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response, stream_with_context, make_response
 from flask_wtf import FlaskForm, CSRFProtect
 from wtforms import StringField, IntegerField, FloatField, DateField, SelectField, SubmitField, PasswordField
 from wtforms.validators import DataRequired, NumberRange, Email, Length
+import io
 import os
 from datetime import datetime, timedelta
-from collections import defaultdict
-from firebase_admin import credentials, initialize_app, auth, firestore
+from firebase_admin import auth, firestore
 from dotenv import load_dotenv
 import secrets
 import json
+import csv
 import logging
 import traceback
 import time
+import threading
 from functools import wraps
+from dataclasses import asdict
 import sys
-import pytz
+import click
+import datastore
+import migrations
+import pagination
+import receivables
+import resilience
+import rollups
+import search
+import exports
+import imports
+import jobs
+import reports
+import analytics
+import task_dates
+import tenants
+import http_cache
+import parallel
+import metrics
+from session_cache import SessionValidationCache
 
 # Configure logging
 logging.basicConfig(
@@ -33,43 +54,37 @@ load_dotenv()
 
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', secrets.token_hex(32))
+app.config['PAGE_SIZE'] = pagination.parse_page_size(os.getenv('PAGE_SIZE'))
+# Deadline for the reads a page issues concurrently (see parallel.py)
+app.config['READ_DEADLINE'] = float(os.getenv('READ_DEADLINE_SECONDS', 10))
+# Caps CSV uploads to /import
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_UPLOAD_MB', 32)) * 1024 * 1024
+app.config['SERVER_TIMING'] = os.getenv('SERVER_TIMING', '1') != '0'
+# Default cap on the points /api/chart-data returns; requests may ask for up to CHART_POINTS_LIMIT
+app.config['CHART_MAX_POINTS'] = int(os.getenv('CHART_MAX_POINTS', 400))
+# /api/live streams hold a worker thread each, so they are capped per process and recycled
+app.config['LIVE_MAX_STREAMS'] = int(os.getenv('LIVE_MAX_STREAMS', 4))
+app.config['LIVE_STREAM_SECONDS'] = float(os.getenv('LIVE_STREAM_SECONDS', 300))
 csrf = CSRFProtect(app)
+# Registered first so its timers wrap the session check below
+metrics.init_app(app)
+# Deadline budget for the Firestore calls of each request (see resilience.py)
+resilience.init_app(app)
 
-# Initialize Firebase with retry mechanism
-def initialize_firebase(max_retries=3, delay=1):
-    for attempt in range(max_retries):
-        try:
-            firebase_credentials = os.getenv('FIREBASE_CREDENTIALS')
-            if not firebase_credentials:
-                logger.error("FIREBASE_CREDENTIALS environment variable is not set")
-                raise ValueError("FIREBASE_CREDENTIALS environment variable is not set")
-            
-            try:
-                cred_dict = json.loads(firebase_credentials)
-            except json.JSONDecodeError as e:
-                logger.error(f"Invalid JSON in FIREBASE_CREDENTIALS: {str(e)}")
-                raise ValueError("Invalid JSON in FIREBASE_CREDENTIALS")
-            
-            cred = credentials.Certificate(cred_dict)
-            firebase_app = initialize_app(cred)
-            db = firestore.client()
-            logger.info("Firebase initialized successfully")
-            return db
-        except Exception as e:
-            logger.error(f"Firebase initialization attempt {attempt + 1} failed: {str(e)}")
-            if attempt < max_retries - 1:
-                time.sleep(delay)
-            else:
-                logger.error("All Firebase initialization attempts failed")
-                raise
-
-# Initialize Firebase
-try:
-    db = initialize_firebase()
-except Exception as e:
-    logger.error(f"Critical error: Could not initialize Firebase: {str(e)}")
-    logger.error(traceback.format_exc())
-    raise
+# The data store (Firestore unless DATA_BACKEND says otherwise). Clients are
+# created on first use in each process, not at import; see create_app.
+app.config['DATA_BACKEND'] = os.getenv('DATA_BACKEND', 'firestore')
+store = datastore.LazyStore(app.config['DATA_BACKEND'])
+# Queue of the background report jobs, shared by the processes of the host (see jobs.py)
+report_jobs = jobs.from_env(app.config['DATA_BACKEND'])
+
+def service_unavailable(error):
+    """503 for a request Firestore could not serve in time (see resilience.py), with Retry-After."""
+    logger.warning(f"Firestore unavailable for {request.endpoint}: {type(error).__name__}: {str(error)}")
+    response = make_response(render_template(
+        'error.html', error="The database is not responding. Please try again in a moment."), 503)
+    response.headers['Retry-After'] = str(resilience.retry_after(error))
+    return response
 
 # Database connection decorator
 def with_db_connection(f):
@@ -78,24 +93,91 @@ def with_db_connection(f):
         try:
             return f(*args, **kwargs)
         except Exception as e:
+            if resilience.is_unavailable(e):
+                return service_unavailable(e)
             logger.error(f"Database error in {f.__name__}: {str(e)}")
             logger.error(traceback.format_exc())
             flash('A database error occurred. Please try again later.', 'error')
             return render_template('error.html', error="Database connection error. Please try again later."), 500
     return decorated_function
 
+def fetch_table_page(tenant, collection, filters=search.NO_FILTERS):
+    """Fetch the page of a tenant's sales or expenses selected by the after/before/page_size query args."""
+    page_size = pagination.parse_page_size(request.args.get('page_size'), app.config['PAGE_SIZE'])
+    after, before = request.args.get('after'), request.args.get('before')
+    page = tenant.cached(('page', collection, page_size, after, before, *filters), [collection],
+                         lambda: getattr(tenant, collection).page(page_size, after=after, before=before,
+                                                                  filters=filters))
+    return page, page_size
+
+def monthly_chart(tenant, collection, fields):
+    """The tenant's monthly rollup chart of `fields`, from the shared cache when enabled."""
+    return tenant.cached(('monthly-chart', fields), [collection], lambda: tenant.rollups.monthly_chart(fields))
+
+def page_etag(name, version):
+    """ETag of a list page for the current user and query, or None when it must not be cached."""
+    if session.get('_flashes'):
+        # The messages are rendered once; a cached copy would show them again
+        return None
+    return http_cache.etag_for(name, version, sorted(request.args.items(multi=True)), app.config['PAGE_SIZE'],
+                               session.get('tenant_id'), session.get('user_id'), session.get('username'),
+                               session.get('csrf_token'),
+                               http_cache.token_window(app.config.get('WTF_CSRF_TIME_LIMIT', 3600)))
+
 # Session management
+# Endpoints that never need a validated session
+SESSION_EXEMPT_ENDPOINTS = {'static', 'healthz', 'readyz', 'metrics_endpoint'}
+
+session_cache = SessionValidationCache(
+    ttl=float(os.getenv('SESSION_VALIDATION_TTL', 300)),
+    negative_ttl=float(os.getenv('SESSION_NEGATIVE_TTL', 30))
+)
+
+def session_key():
+    return session.get('user_id') or session.get('email')
+
+def tenant_store():
+    """The datastore.TenantStore of the logged-in user's shop."""
+    return store.tenant(session['tenant_id'])
+
+def ledger(collection):
+    """The sales or expenses repository of the logged-in user's shop."""
+    return getattr(tenant_store(), collection)
+
+def validate_session_user():
+    try:
+        if session.get('user_id'):
+            user = store.auth.get_user(session['user_id'])
+        else:
+            user = store.auth.get_user_by_email(session.get('email'))
+    except auth.UserNotFoundError:
+        return False
+    return not user.disabled
+
 @app.before_request
 def before_request():
+    if request.endpoint in SESSION_EXEMPT_ENDPOINTS:
+        return
     if 'username' in session:
-        # Check if the session is still valid
+        # Check if the session is still valid (cached for SESSION_VALIDATION_TTL seconds)
         try:
-            user = auth.get_user_by_email(session.get('email'))
-            if not user:
+            key = session_key()
+            if not session_cache.is_valid(key, validate_session_user, store.session_generation(key)):
                 session.clear()
                 flash('Session expired. Please login again.', 'error')
                 return redirect(url_for('index'))
+            if 'tenant_id' not in session:
+                # Logged in before data was partitioned per tenant
+                tenant_id = store.users.tenant_of(session['user_id']) if session.get('user_id') else None
+                if tenant_id is None:
+                    session.clear()
+                    flash('User data missing in Firestore.', 'error')
+                    return redirect(url_for('index'))
+                session['tenant_id'] = tenant_id
         except Exception as e:
+            if resilience.is_unavailable(e):
+                # Firestore is down, not the session; keep the user logged in
+                return service_unavailable(e)
             logger.error(f"Session validation error: {str(e)}")
             session.clear()
             flash('Session error. Please login again.', 'error')
@@ -117,6 +199,10 @@ def bad_gateway_error(error):
     logger.error(f"Bad Gateway Error: {str(error)}")
     return render_template('error.html', error="Service temporarily unavailable. Please try again later."), 502
 
+# Firestore failures that reach Flask unhandled: 503 rather than 500
+for error_class in (resilience.Unavailable, parallel.DeadlineExceeded) + resilience.TRANSIENT_ERRORS:
+    app.register_error_handler(error_class, service_unavailable)
+
 # ------------------ Forms ------------------ #
 class RegistrationForm(FlaskForm):
     username = StringField('Username', validators=[DataRequired(), Length(min=4, max=20)])
@@ -153,6 +239,9 @@ class TaskForm(FlaskForm):
     taskPrice = FloatField('Price (THB)', validators=[NumberRange(min=0)], default=0)
     submit = SubmitField('Add Task')
 
+# Forms whose rules bulk CSV imports validate rows with
+IMPORT_FORMS = {'sales': SalesForm, 'expenses': ExpensesForm}
+
 # ------------------ Routes ------------------ #
 
 @app.route('/')
@@ -169,18 +258,21 @@ def register():
             flash('Passwords do not match.', 'error')
             return redirect(url_for('register'))
         try:
-            user = auth.create_user(
+            user = store.auth.create_user(
                 email=form.email.data,
                 password=form.password.data,
                 display_name=form.username.data,
                 email_verified=False
             )
-            db.collection('users').document(user.uid).set({
+            store.users.create(user.uid, {
                 'username': form.username.data,
                 'email': form.email.data,
                 'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'role': 'user'
+                'role': 'user',
+                # A new user starts a shop of their own
+                'tenant_id': user.uid
             })
+            tenants.ensure(store.db, user.uid, name=form.username.data)
             flash('Registration successful. Please login.', 'success')
             return redirect(url_for('index'))
         except auth.EmailAlreadyExistsError:
@@ -194,12 +286,14 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         try:
-            user = auth.get_user_by_email(form.email.data)
-            user_doc = db.collection('users').document(user.uid).get()
-            if user_doc.exists:
+            user = store.auth.get_user_by_email(form.email.data)
+            profile = store.users.get(user.uid)
+            if profile is not None:
                 session['username'] = user.display_name
                 session['email'] = user.email
                 session['user_id'] = user.uid
+                session['tenant_id'] = tenants.tenant_of(user.uid, profile)
+                session_cache.revoke(user.uid)
                 flash('Login successful.', 'success')
                 return redirect(url_for('dashboard'))
             else:
@@ -214,10 +308,32 @@ def login():
 
 @app.route('/logout')
 def logout():
+    session_cache.revoke(session_key())
     session.clear()
     flash('Logged out.', 'success')
     return redirect(url_for('index'))
 
+@app.route('/healthz')
+def healthz():
+    # Liveness only: answers without touching the data store
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    # Readiness: this worker's data store is connected and has answered a read
+    ready, error = store.readiness()
+    if not ready:
+        return jsonify({'status': 'starting' if error is None else 'unavailable', 'error': error}), 503
+    return jsonify({'status': 'ok', 'backend': store.backend, 'pid': os.getpid(), 'breaker': resilience.BREAKER.state})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Prometheus scrape target; set METRICS_TOKEN to require a bearer token
+    token = os.getenv('METRICS_TOKEN')
+    if token and not secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 @app.route('/dashboard')
 @with_db_connection
 def dashboard():
@@ -231,22 +347,15 @@ def dashboard():
         pending_expenses = 0
         net_income = 0
 
-        # Get sales data
+        # Read the pre-aggregated totals instead of streaming both collections
         try:
-            sales = [doc.to_dict() for doc in db.collection('sales').stream()]
-            total_sales = sum(float(s.get('sale_amount', 0) or 0) for s in sales)
+            tenant = tenant_store()
+            totals = tenant.cached(('totals',), rollups.LEDGER_COLLECTIONS, tenant.rollups.totals)
+            total_sales = totals['sales_paid'] + totals['sales_pending']
+            paid_expenses = totals['expenses_paid']
+            pending_expenses = totals['expenses_pending']
         except Exception as e:
-            logger.error(f"Error getting sales data: {str(e)}")
-            sales = []
-
-        # Get expenses data
-        try:
-            expenses = [doc.to_dict() for doc in db.collection('expenses').stream()]
-            paid_expenses = sum(float(e.get('amount', 0) or 0) for e in expenses if e.get('status') == 'Paid')
-            pending_expenses = sum(float(e.get('amount', 0) or 0) for e in expenses if e.get('status') == 'Pending')
-        except Exception as e:
-            logger.error(f"Error getting expenses data: {str(e)}")
-            expenses = []
+            logger.error(f"Error getting rollup totals: {str(e)}")
 
         # Calculate net income
         net_income = total_sales - paid_expenses
@@ -262,7 +371,8 @@ def dashboard():
                              total_sales=total_sales,
                              paid_expenses=paid_expenses,
                              pending_expenses=pending_expenses,
-                             net_income=net_income)
+                             net_income=net_income,
+                             live_updates=tenant_store().mirror is not None)
     except Exception as e:
         logger.error(f"Error in dashboard: {str(e)}")
         logger.error(traceback.format_exc())
@@ -286,7 +396,7 @@ def sales():
                 'sale_amount': sale_amount,
                 'status': form.saleStatus.data
             }
-            db.collection('sales').add(data)
+            tenant_store().sales.add(data)
             flash('Sale added successfully.', 'success')
             return redirect(url_for('sales'))
         except Exception as e:
@@ -296,37 +406,66 @@ def sales():
             return redirect(url_for('sales'))
 
     try:
-        sales_docs = db.collection('sales').stream()
-        sales_data = []
-        monthly_sales = defaultdict(float)
-        for doc in sales_docs:
-            sale = doc.to_dict()
-            sale['id'] = doc.id
-            # Ensure all required fields exist with default values
-            sale['customer_name'] = sale.get('customer_name', '')
-            sale['quantity'] = sale.get('quantity', 0)
-            sale['price_per_unit'] = float(sale.get('price_per_unit', 0))
-            sale['sale_amount'] = float(sale.get('sale_amount', 0))
-            sale['sale_date'] = sale.get('sale_date', '')
-            sale['status'] = sale.get('status', 'Pending')
-            sales_data.append(sale)
+        filters = search.parse_filters(request.args)
+    except ValueError as e:
+        flash(str(e), 'error')
+        filters = search.NO_FILTERS
+    try:
+        tenant = tenant_store()
+        etag = page_etag('sales', tenant.rollups.versions()['sales'])
+        if http_cache.is_fresh(etag):
+            return http_cache.not_modified(etag)
+        # The table page and the chart rollups are independent reads
+        (page, page_size), (chart_labels, chart_data) = parallel.run_all([
+            lambda: fetch_table_page(tenant, 'sales', filters),
             # Only count paid sales in the monthly total
-            if sale['status'] == 'Paid':
-                dt = datetime.strptime(sale['sale_date'], '%Y-%m-%d')
-                monthly_sales[dt.strftime('%b %Y')] += sale['sale_amount']
-        
-        sorted_data = sorted(monthly_sales.items(), key=lambda x: datetime.strptime(x[0], '%b %Y'))
-        chart_labels = [k for k, _ in sorted_data]
-        chart_data = [v for _, v in sorted_data]
-
-        return render_template('sales.html', username=session['username'], sales=sales_data,
-                            form=form, chart_labels=chart_labels, chart_data=chart_data)
+            lambda: monthly_chart(tenant, 'sales', ['sales_paid']),
+        ], timeout=app.config['READ_DEADLINE'])
+        return http_cache.tag(make_response(render_template(
+            'sales.html', username=session['username'], sales=page.docs,
+            form=form, chart_labels=chart_labels, chart_data=chart_data,
+            next_cursor=page.next_cursor, prev_cursor=page.prev_cursor,
+            page_size=page_size, filters=filters, filter_args=search.query_args(filters))), etag)
     except Exception as e:
         logger.error(f"Error loading sales: {str(e)}")
         logger.error(traceback.format_exc())
         flash(f'Error loading sales: {str(e)}', 'error')
         return render_template('sales.html', username=session['username'], sales=[],
-                            form=form, chart_labels=[], chart_data=[])
+                            form=form, chart_labels=[], chart_data=[],
+                            filters=filters, filter_args=search.query_args(filters))
+
+@app.route('/api/sales')
+@with_db_connection
+def sales_feed():
+    """One page of sales as JSON, newest first, filtered like the sales table.
+
+    Query args: q (customer name prefix, case-insensitive), status,
+    start_date and end_date (YYYY-MM-DD, inclusive), page_size, and the
+    after/before cursors of a previous response.
+    """
+    if 'username' not in session:
+        return jsonify({'error': 'Login required'}), 401
+    try:
+        filters = search.parse_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        tenant = tenant_store()
+        etag = http_cache.etag_for('api-sales', tenant.tenant_id, sorted(request.args.items(multi=True)),
+                                   app.config['PAGE_SIZE'], tenant.rollups.versions()['sales'])
+        if http_cache.is_fresh(etag):
+            return http_cache.not_modified(etag)
+        page, page_size = fetch_table_page(tenant, 'sales', filters)
+    except Exception as e:
+        logger.error(f"Error searching sales: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': 'Error loading sales'}), 500
+    return http_cache.tag(jsonify({
+        'sales': [asdict(sale) for sale in page.docs],
+        'next_cursor': page.next_cursor,
+        'prev_cursor': page.prev_cursor,
+        'page_size': page_size,
+    }), etag)
 
 @app.route('/sales/delete/<string:sale_id>', methods=['POST'])
 def delete_sale(sale_id):
@@ -337,39 +476,35 @@ def delete_sale(sale_id):
             flash('Invalid sale ID.', 'error')
             return redirect(url_for('sales'))
             
-        # Check if the sale exists before deleting
-        sale_ref = db.collection('sales').document(sale_id)
-        sale = sale_ref.get()
-        
-        if not sale.exists:
+        if not tenant_store().sales.delete(sale_id):
             flash('Sale not found.', 'error')
             return redirect(url_for('sales'))
             
-        sale_ref.delete()
         flash('Sale deleted successfully.', 'success')
     except Exception as e:
+        if resilience.is_unavailable(e):
+            return service_unavailable(e)
+        logger.error(f"Error deleting sale: {str(e)}")
+        logger.error(traceback.format_exc())
         flash(f'Error deleting sale: {str(e)}', 'error')
-        print(f"Error deleting sale: {str(e)}")  # For server-side logging
         
     return redirect(url_for('sales'))
 
 @app.route('/sales/update_status/<string:sale_id>', methods=['POST'])
+@with_db_connection
 def update_sale_status(sale_id):
     if 'username' not in session:
         return redirect(url_for('index'))
     
-    ref = db.collection('sales').document(sale_id)
-    sale = ref.get()
-    if not sale.exists:
-        flash('Sale not found.', 'error')
-        return redirect(url_for('sales'))
-    
     new_status = request.form.get('status')
     if new_status not in ['Paid', 'Pending']:
         flash('Invalid status.', 'error')
         return redirect(url_for('sales'))
     
-    ref.update({'status': new_status})
+    if not tenant_store().sales.update_status(sale_id, new_status):
+        flash('Sale not found.', 'error')
+        return redirect(url_for('sales'))
+    
     flash('Sale status updated.', 'success')
     return redirect(url_for('sales'))
 
@@ -387,7 +522,7 @@ def expenses():
                 'date': form.expenseDate.data.strftime('%Y-%m-%d'),
                 'status': form.expenseStatus.data
             }
-            db.collection('expenses').add(data)
+            tenant_store().expenses.add(data)
             flash('Expense added successfully.', 'success')
             return redirect(url_for('expenses'))
         except Exception as e:
@@ -397,27 +532,19 @@ def expenses():
             return redirect(url_for('expenses'))
 
     try:
-        docs = db.collection('expenses').stream()
-        expenses_data = []
-        monthly = defaultdict(float)
-        for doc in docs:
-            e = doc.to_dict()
-            e['id'] = doc.id
-            # Ensure all required fields exist with default values
-            e['name'] = e.get('name', '')
-            e['amount'] = float(e.get('amount', 0))
-            e['date'] = e.get('date', '')
-            e['status'] = e.get('status', 'Pending')
-            expenses_data.append(e)
-            dt = datetime.strptime(e['date'], '%Y-%m-%d')
-            monthly[dt.strftime('%b %Y')] += e['amount']
-
-        sorted_data = sorted(monthly.items(), key=lambda x: datetime.strptime(x[0], '%b %Y'))
-        labels = [k for k, _ in sorted_data]
-        data = [v for _, v in sorted_data]
-
-        return render_template('expenses.html', username=session['username'], expenses=expenses_data,
-                            form=form, chart_labels=labels, chart_data=data)
+        tenant = tenant_store()
+        etag = page_etag('expenses', tenant.rollups.versions()['expenses'])
+        if http_cache.is_fresh(etag):
+            return http_cache.not_modified(etag)
+        (page, page_size), (labels, data) = parallel.run_all([
+            lambda: fetch_table_page(tenant, 'expenses'),
+            lambda: monthly_chart(tenant, 'expenses', ['expenses_paid', 'expenses_pending']),
+        ], timeout=app.config['READ_DEADLINE'])
+        return http_cache.tag(make_response(render_template(
+            'expenses.html', username=session['username'], expenses=page.docs,
+            form=form, chart_labels=labels, chart_data=data,
+            next_cursor=page.next_cursor, prev_cursor=page.prev_cursor,
+            page_size=page_size)), etag)
     except Exception as e:
         logger.error(f"Error loading expenses: {str(e)}")
         logger.error(traceback.format_exc())
@@ -434,24 +561,288 @@ def delete_expense(expense_id):
             flash('Invalid expense ID.', 'error')
             return redirect(url_for('expenses'))
             
-        # Check if the expense exists before deleting
-        expense_ref = db.collection('expenses').document(expense_id)
-        expense = expense_ref.get()
-        
-        if not expense.exists:
+        if not tenant_store().expenses.delete(expense_id):
             flash('Expense not found.', 'error')
             return redirect(url_for('expenses'))
             
-        expense_ref.delete()
         flash('Expense deleted successfully.', 'success')
     except Exception as e:
+        if resilience.is_unavailable(e):
+            return service_unavailable(e)
         logger.error(f"Error deleting expense: {str(e)}")
         logger.error(traceback.format_exc())
         flash(f'Error deleting expense: {str(e)}', 'error')
         
     return redirect(url_for('expenses'))
 
+@app.route('/expenses/update_status/<string:expense_id>', methods=['POST'])
+@with_db_connection
+def update_expense_status(expense_id):
+    if 'username' not in session:
+        return redirect(url_for('index'))
+    
+    new_status = request.form.get('status')
+    if new_status not in ['Paid', 'Pending']:
+        flash('Invalid status.', 'error')
+        return redirect(url_for('expenses'))
+    
+    if not tenant_store().expenses.update_status(expense_id, new_status):
+        flash('Expense not found.', 'error')
+        return redirect(url_for('expenses'))
+    
+    flash('Expense status updated.', 'success')
+    return redirect(url_for('expenses'))
+
+# ------------------ Bulk actions ------------------ #
+# Most ids one bulk request may name (a few pages of the tables)
+MAX_BULK_IDS = 1000
+
+def redirect_back(default):
+    """Redirect back to the page a form was posted from (its `next` field), if it is local."""
+    target = request.form.get('next', '')
+    if not target.startswith('/') or target.startswith('//'):
+        target = default
+    return redirect(target)
+
+def selected_ids():
+    return [doc_id for doc_id in request.form.getlist('ids') if doc_id]
+
+@app.route('/bulk/<any(sales, expenses):collection>', methods=['POST'])
+def bulk_ledger(collection):
+    if 'username' not in session:
+        return redirect(url_for('index'))
+    back = url_for(collection)
+    ids = selected_ids()
+    action = request.form.get('action')
+    if not ids:
+        flash('No rows selected.', 'error')
+        return redirect_back(back)
+    if len(ids) > MAX_BULK_IDS:
+        flash(f'Select at most {MAX_BULK_IDS} rows at a time.', 'error')
+        return redirect_back(back)
+
+    repository = ledger(collection)
+    try:
+        if action in ('Paid', 'Pending'):
+            changed, missing = repository.bulk_update_status(ids, action)
+            message = f'{changed} {collection} marked {action}.'
+        elif action == 'delete':
+            changed, missing = repository.bulk_delete(ids)
+            message = f'{changed} {collection} deleted.'
+        else:
+            flash('Invalid action.', 'error')
+            return redirect_back(back)
+    except Exception as e:
+        if resilience.is_unavailable(e):
+            return service_unavailable(e)
+        logger.error(f"Bulk {action} on {collection} failed: {str(e)}")
+        logger.error(traceback.format_exc())
+        flash(f'Error updating {collection}: {str(e)}', 'error')
+        return redirect_back(back)
+
+    if missing:
+        message += f' {missing} no longer existed.'
+    flash(message, 'success')
+    return redirect_back(back)
+
+# ------------------ Receivables ------------------ #
+def read_receivables(tenant, include_settled):
+    """(customers, totals, today) of the tenant; the aging is as of today in TASK_TIMEZONE."""
+    today = task_dates.today()
+    customers, totals = tenant.cached(('receivables', include_settled, today.isoformat()), ['sales'],
+                                      lambda: tenant.receivables.read(include_settled=include_settled))
+    return customers, totals, today
+
+@app.route('/receivables')
+@with_db_connection
+def receivables_page():
+    """Who owes how much, and for how long: outstanding sales per customer with aging buckets."""
+    if 'username' not in session:
+        return redirect(url_for('index'))
+    include_settled = request.args.get('all') == '1'
+    tenant = tenant_store()
+    etag = page_etag('receivables', [tenant.rollups.versions()['sales'], task_dates.today().isoformat()])
+    if http_cache.is_fresh(etag):
+        return http_cache.not_modified(etag)
+    customers, totals, today = read_receivables(tenant, include_settled)
+    return http_cache.tag(make_response(render_template(
+        'receivables.html', username=session['username'], customers=customers, totals=totals,
+        as_of=today.isoformat(), include_settled=include_settled,
+        aging_labels=[label for label, _, _ in receivables.AGING_BUCKETS])), etag)
+
+@app.route('/api/receivables')
+@with_db_connection
+def receivables_feed():
+    """The receivables page as JSON; all=1 includes customers with nothing outstanding."""
+    if 'username' not in session:
+        return jsonify({'error': 'Login required'}), 401
+    include_settled = request.args.get('all') == '1'
+    tenant = tenant_store()
+    today = task_dates.today()
+    etag = http_cache.etag_for('api-receivables', tenant.tenant_id, include_settled, today.isoformat(),
+                               tenant.rollups.versions()['sales'])
+    if http_cache.is_fresh(etag):
+        return http_cache.not_modified(etag)
+    customers, totals, today = read_receivables(tenant, include_settled)
+    return http_cache.tag(jsonify({'as_of': today.isoformat(), 'totals': totals, 'customers': customers}), etag)
+
+# ------------------ Reports ------------------ #
+def job_json(job):
+    """A report job as the status endpoint returns it, with where to poll and download."""
+    return {**job, 'filename': reports.filename(job['kind'], job['period'], job['format']),
+            'status_url': url_for('report_status', job_id=job['id']),
+            'download_url': url_for('download_report', job_id=job['id']) if job['status'] == 'done' else None}
+
+@app.route('/reports')
+@with_db_connection
+def reports_page():
+    """Profit-and-loss reports by month or year, generated in the background."""
+    if 'username' not in session:
+        return redirect(url_for('index'))
+    recent = []
+    if report_jobs is not None:
+        recent = [job_json(job) for job in report_jobs.recent(session['tenant_id'])]
+        if any(job['status'] in ('queued', 'running') for job in recent):
+            report_jobs.ensure_running(store)
+    today = task_dates.today()
+    return render_template('reports.html', username=session['username'], jobs=recent,
+                           available=report_jobs is not None, this_month=today.strftime('%Y-%m'),
+                           this_year=today.year, formats=list(reports.FORMATS))
+
+@app.route('/reports', methods=['POST'])
+@with_db_connection
+def submit_report():
+    """Queue a report (kind, period, format), or return the finished one for the current data."""
+    if 'username' not in session:
+        return jsonify({'error': 'Login required'}), 401
+    if report_jobs is None:
+        return jsonify({'error': 'Reports are unavailable on this server'}), 503
+    tenant = tenant_store()
+    try:
+        job = report_jobs.submit(tenant.tenant_id, request.form.get('kind', ''), request.form.get('period', ''),
+                                 request.form.get('format', 'csv'), tenant.rollups.versions())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if job['status'] != 'done':
+        report_jobs.ensure_running(store)
+    return jsonify(job_json(job)), 200 if job['status'] == 'done' else 202
+
+@app.route('/api/reports/<string:job_id>')
+def report_status(job_id):
+    """A report job's status; poll until it is done or failed."""
+    if 'username' not in session:
+        return jsonify({'error': 'Login required'}), 401
+    job = report_jobs.job(job_id, session['tenant_id']) if report_jobs is not None else None
+    if job is None:
+        return jsonify({'error': 'Report not found'}), 404
+    if job['status'] in ('queued', 'running'):
+        report_jobs.ensure_running(store)
+    return jsonify(job_json(job)), 200, {'Cache-Control': 'no-store'}
+
+@app.route('/reports/<string:job_id>/download')
+def download_report(job_id):
+    """The file of a finished report job."""
+    if 'username' not in session:
+        return redirect(url_for('index'))
+    job, content = report_jobs.result(job_id, session['tenant_id']) if report_jobs is not None else (None, None)
+    if job is None:
+        return jsonify({'error': 'Report not found'}), 404
+    if content is None:
+        return jsonify({**job_json(job), 'error': f"Report is {job['status']}"}), 409
+    # A job's file never changes; a newer ledger makes a new job
+    return Response(content, mimetype=reports.FORMATS[job['format']],
+                    headers={'Content-Disposition': f"attachment; filename={job_json(job)['filename']}",
+                             'Cache-Control': 'private, max-age=86400, immutable'})
+
+# ------------------ Exports ------------------ #
+@app.route('/export/<any(sales, expenses):collection>')
+def export_data(collection):
+    if 'username' not in session:
+        return redirect(url_for('index'))
+
+    fmt = request.args.get('format', 'csv')
+    if fmt not in exports.FORMATS:
+        return jsonify({'error': 'Format must be csv or ndjson'}), 400
+    status = request.args.get('status') or None
+    if status not in (None, 'Paid', 'Pending'):
+        return jsonify({'error': 'Status must be Paid or Pending'}), 400
+
+    dates = {}
+    for name in ('start_date', 'end_date'):
+        value = request.args.get(name)
+        if value:
+            try:
+                dates[name] = datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+            except ValueError:
+                return jsonify({'error': 'Dates must be in YYYY-MM-DD format'}), 400
+    customer = search.normalize(request.args.get('q'))
+    if customer and collection != 'sales':
+        return jsonify({'error': 'Only sales can be filtered by customer'}), 400
+    if len(customer) > search.PREFIX_LENGTH:
+        return jsonify({'error': f'Search by at most {search.PREFIX_LENGTH} characters of the customer name'}), 400
+
+    repository = ledger(collection)
+    lines = repository.export(fmt, status=status, customer=customer or None, **dates)
+    filename = f"{collection}_{datetime.now().strftime('%Y%m%d')}.{fmt}"
+    return Response(lines, mimetype=exports.FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+# ------------------ Imports ------------------ #
+@app.route('/import/<any(sales, expenses):collection>', methods=['POST'])
+def import_data(collection):
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        return jsonify({'error': 'No CSV file uploaded'}), 400
+
+    repository = ledger(collection)
+    lines = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+    try:
+        events = repository.import_csv(lines, IMPORT_FORMS[collection],
+                                       dry_run=request.form.get('dry_run') == '1')
+    except (ValueError, UnicodeDecodeError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    def generate():
+        # One JSON event per line so the page can show progress as batches commit
+        try:
+            for event in events:
+                yield json.dumps(event) + '\n'
+        except Exception as e:
+            logger.error(f"Import into {collection} failed: {str(e)}")
+            logger.error(traceback.format_exc())
+            yield json.dumps({'event': 'failed', 'error': str(e)}) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 # ------------------ Calendar / Tasks ------------------ #
+def calendar_range():
+    """The visible range from ?week=YYYY-MM-DD or ?month=YYYY-MM, this month by default.
+
+    Returns (first day, day after the last, view, label, previous args, next args).
+    """
+    week = request.args.get('week')
+    if week:
+        try:
+            start, end, previous = task_dates.week_view(datetime.strptime(week, '%Y-%m-%d').date())
+            return (start, end, 'week', f"Week of {start.strftime('%d %b %Y')}",
+                    {'week': previous.isoformat()}, {'week': end.isoformat()})
+        except ValueError:
+            pass
+    try:
+        month = datetime.strptime(request.args.get('month', ''), '%Y-%m')
+    except ValueError:
+        month = task_dates.today()
+    start, end, previous = task_dates.month_view(month.year, month.month)
+    return (start, end, 'month', start.strftime('%B %Y'),
+            {'month': previous.strftime('%Y-%m')}, {'month': end.strftime('%Y-%m')})
+
+def due_tasks(tenant, start, end):
+    """Tasks due in [start, end), from the shared cache when enabled."""
+    return tenant.cached(('tasks', start.isoformat(), end.isoformat()), ['calendar_tasks'],
+                         lambda: tenant.tasks.due_between(start, end))
+
 @app.route('/calendar', methods=['GET', 'POST'])
 def calendar():
     try:
@@ -461,12 +852,8 @@ def calendar():
         
         form = TaskForm()
         if form.validate_on_submit():
+            back = url_for('calendar')
             try:
-                # Safely handle datetime
-                date_str = form.taskDate.data.strftime('%Y-%m-%d')
-                time_str = form.taskTime.data.strip() if form.taskTime.data else ''
-                dt_str = f"{date_str} {time_str}" if time_str else date_str
-                
                 # Safely handle price
                 try:
                     price = float(form.taskPrice.data or 0)
@@ -475,79 +862,136 @@ def calendar():
                 
                 task_data = {
                     'name': form.taskName.data,
-                    'datetime': dt_str,
                     'priority': form.taskPriority.data,
                     'done': False,
                     'price': price
                 }
-                db.collection('calendar_tasks').add(task_data)
+                task_data.update(task_dates.due_fields(form.taskDate.data, form.taskTime.data))
+                tenant_store().tasks.add(task_data)
                 logger.info(f"Task added successfully: {task_data['name']}")
                 flash('Task added.', 'success')
+                # Show the month the new task is in
+                back = url_for('calendar', month=form.taskDate.data.strftime('%Y-%m'))
+            except ValueError as e:
+                flash(str(e), 'error')
             except Exception as e:
                 logger.error(f"Error adding task: {str(e)}")
                 logger.error(traceback.format_exc())
                 flash(f'Error adding task: {str(e)}', 'error')
-            return redirect(url_for('calendar'))
+            return redirect(back)
 
+        start, end, view, label, previous_args, next_args = calendar_range()
         try:
-            docs = db.collection('calendar_tasks').stream()
-            tasks = []
-            for doc in docs:
-                task = doc.to_dict()
-                task['id'] = doc.id
-                # Ensure all required fields exist with default values
-                task['name'] = task.get('name', '')
-                task['datetime'] = task.get('datetime', '')
-                task['priority'] = task.get('priority', 'normal')
-                task['done'] = task.get('done', False)
-                try:
-                    task['price'] = float(task.get('price', 0))
-                except (ValueError, TypeError):
-                    task['price'] = 0.0
-                tasks.append(task)
+            # Only the visible range is read, however long the task history grows
+            tasks = due_tasks(tenant_store(), task_dates.local_start(start), task_dates.local_start(end))
             logger.info(f"Successfully loaded {len(tasks)} tasks")
-            return render_template('calendar.html', username=session['username'], tasks=tasks, form=form)
         except Exception as e:
             logger.error(f"Error loading tasks: {str(e)}")
             logger.error(traceback.format_exc())
             flash(f'Error loading tasks: {str(e)}', 'error')
-            return render_template('calendar.html', username=session['username'], tasks=[], form=form)
+            tasks = []
+        return render_template('calendar.html', username=session['username'], tasks=tasks, form=form,
+                               view=view, view_label=label, range_start=start,
+                               previous_args=previous_args, next_args=next_args)
     except Exception as e:
         logger.error(f"Unexpected error in calendar route: {str(e)}")
         logger.error(traceback.format_exc())
         flash('An unexpected error occurred.', 'error')
         return redirect(url_for('dashboard'))
 
+@app.route('/api/tasks')
+def task_feed():
+    """Tasks due in [start, end) as calendar feed events; start and end are ISO dates or datetimes."""
+    if 'username' not in session:
+        return jsonify({'error': 'Login required'}), 401
+    try:
+        start = task_dates.parse_feed_bound(request.args.get('start'))
+        end = task_dates.parse_feed_bound(request.args.get('end'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if end <= start:
+        return jsonify({'error': 'end must be after start'}), 400
+    if end - start > timedelta(days=task_dates.MAX_FEED_DAYS):
+        return jsonify({'error': f'The range may span at most {task_dates.MAX_FEED_DAYS} days'}), 400
+    try:
+        tasks = due_tasks(tenant_store(), start, end)
+    except Exception as e:
+        logger.error(f"Error loading the task feed: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': 'Error loading tasks'}), 500
+    return jsonify([task_dates.feed_event(task) for task in tasks])
+
 @app.route('/calendar/update_task_status', methods=['POST'])
+@with_db_connection
 def update_task_status():
+    if 'username' not in session:
+        return redirect(url_for('index'))
     task_id = request.form.get('task_id')
     if not task_id:
         flash('Task ID missing.', 'error')
         return redirect(url_for('calendar'))
 
-    ref = db.collection('calendar_tasks').document(task_id)
-    task = ref.get()
-    if not task.exists:
+    task = tenant_store().tasks.get(task_id)
+    if task is None:
         flash('Task not found.', 'error')
-        return redirect(url_for('calendar'))
+        return redirect_back(url_for('calendar'))
     
-    current_status = task.to_dict().get('done', False)
-    ref.update({'done': not current_status})
+    tenant_store().tasks.update(task_id, {'done': not task.done})
     flash('Task status updated.', 'success')
-    return redirect(url_for('calendar'))
+    return redirect_back(url_for('calendar'))
+
+@app.route('/calendar/bulk', methods=['POST'])
+def bulk_tasks():
+    if 'username' not in session:
+        return redirect(url_for('index'))
+    back = url_for('calendar')
+    ids = selected_ids()
+    action = request.form.get('action')
+    if not ids:
+        flash('No tasks selected.', 'error')
+        return redirect_back(back)
+    if len(ids) > MAX_BULK_IDS:
+        flash(f'Select at most {MAX_BULK_IDS} tasks at a time.', 'error')
+        return redirect_back(back)
+
+    try:
+        if action in ('done', 'not_done'):
+            changed, missing = tenant_store().tasks.bulk_update(ids, {'done': action == 'done'})
+            message = f"{changed} tasks marked {'done' if action == 'done' else 'not done'}."
+        elif action == 'delete':
+            changed, missing = tenant_store().tasks.bulk_delete(ids)
+            message = f'{changed} tasks deleted.'
+        else:
+            flash('Invalid action.', 'error')
+            return redirect_back(back)
+    except Exception as e:
+        if resilience.is_unavailable(e):
+            return service_unavailable(e)
+        logger.error(f"Bulk {action} on tasks failed: {str(e)}")
+        logger.error(traceback.format_exc())
+        flash(f'Error updating tasks: {str(e)}', 'error')
+        return redirect_back(back)
+
+    if missing:
+        message += f' {missing} no longer existed.'
+    flash(message, 'success')
+    return redirect_back(back)
 
 @app.route('/calendar/delete/<string:task_id>', methods=['POST'])
+@with_db_connection
 def delete_task(task_id):
-    db.collection('calendar_tasks').document(task_id).delete()
+    if 'username' not in session:
+        return redirect(url_for('index'))
+    tenant_store().tasks.delete(task_id)
     flash('Task deleted.', 'success')
-    return redirect(url_for('calendar'))
+    return redirect_back(url_for('calendar'))
 
 @app.route('/calendar/edit/<string:task_id>', methods=['POST'])
 def edit_task(task_id):
+    if 'username' not in session:
+        return redirect(url_for('index'))
     try:
-        ref = db.collection('calendar_tasks').document(task_id)
-        task = ref.get()
-        if not task.exists:
+        if tenant_store().tasks.get(task_id) is None:
             flash('Task not found.', 'error')
             return redirect(url_for('calendar'))
 
@@ -566,23 +1010,39 @@ def edit_task(task_id):
             flash('Missing required fields.', 'error')
             return redirect(url_for('calendar'))
 
-        dt_str = f"{date} {time}" if time else date
-        ref.update({
+        fields = {
             'name': name,
-            'datetime': dt_str,
             'priority': priority,
-            'price': price
-        })
+            'price': price,
+            # Drops the legacy string of a task edited before migrate-task-dates ran
+            'datetime': firestore.DELETE_FIELD,
+        }
+        fields.update(task_dates.due_fields(datetime.strptime(date, '%Y-%m-%d').date(), time))
+        tenant_store().tasks.update(task_id, fields)
         flash('Task updated.', 'success')
+    except ValueError as e:
+        flash(str(e), 'error')
     except Exception as e:
+        if resilience.is_unavailable(e):
+            return service_unavailable(e)
         logger.error(f"Error updating task: {str(e)}")
         logger.error(traceback.format_exc())
         flash(f'Error updating task: {str(e)}', 'error')
-    return redirect(url_for('calendar'))
+    return redirect_back(url_for('calendar'))
+
+CHART_POINTS_MIN = 10
+CHART_POINTS_LIMIT = 2000
 
 @app.route('/api/chart-data')
 @with_db_connection
 def get_chart_data():
+    """Sales and expense totals per bucket of [start_date, end_date].
+
+    granularity is day, week, month, year or auto (the default): the finest
+    one with at most max_points buckets. An explicit granularity with more
+    buckets than max_points is refused, except day with downsample=lttb,
+    which returns max_points of the days (see analytics.downsample).
+    """
     try:
         start_date = request.args.get('start_date')
         end_date = request.args.get('end_date')
@@ -590,79 +1050,307 @@ def get_chart_data():
         if not start_date or not end_date:
             return jsonify({'error': 'Start date and end date are required'}), 400
             
-        start_date = datetime.strptime(start_date, '%Y-%m-%d')
-        end_date = datetime.strptime(end_date, '%Y-%m-%d')
-        
-        # Get sales data
-        sales = [doc.to_dict() for doc in db.collection('sales').stream()]
-        expenses = [doc.to_dict() for doc in db.collection('expenses').stream()]
-        
-        # Initialize data structures
-        daily_sales = defaultdict(float)
-        daily_pending = defaultdict(float)
-        daily_expenses_paid = defaultdict(float)
-        daily_expenses_pending = defaultdict(float)
-        
-        # Process sales data
-        for sale in sales:
-            try:
-                sale_date = datetime.strptime(sale.get('sale_date', ''), '%Y-%m-%d')
-                if start_date <= sale_date <= end_date:
-                    amount = float(sale.get('sale_amount', 0) or 0)
-                    if sale.get('status') == 'Paid':
-                        daily_sales[sale_date.strftime('%Y-%m-%d')] += amount
-                    else:
-                        daily_pending[sale_date.strftime('%Y-%m-%d')] += amount
-            except (ValueError, TypeError) as e:
-                logger.error(f"Error processing sale data: {str(e)}")
-                continue
-        
-        # Process expenses data
-        for expense in expenses:
-            try:
-                expense_date = datetime.strptime(expense.get('date', ''), '%Y-%m-%d')
-                if start_date <= expense_date <= end_date:
-                    amount = float(expense.get('amount', 0) or 0)
-                    if expense.get('status') == 'Paid':
-                        daily_expenses_paid[expense_date.strftime('%Y-%m-%d')] += amount
-                    else:
-                        daily_expenses_pending[expense_date.strftime('%Y-%m-%d')] += amount
-            except (ValueError, TypeError) as e:
-                logger.error(f"Error processing expense data: {str(e)}")
-                continue
-        
-        # Generate date range
-        date_range = []
-        current_date = start_date
-        while current_date <= end_date:
-            date_str = current_date.strftime('%Y-%m-%d')
-            date_range.append(date_str)
-            current_date += timedelta(days=1)
+        try:
+            start_date = datetime.strptime(start_date, '%Y-%m-%d')
+            end_date = datetime.strptime(end_date, '%Y-%m-%d')
+        except ValueError:
+            return jsonify({'error': 'Dates must be in YYYY-MM-DD format'}), 400
+        if start_date > end_date:
+            return jsonify({'error': 'Start date must not be after end date'}), 400
+        start_key = start_date.strftime('%Y-%m-%d')
+        end_key = end_date.strftime('%Y-%m-%d')
+
+        try:
+            max_points = int(request.args.get('max_points', app.config['CHART_MAX_POINTS']))
+        except ValueError:
+            max_points = None
+        if max_points is None or not CHART_POINTS_MIN <= max_points <= CHART_POINTS_LIMIT:
+            return jsonify({'error': f'max_points must be a number from {CHART_POINTS_MIN} '
+                                     f'to {CHART_POINTS_LIMIT}'}), 400
+        requested = request.args.get('granularity', 'auto')
+        if requested != 'auto' and requested not in analytics.GRANULARITIES:
+            return jsonify({'error': f"granularity must be auto or one of {', '.join(analytics.GRANULARITIES)}"}), 400
+        downsample = request.args.get('downsample') == 'lttb'
+        if request.args.get('downsample') not in (None, 'lttb') or (downsample and requested != 'day'):
+            return jsonify({'error': 'downsample=lttb is only available with granularity=day'}), 400
+        granularity = (analytics.auto_granularity(start_date, end_date, max_points)
+                       if requested == 'auto' else requested)
+        buckets = analytics.bucket_count(start_date, end_date, granularity)
+        # Only auto may exceed the cap, when even yearly buckets do
+        downsampled = downsample and buckets > max_points
+        if buckets > max_points and requested != 'auto' and not downsampled:
+            return jsonify({'error': f'The range has {buckets} {granularity} buckets, more than max_points '
+                                     f'({max_points}); use a coarser granularity, auto or downsample=lttb'}), 400
+
+        # Versions first: a write racing the reads below leaves the tag behind the body, not ahead
+        tenant = tenant_store()
+        versions = tenant.rollups.versions()
+        etag = http_cache.etag_for('chart-data', tenant.tenant_id, start_key, end_key, granularity, max_points,
+                                   downsample, versions['sales'], versions['expenses'])
+        if http_cache.is_fresh(etag):
+            return http_cache.not_modified(etag)
         
-        # Prepare response data
-        response_data = {
-            'labels': date_range,
-            'daily_sales': [daily_sales.get(date, 0) for date in date_range],
-            'daily_pending': [daily_pending.get(date, 0) for date in date_range],
-            'daily_expenses_paid': [daily_expenses_paid.get(date, 0) for date in date_range],
-            'daily_expenses_pending': [daily_expenses_pending.get(date, 0) for date in date_range]
-        }
+        def compute():
+            # Only read the rows inside the requested window; both collections at once
+            sales, expenses = parallel.run_all([
+                lambda: analytics.load_sales(tenant.sales.in_range(start_key, end_key)),
+                lambda: analytics.load_expenses(tenant.expenses.in_range(start_key, end_key)),
+            ], timeout=app.config['READ_DEADLINE'])
+            data = analytics.chart_data(sales, expenses, start_date, end_date, granularity)
+            if downsampled:
+                data = analytics.downsample(data, max_points)
+            return data
+
+        # The Firestore versions also catch writes made by other hosts
+        response_data = tenant.cached(('chart-data', start_key, end_key, granularity, max_points, downsample,
+                                       versions['sales'], versions['expenses']),
+                                      rollups.LEDGER_COLLECTIONS, compute)
+        response_data['granularity'] = granularity
+        response_data['downsampled'] = downsampled
         
-        return jsonify(response_data)
+        return http_cache.tag(jsonify(response_data), etag)
+    except parallel.DeadlineExceeded as e:
+        logger.error(f"Chart data reads timed out: {str(e)}")
+        return jsonify({'error': 'Timed out loading chart data'}), 504
     except Exception as e:
         logger.error(f"Error generating chart data: {str(e)}")
         logger.error(traceback.format_exc())
         return jsonify({'error': 'Error generating chart data'}), 500
 
-# ------------------ Run App ------------------ #
+# ------------------ Live updates ------------------ #
+live_streams = threading.BoundedSemaphore(app.config['LIVE_MAX_STREAMS'])
+
+def live_figures(totals):
+    """The dashboard's figures from all-time totals, as /dashboard computes them."""
+    total_sales = totals['sales_paid'] + totals['sales_pending']
+    return {
+        'total_sales': total_sales,
+        'paid_expenses': totals['expenses_paid'],
+        'pending_expenses': totals['expenses_pending'],
+        'net_income': total_sales - totals['expenses_paid'],
+    }
+
+@app.route('/api/live')
+def live_updates():
+    """Server-Sent Events: a 'totals' event whenever the mirrored sales or expenses change."""
+    if 'username' not in session:
+        return jsonify({'error': 'Login required'}), 401
+    mirror = tenant_store().mirror
+    if mirror is None:
+        return jsonify({'error': 'Live updates are not enabled'}), 404
+    if not live_streams.acquire(blocking=False):
+        return jsonify({'error': 'Too many live connections'}), 503
+    deadline = time.monotonic() + app.config['LIVE_STREAM_SECONDS']
+
+    def stream():
+        # Browsers reconnect by themselves once the stream is recycled
+        yield 'retry: 5000\n\n'
+        version, sent = None, None
+        while time.monotonic() < deadline:
+            current = mirror.wait_for_change(version, timeout=min(15, max(0, deadline - time.monotonic())))
+            if current == version:
+                yield ': keepalive\n\n'
+                continue
+            version = current
+            totals = mirror.totals()
+            if totals is not None and totals != sent:
+                sent = totals
+                yield f"event: totals\ndata: {json.dumps(live_figures(totals))}\n\n"
+
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
+    # Runs even when the client goes away before the first chunk
+    response.call_on_close(live_streams.release)
+    return response
+
+# ------------------ CLI ------------------ #
+tenant_option = click.option('--tenant', 'tenant_id', help='Only this tenant (default: every tenant).')
+
+def cli_tenants(tenant_id):
+    """The TenantStores a maintenance command runs on."""
+    if tenant_id is not None and not tenants.valid_id(tenant_id):
+        raise click.BadParameter(f'Invalid tenant id {tenant_id!r}', param_hint='--tenant')
+    return [store.tenant(t) for t in ([tenant_id] if tenant_id else store.tenant_ids())]
+
+@app.cli.command('disable-user')
+@click.argument('email')
+@click.option('--enable', is_flag=True, help='Re-enable the user instead.')
+def disable_user_command(email, enable):
+    """Disable (or re-enable) a Firebase Auth user and end their sessions."""
+    try:
+        user = store.auth.get_user_by_email(email)
+    except auth.UserNotFoundError:
+        raise click.BadParameter(f'No user with email {email!r}', param_hint='EMAIL')
+    store.auth.update_user(user.uid, disabled=not enable)
+    if enable:
+        click.echo(f"{email}: enabled.")
+        return
+    # Sessions are keyed by uid, or by email for those from before uids were stored
+    session_cache.revoke(user.uid)
+    session_cache.revoke(user.email)
+    store.revoke_sessions(user.uid, user.email)
+    if store.cache is not None:
+        click.echo(f"{email}: disabled; logged out on this host now, "
+                   f"on other hosts within SESSION_VALIDATION_TTL ({session_cache.ttl:g}s).")
+    else:
+        click.echo(f"{email}: disabled; logged out within SESSION_VALIDATION_TTL ({session_cache.ttl:g}s). "
+                   f"Set SHARED_CACHE=1 to log them out on this host at once.")
+
+@app.cli.command('rebuild-rollups')
+@click.option('--check', is_flag=True, help='Only report drift, do not write.')
+@tenant_option
+def rebuild_rollups_command(check, tenant_id):
+    """Recompute the dashboard rollups from the raw sales and expenses."""
+    for tenant in cli_tenants(tenant_id):
+        if check:
+            drift = tenant.rollups.reconcile()
+            for doc_id, (stored, expected) in sorted(drift.items()):
+                click.echo(f"{tenant.tenant_id}/{doc_id}: stored={stored} expected={expected}")
+            click.echo(f"{tenant.tenant_id}: {len(drift)} rollup documents out of date.")
+            continue
+        count = tenant.rollups.rebuild()
+        click.echo(f"{tenant.tenant_id}: rebuilt {count} rollup documents.")
+
+@app.cli.command('rebuild-receivables')
+@click.option('--check', is_flag=True, help='Only report drift, do not write.')
+@tenant_option
+def rebuild_receivables_command(check, tenant_id):
+    """Recompute the per-customer receivables from the raw sales."""
+    for tenant in cli_tenants(tenant_id):
+        if check:
+            drift = tenant.receivables.reconcile()
+            for doc_id, (stored, expected) in sorted(drift.items()):
+                click.echo(f"{tenant.tenant_id}/{doc_id}: stored={stored} expected={expected}")
+            click.echo(f"{tenant.tenant_id}: {len(drift)} customers out of date.")
+            continue
+        count = tenant.receivables.rebuild()
+        click.echo(f"{tenant.tenant_id}: rebuilt {count} customers.")
+
+@app.cli.command('normalize-dates')
+@click.option('--dry-run', is_flag=True, help='Only report what would change.')
+@tenant_option
+def normalize_dates_command(dry_run, tenant_id):
+    """Rewrite legacy sale/expense dates as zero-padded YYYY-MM-DD strings."""
+    for tenant in cli_tenants(tenant_id):
+        report = migrations.normalize_dates(tenant.db, dry_run=dry_run)
+        for collection, (rewritten, unparseable) in report.items():
+            click.echo(f"{tenant.tenant_id}/{collection}: {rewritten} rewritten, {unparseable} unparseable")
+        if not dry_run and any(rewritten for rewritten, _ in report.values()):
+            tenant.rollups.rebuild()
+            tenant.receivables.rebuild()
+            click.echo(f"{tenant.tenant_id}: rollups and receivables rebuilt.")
+
+@app.cli.command('index-customers')
+@click.option('--dry-run', is_flag=True, help='Only report what would change.')
+@tenant_option
+def index_customers_command(dry_run, tenant_id):
+    """Add the customer search field to sales saved before it existed."""
+    for tenant in cli_tenants(tenant_id):
+        updated, total = migrations.index_customers(tenant.db, dry_run=dry_run)
+        if updated and not dry_run:
+            tenant.invalidate('sales')
+        click.echo(f"{tenant.tenant_id}/sales: {updated} of {total} {'to be ' if dry_run else ''}indexed")
+
+@app.cli.command('migrate-task-dates')
+@click.option('--dry-run', is_flag=True, help='Only report what would change.')
+@tenant_option
+def migrate_task_dates_command(dry_run, tenant_id):
+    """Convert legacy calendar task date strings into `due` timestamps."""
+    for tenant in cli_tenants(tenant_id):
+        migrated, unparseable = migrations.migrate_task_dates(tenant.db, dry_run=dry_run)
+        if migrated and not dry_run:
+            tenant.invalidate('calendar_tasks')
+        click.echo(f"{tenant.tenant_id}/calendar_tasks: {migrated} migrated, {unparseable} unparseable")
+
+@app.cli.command('migrate-tenants')
+@click.option('--tenant', 'tenant_id', required=True,
+              help='Tenant that receives documents without a tenant_id field, and users without one.')
+@click.option('--dry-run', is_flag=True, help='Only report what would move.')
+def migrate_tenants_command(tenant_id, dry_run):
+    """Move the global sales, expenses and calendar_tasks into per-tenant collections."""
+    try:
+        report, touched = tenants.migrate(store.db, tenant_id, dry_run=dry_run)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--tenant')
+    for collection, counts in report.items():
+        verb = 'assigned' if collection == tenants.USER_COLLECTION else 'moved'
+        for target, count in sorted(counts.items()):
+            click.echo(f"{collection}: {count} {'to be ' + verb if dry_run else verb} to {target}")
+    if not dry_run:
+        for target in sorted(touched):
+            store.tenant(target).invalidate(*tenants.MIGRATED_COLLECTIONS)
+            count = store.tenant(target).rollups.rebuild()
+            customers = store.tenant(target).receivables.rebuild()
+            click.echo(f"{target}: rebuilt {count} rollup documents and {customers} customers.")
+
+@app.cli.command('run-jobs')
+def run_jobs_command():
+    """Run report jobs in the foreground until interrupted (gunicorn starts its own runners)."""
+    if report_jobs is None:
+        raise click.ClickException('The report job queue could not be opened; see the log.')
+    if report_jobs.per_process:
+        raise click.ClickException('On the memory backend reports run in the web process that queued them.')
+    stop = threading.Event()
+    try:
+        jobs.work(report_jobs, store, stop)
+    except KeyboardInterrupt:
+        stop.set()
+
+@app.cli.command('import-csv')
+@click.argument('collection', type=click.Choice(['sales', 'expenses']))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--tenant', 'tenant_id', required=True, help='Tenant to import into.')
+@click.option('--dry-run', is_flag=True, help='Validate only, do not write.')
+@click.option('--errors', 'errors_path', type=click.Path(dir_okay=False),
+              help='Write the per-row error report to this CSV file.')
+def import_csv_command(collection, path, tenant_id, dry_run, errors_path):
+    """Bulk-import sales or expenses from a CSV file."""
+    repository = getattr(cli_tenants(tenant_id)[0], collection)
+    report = open(errors_path, 'w', newline='', encoding='utf-8') if errors_path else None
+    try:
+        writer = csv.writer(report) if report else None
+        if writer:
+            writer.writerow(['line', 'row_key', 'errors'])
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            try:
+                events = repository.import_csv(f, IMPORT_FORMS[collection], dry_run=dry_run)
+            except ValueError as e:
+                raise click.ClickException(str(e))
+            for event in events:
+                if event['event'] == 'error':
+                    message = imports.format_errors(event['errors'])
+                    if writer:
+                        writer.writerow([event['line'], event['row_key'] or '', message])
+                    else:
+                        click.echo(f"line {event['line']}: {message}", err=True)
+                elif event['event'] == 'progress':
+                    click.echo(f"{event['processed']} rows processed, {event['imported']} imported")
+                else:
+                    verb = 'Would import' if dry_run else 'Imported'
+                    click.echo(f"{verb} {event['imported']} of {event['processed']} rows "
+                               f"({event['skipped']} already imported, {event['failed']} invalid)")
+    finally:
+        if report:
+            report.close()
+
+# ------------------ Application factory ------------------ #
+def create_app(config=None):
+    """The configured WSGI app; gunicorn's entry point (`app:create_app()`, see gunicorn.conf.py).
+
+    The routes are registered on the module-level `app` at import, so their
+    endpoint names stay what the templates use. This applies `config` on top
+    of the environment; a DATA_BACKEND in `config` swaps in a fresh store.
+    No client is created here: that happens on first use in each process, so
+    the app can be preloaded before gunicorn forks its workers.
+    """
+    global store, report_jobs
+    if config:
+        app.config.update(config)
+        if 'DATA_BACKEND' in config:
+            store = datastore.LazyStore(app.config['DATA_BACKEND'])
+            report_jobs = jobs.from_env(app.config['DATA_BACKEND'])
+    return app
+
 if __name__ == '__main__':
-    # Set up proper logging for production
-    if not app.debug:
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.StreamHandler(sys.stdout)
-            ]
-        )
+    # Logging is configured once, at import
     app.run(debug=False)
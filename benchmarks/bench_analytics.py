@@ -0,0 +1,180 @@
+# benchmarks/bench_analytics.py
+#
+# Compares the columnar analytics module with the per-row loops the routes
+# used before it, on synthetic sales and expenses.
+#
+#   python benchmarks/bench_analytics.py                 # 10k, 100k and 1M rows
+#   python benchmarks/bench_analytics.py --sizes 10000 --json
+#
+# Every run also checks that both implementations return identical output.
+# The columnar timings include decoding the rows into models, as the routes do.
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analytics  # noqa: E402
+import models  # noqa: E402
+
+
+def make_records(count, seed=0):
+    rng = random.Random(seed)
+    first = datetime(2020, 1, 1)
+    sales, expenses = [], []
+    for _ in range(count):
+        day = (first + timedelta(days=rng.randrange(5 * 365))).strftime('%Y-%m-%d')
+        sales.append({
+            'customer_name': f'Customer {rng.randrange(500)}',
+            'sale_date': day,
+            'sale_amount': round(rng.uniform(20, 5000), 2),
+            'status': 'Paid' if rng.random() < 0.8 else 'Pending',
+        })
+    for _ in range(count):
+        day = (first + timedelta(days=rng.randrange(5 * 365))).strftime('%Y-%m-%d')
+        expenses.append({
+            'name': 'Ice bags',
+            'date': day,
+            'amount': round(rng.uniform(10, 2000), 2),
+            'status': 'Paid' if rng.random() < 0.7 else 'Pending',
+        })
+    return sales, expenses
+
+
+# ---- The per-row implementations the routes used before analytics.py ----
+
+def legacy_chart_data(sales, expenses, start_date, end_date):
+    daily_sales = defaultdict(float)
+    daily_pending = defaultdict(float)
+    daily_expenses_paid = defaultdict(float)
+    daily_expenses_pending = defaultdict(float)
+    for sale in sales:
+        sale_date = datetime.strptime(sale.get('sale_date', ''), '%Y-%m-%d')
+        if start_date <= sale_date <= end_date:
+            amount = float(sale.get('sale_amount', 0) or 0)
+            if sale.get('status') == 'Paid':
+                daily_sales[sale_date.strftime('%Y-%m-%d')] += amount
+            else:
+                daily_pending[sale_date.strftime('%Y-%m-%d')] += amount
+    for expense in expenses:
+        expense_date = datetime.strptime(expense.get('date', ''), '%Y-%m-%d')
+        if start_date <= expense_date <= end_date:
+            amount = float(expense.get('amount', 0) or 0)
+            if expense.get('status') == 'Paid':
+                daily_expenses_paid[expense_date.strftime('%Y-%m-%d')] += amount
+            else:
+                daily_expenses_pending[expense_date.strftime('%Y-%m-%d')] += amount
+    date_range = []
+    current_date = start_date
+    while current_date <= end_date:
+        date_range.append(current_date.strftime('%Y-%m-%d'))
+        current_date += timedelta(days=1)
+    return {
+        'labels': date_range,
+        'daily_sales': [daily_sales.get(d, 0) for d in date_range],
+        'daily_pending': [daily_pending.get(d, 0) for d in date_range],
+        'daily_expenses_paid': [daily_expenses_paid.get(d, 0) for d in date_range],
+        'daily_expenses_pending': [daily_expenses_pending.get(d, 0) for d in date_range],
+    }
+
+
+def legacy_monthly_sales(sales):
+    monthly_sales = defaultdict(float)
+    for sale in sales:
+        if sale['status'] == 'Paid':
+            dt = datetime.strptime(sale['sale_date'], '%Y-%m-%d')
+            monthly_sales[dt.strftime('%b %Y')] += float(sale.get('sale_amount', 0))
+    sorted_data = sorted(monthly_sales.items(), key=lambda x: datetime.strptime(x[0], '%b %Y'))
+    return [k for k, _ in sorted_data], [v for _, v in sorted_data]
+
+
+def legacy_monthly_expenses(expenses):
+    monthly = defaultdict(float)
+    for e in expenses:
+        dt = datetime.strptime(e['date'], '%Y-%m-%d')
+        monthly[dt.strftime('%b %Y')] += float(e.get('amount', 0))
+    sorted_data = sorted(monthly.items(), key=lambda x: datetime.strptime(x[0], '%b %Y'))
+    return [k for k, _ in sorted_data], [v for _, v in sorted_data]
+
+
+# ---- Columnar equivalents ----
+
+def decode(records, model):
+    return [model.from_dict(str(i), record) for i, record in enumerate(records)]
+
+
+def columnar_all(sales, expenses, start_date, end_date):
+    sale_columns = analytics.load_sales(decode(sales, models.Sale))
+    expense_columns = analytics.load_expenses(decode(expenses, models.Expense))
+    return (analytics.chart_data(sale_columns, expense_columns, start_date, end_date),
+            analytics.monthly_chart(sale_columns, analytics.PAID),
+            analytics.monthly_chart(expense_columns))
+
+
+def legacy_all(sales, expenses, start_date, end_date):
+    return (legacy_chart_data(sales, expenses, start_date, end_date),
+            legacy_monthly_sales(sales),
+            legacy_monthly_expenses(expenses))
+
+
+def timed(fn, *args, repeat=3):
+    best, result = None, None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run(sizes, repeat):
+    start_date, end_date = datetime(2021, 1, 1), datetime(2023, 12, 31)
+    results = []
+    for size in sizes:
+        sales, expenses = make_records(size)
+        legacy_time, legacy = timed(legacy_all, sales, expenses, start_date, end_date, repeat=repeat)
+        columnar_time, columnar = timed(columnar_all, sales, expenses, start_date, end_date, repeat=repeat)
+        if legacy[0] != columnar[0] or list(legacy[1]) != list(columnar[1]) or list(legacy[2]) != list(columnar[2]):
+            raise AssertionError(f'Columnar output differs from the per-row loops at {size} rows')
+        # Aggregation alone, with columns already loaded
+        sale_columns = analytics.load_sales(decode(sales, models.Sale))
+        expense_columns = analytics.load_expenses(decode(expenses, models.Expense))
+        aggregate_time, _ = timed(lambda: (analytics.chart_data(sale_columns, expense_columns, start_date, end_date),
+                                           analytics.monthly_chart(sale_columns, analytics.PAID),
+                                           analytics.monthly_chart(expense_columns)), repeat=repeat)
+        results.append({
+            'rows': size,
+            'legacy_s': round(legacy_time, 4),
+            'columnar_s': round(columnar_time, 4),
+            'columnar_aggregate_only_s': round(aggregate_time, 4),
+            'speedup': round(legacy_time / columnar_time, 1),
+            'aggregate_speedup': round(legacy_time / aggregate_time, 1),
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark columnar analytics against the per-row loops.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'rows':>10} {'legacy':>10} {'columnar':>10} {'agg only':>10} {'speedup':>8} {'agg x':>8}")
+    for row in results:
+        print(f"{row['rows']:>10} {row['legacy_s']:>9.3f}s {row['columnar_s']:>9.3f}s "
+              f"{row['columnar_aggregate_only_s']:>9.4f}s {row['speedup']:>7.1f}x {row['aggregate_speedup']:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
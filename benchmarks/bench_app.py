@@ -0,0 +1,28 @@
+# benchmarks/bench_app.py
+#
+# WSGI entry point for load tests: the app on the in-memory backend, seeded
+# with the synthetic dataset described by BENCH_SALES, BENCH_EXPENSES,
+# BENCH_TASKS and BENCH_SEED. With preload_app (the gunicorn.conf.py default)
+# the master seeds once and the workers inherit the data; with
+# GUNICORN_PRELOAD=0 every worker imports this module and seeds its own copy.
+#
+#   gunicorn benchmarks.bench_app:app --workers=2 --threads=2
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['DATA_BACKEND'] = 'memory'
+
+from app import app, store  # noqa: E402
+from benchmarks import seed  # noqa: E402
+
+# Benchmark clients log in with a plain POST
+app.config['WTF_CSRF_ENABLED'] = False
+
+seed.seed(store,
+          sales=int(os.getenv('BENCH_SALES', 1000)),
+          expenses=int(os.getenv('BENCH_EXPENSES', 300)),
+          tasks=int(os.getenv('BENCH_TASKS', 200)),
+          random_seed=int(os.getenv('BENCH_SEED', 0)))
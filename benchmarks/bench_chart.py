@@ -0,0 +1,110 @@
+# benchmarks/bench_chart.py
+#
+# /api/chart-data payload size and server time for growing date ranges:
+# one point per day, as before the granularity parameter, against the
+# default granularity=auto with max_points.
+#
+#   python benchmarks/bench_chart.py                     # 100k sales over 10 years
+#   python benchmarks/bench_chart.py --max-points 200 --json
+#
+# Every run checks that the bucket totals of each range add up to the daily
+# totals, and that auto stays within max_points.
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+from datetime import timedelta
+
+os.environ.setdefault('DATA_BACKEND', 'memory')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analytics  # noqa: E402
+import models  # noqa: E402
+from benchmarks import seed  # noqa: E402
+
+RANGES_DAYS = [7, 30, 90, 365, 3 * 365, 10 * 365]
+
+
+def columns(sales, years):
+    rng = random.Random(0)
+    end = seed.END_DATE
+    records = []
+    for doc_id, data in seed.make_sales(sales, rng).items():
+        data['sale_date'] = (end - timedelta(days=rng.randrange(years * 365))).strftime('%Y-%m-%d')
+        records.append(models.Sale.from_dict(doc_id, data))
+    return analytics.load_sales(records)
+
+
+def payload(sale_columns, expense_columns, start, end, granularity, max_points=None):
+    data = analytics.chart_data(sale_columns, expense_columns, start, end, granularity)
+    if max_points is not None and len(data['labels']) > max_points:
+        data = analytics.downsample(data, max_points)
+    return data
+
+
+def timed(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run(sales, max_points):
+    sale_columns = columns(sales, 10)
+    expense_columns = analytics.load_expenses([])
+    end = seed.END_DATE
+    results = []
+    for days in RANGES_DAYS:
+        start = end - timedelta(days=days - 1)
+        daily_s, daily = timed(lambda: payload(sale_columns, expense_columns, start, end, 'day'))
+        granularity = analytics.auto_granularity(start, end, max_points)
+        auto_s, auto = timed(lambda: payload(sale_columns, expense_columns, start, end, granularity))
+        lttb_s, lttb = timed(lambda: payload(sale_columns, expense_columns, start, end, 'day', max_points))
+        if len(auto['labels']) > max_points:
+            raise AssertionError(f'{days} days: {len(auto["labels"])} points, over max_points')
+        for name in analytics.CHART_SERIES:
+            if not math.isclose(math.fsum(auto[name]), math.fsum(daily[name]), rel_tol=1e-12, abs_tol=1e-6):
+                raise AssertionError(f'{days} days: {granularity} {name} does not add up to the daily totals')
+        results.append({
+            'days': days,
+            'granularity': granularity,
+            'daily_points': len(daily['labels']),
+            'daily_bytes': len(json.dumps(daily)),
+            'daily_ms': round(daily_s * 1000, 2),
+            'auto_points': len(auto['labels']),
+            'auto_bytes': len(json.dumps(auto)),
+            'auto_ms': round(auto_s * 1000, 2),
+            'lttb_points': len(lttb['labels']),
+            'lttb_ms': round(lttb_s * 1000, 2),
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure /api/chart-data payloads across date ranges.')
+    parser.add_argument('--sales', type=int, default=100_000)
+    parser.add_argument('--max-points', type=int, default=400)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    results = run(args.sales, args.max_points)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'days':>6} {'auto':>6} {'daily pts':>10} {'KiB':>7} {'ms':>7} {'auto pts':>9} {'KiB':>6} "
+          f"{'ms':>6} {'lttb ms':>8}")
+    for row in results:
+        print(f"{row['days']:>6} {row['granularity']:>6} {row['daily_points']:>10} {row['daily_bytes'] / 1024:>7.1f} "
+              f"{row['daily_ms']:>7.2f} {row['auto_points']:>9} {row['auto_bytes'] / 1024:>6.1f} "
+              f"{row['auto_ms']:>6.2f} {row['lttb_ms']:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
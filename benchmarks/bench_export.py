@@ -0,0 +1,109 @@
+# benchmarks/bench_export.py
+#
+# Memory of the streaming exports (/export/sales, /export/expenses) against
+# the number of rows, on the in-memory backend, through the Flask test client
+# with tracemalloc running. Each response is consumed chunk by chunk, as a
+# browser download would, and never buffered whole.
+#
+#   python benchmarks/bench_export.py                     # 10k and 100k rows
+#   python benchmarks/bench_export.py --sizes 10000 200000 --json
+#
+# Only allocations made while the export runs are traced, not the seeded
+# data, nor the sorted index memory_firestore builds on a collection's first
+# query (Firestore keeps its indexes on the server): each export is
+# downloaded once before tracing starts. Every run checks the row count of
+# each export and that the peak traced memory of the largest size stays
+# within --max-growth of the smallest's: a worker holds one page of
+# documents whatever the export size.
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault('DATA_BACKEND', 'memory')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+from benchmarks import seed  # noqa: E402
+
+EXPORTS = [
+    '/export/sales?format=csv',
+    '/export/sales?format=ndjson',
+    '/export/expenses?format=csv',
+    '/export/expenses?format=ndjson',
+]
+
+
+def stream(client, path):
+    """(lines, bytes, seconds, peak traced bytes) of downloading `path` chunk by chunk."""
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    response = client.get(path, buffered=False)
+    if response.status_code != 200:
+        raise AssertionError(f'{path}: {response.status_code}')
+    lines = size = 0
+    for chunk in response.response:
+        lines += chunk.count(b'\n')
+        size += len(chunk)
+    response.close()
+    seconds = time.perf_counter() - started
+    return lines, size, seconds, tracemalloc.get_traced_memory()[1] - baseline
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure export memory against the number of rows.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000],
+                        help='Sales (and expenses) per run')
+    parser.add_argument('--max-growth', type=float, default=1.5,
+                        help='Largest allowed ratio of the peak at the largest size to the smallest')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    app_module.app.config['WTF_CSRF_ENABLED'] = False
+    logging.disable(logging.INFO)
+    results = []
+    for size in sorted(args.sizes):
+        # A fresh store per size; the seeded documents are allocated before tracing starts
+        app_module.create_app({'DATA_BACKEND': 'memory'})
+        app_module.session_cache.clear()
+        seed.seed(app_module.store, sales=size, expenses=size, tasks=0)
+        client = app_module.app.test_client()
+        client.post('/login', data={'email': seed.BENCH_EMAIL, 'password': seed.BENCH_PASSWORD})
+        for path in EXPORTS:
+            for _ in client.get(path, buffered=False).response:
+                pass
+        tracemalloc.start()
+        try:
+            for path in EXPORTS:
+                lines, length, seconds, peak = stream(client, path)
+                # A header line for CSV, none for NDJSON
+                rows = lines - 1 if 'format=csv' in path else lines
+                if rows != size:
+                    raise AssertionError(f'{path}: {rows} rows, expected {size}')
+                results.append({'rows': size, 'export': path, 'bytes': length,
+                                'seconds': round(seconds, 2), 'peak_kb': round(peak / 1024)})
+        finally:
+            tracemalloc.stop()
+
+    smallest, largest = min(args.sizes), max(args.sizes)
+    for path in EXPORTS:
+        peaks = {r['rows']: r['peak_kb'] for r in results if r['export'] == path}
+        if peaks[largest] > peaks[smallest] * args.max_growth:
+            raise AssertionError(f'{path}: peak {peaks[largest]} KiB at {largest} rows against '
+                                 f'{peaks[smallest]} KiB at {smallest}; memory grows with the export')
+
+    if args.json:
+        print(json.dumps({'exports': results}, indent=2))
+        return
+    for r in results:
+        print(f"{r['rows']:>8} rows {r['export']:<30} {r['bytes']:>11} bytes in {r['seconds']:>6} s, "
+              f"peak {r['peak_kb']:>6} KiB")
+
+
+if __name__ == '__main__':
+    main()
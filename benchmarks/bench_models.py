@@ -0,0 +1,167 @@
+# benchmarks/bench_models.py
+#
+# Compares decoding sales, expenses and tasks into the models.py records
+# with the per-row dict normalization the routes used before them: decode
+# throughput from snapshots, and memory held per decoded record.
+#
+#   python benchmarks/bench_models.py                    # 10k and 100k rows
+#   python benchmarks/bench_models.py --sizes 100000 --json
+#
+# Snapshots come from the memory_firestore backend (whose to_dict() copies
+# the stored data, like the real client decoding a response) and from the
+# mirror (mirror.Document). Every run checks that both approaches agree.
+
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import memory_firestore  # noqa: E402
+import mirror  # noqa: E402
+import models  # noqa: E402
+import task_dates  # noqa: E402
+from benchmarks import seed  # noqa: E402
+
+
+# ---- The per-row normalization the routes used before models.py ----
+
+def legacy_sale(doc):
+    sale = doc.to_dict()
+    sale['id'] = doc.id
+    sale['customer_name'] = sale.get('customer_name', '')
+    sale['quantity'] = sale.get('quantity', 0)
+    sale['price_per_unit'] = float(sale.get('price_per_unit', 0))
+    sale['sale_amount'] = float(sale.get('sale_amount', 0))
+    sale['sale_date'] = sale.get('sale_date', '')
+    sale['status'] = sale.get('status', 'Pending')
+    return sale
+
+
+def legacy_expense(doc):
+    e = doc.to_dict()
+    e['id'] = doc.id
+    e['name'] = e.get('name', '')
+    e['amount'] = float(e.get('amount', 0))
+    e['date'] = e.get('date', '')
+    e['status'] = e.get('status', 'Pending')
+    return e
+
+
+def legacy_task(doc):
+    task = doc.to_dict()
+    task['id'] = doc.id
+    task['name'] = task.get('name', '')
+    task['priority'] = task.get('priority', 'normal')
+    task['done'] = task.get('done', False)
+    try:
+        task['price'] = float(task.get('price', 0))
+    except (ValueError, TypeError):
+        task['price'] = 0.0
+    return task
+
+
+KINDS = [
+    # (collection, seed factory, legacy decoder, model)
+    ('sales', seed.make_sales, legacy_sale, models.Sale),
+    ('expenses', seed.make_expenses, legacy_expense, models.Expense),
+    ('calendar_tasks', seed.make_tasks, legacy_task, models.Task),
+]
+
+
+def snapshots(collection, data):
+    db = memory_firestore.Client()
+    db.load(collection, data)
+    return list(db.collection(collection).stream())
+
+
+def timed(fn, docs, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(docs)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def retained_bytes(build):
+    """Bytes still allocated after build() returns, while its result is alive."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return after - before
+
+
+def check(legacy, decoded):
+    for row, record in zip(legacy, decoded):
+        for field in type(record).__dataclass_fields__:
+            if field in row and row[field] != getattr(record, field):
+                raise AssertionError(f'{record.id}: {field} is {getattr(record, field)!r}, expected {row[field]!r}')
+        if isinstance(record, models.Task) and record.due_label != task_dates.display(record):
+            raise AssertionError(f'{record.id}: due label differs')
+
+
+def run(sizes, repeat):
+    results = []
+    for size in sizes:
+        for collection, make, legacy, model in KINDS:
+            data = make(size, random.Random(0))
+            docs = snapshots(collection, data)
+            mirrored = [mirror.Document(doc_id, values) for doc_id, values in data.items()]
+            legacy_rows = [legacy(doc) for doc in docs]
+            check(legacy_rows, [model.from_snapshot(doc) for doc in docs])
+
+            legacy_all = lambda rows: [legacy(doc) for doc in rows]  # noqa: E731
+            model_all = lambda rows: [model.from_snapshot(doc) for doc in rows]  # noqa: E731
+            # As datastore reads the mirror: from the shared data, no copy
+            model_mirror = lambda rows: [model.from_dict(doc.id, doc.data) for doc in rows]  # noqa: E731
+            legacy_s = timed(legacy_all, docs, repeat)
+            model_s = timed(model_all, docs, repeat)
+            legacy_mirror_s = timed(legacy_all, mirrored, repeat)
+            model_mirror_s = timed(model_mirror, mirrored, repeat)
+            legacy_bytes = retained_bytes(lambda: legacy_all(mirrored))
+            model_bytes = retained_bytes(lambda: model_mirror(mirrored))
+            results.append({
+                'collection': collection,
+                'rows': size,
+                'legacy_rows_per_s': round(size / legacy_s),
+                'model_rows_per_s': round(size / model_s),
+                'legacy_mirror_rows_per_s': round(size / legacy_mirror_s),
+                'model_mirror_rows_per_s': round(size / model_mirror_s),
+                'legacy_bytes_per_row': round(legacy_bytes / size),
+                'model_bytes_per_row': round(model_bytes / size),
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark model decoding against per-row dict normalization.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'collection':>15} {'rows':>8} {'dict/s':>10} {'model/s':>10} {'dict/s (mirror)':>16} "
+          f"{'model/s (mirror)':>17} {'dict B/row':>11} {'model B/row':>12}")
+    for row in results:
+        print(f"{row['collection']:>15} {row['rows']:>8} {row['legacy_rows_per_s']:>10} {row['model_rows_per_s']:>10} "
+              f"{row['legacy_mirror_rows_per_s']:>16} {row['model_mirror_rows_per_s']:>17} "
+              f"{row['legacy_bytes_per_row']:>11} {row['model_bytes_per_row']:>12}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+# benchmarks/bench_projection.py
+#
+# Checks the select() projections of the aggregate-only reads: the chart
+# data and the rollup computation must come out identical to reading whole
+# documents, with a smaller payload.
+#
+#   python benchmarks/bench_projection.py                 # 10k and 100k sales
+#   python benchmarks/bench_projection.py --sizes 50000 --json
+#
+# Payload is the size of the documents in Firestore's wire encoding
+# (google.firestore.v1.Document), which is what RunQuery streams back.
+# Exits non-zero when a result differs or a projection is not smaller.
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+os.environ.setdefault('DATA_BACKEND', 'memory')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from firebase_admin import firestore  # noqa: E402
+from google.cloud.firestore_v1 import _helpers, types  # noqa: E402
+
+import analytics  # noqa: E402
+import datastore  # noqa: E402
+import models  # noqa: E402
+import rollups  # noqa: E402
+from benchmarks import seed  # noqa: E402
+
+DOCUMENT_PREFIX = 'projects/project-id/databases/(default)/documents'
+
+
+def wire_bytes(snapshots, collection):
+    total = 0
+    for snapshot in snapshots:
+        document = types.Document(name=f'{DOCUMENT_PREFIX}/{collection}/{snapshot.id}',
+                                  fields=_helpers.encode_dict(snapshot.to_dict()))
+        total += types.Document.pb(document).ByteSize()
+    return total
+
+
+def range_query(store, repository, start, end, projected):
+    query = (repository.db.collection(repository.collection)
+             .where(filter=firestore.FieldFilter(repository.date_field, '>=', start))
+             .where(filter=firestore.FieldFilter(repository.date_field, '<=', end)))
+    return query.select(repository.model.AGGREGATE_FIELDS) if projected else query
+
+
+# ---- Whole-document reads, as before the projections ----
+
+def full_chart(store, start, end):
+    start_key, end_key = start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+    sales = [models.Sale.from_snapshot(doc)
+             for doc in range_query(store, store.sales, start_key, end_key, False).stream()]
+    expenses = [models.Expense.from_snapshot(doc)
+                for doc in range_query(store, store.expenses, start_key, end_key, False).stream()]
+    return analytics.chart_data(analytics.load_sales(sales), analytics.load_expenses(expenses), start, end)
+
+
+def full_compute(db):
+    docs = defaultdict(lambda: defaultdict(float))
+    for collection, (date_field, amount_field) in rollups._LEDGER_FIELDS.items():
+        for doc in db.collection(collection).stream():
+            data = doc.to_dict()
+            amount = rollups._amount(data.get(amount_field))
+            if amount:
+                field = rollups._field(collection, data.get('status'))
+                for doc_id in rollups.rollup_doc_ids(data.get(date_field)):
+                    docs[doc_id][field] += amount
+    return {doc_id: dict(fields) for doc_id, fields in docs.items()}
+
+
+# ---- The projected reads the app makes ----
+
+def projected_chart(store, start, end):
+    start_key, end_key = start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+    return analytics.chart_data(analytics.load_sales(store.sales.in_range(start_key, end_key)),
+                                analytics.load_expenses(store.expenses.in_range(start_key, end_key)), start, end)
+
+
+def projected_compute(db):
+    return {doc_id: {field: value for field, value in data.items() if field in rollups.ROLLUP_FIELDS and value}
+            for doc_id, data in rollups.compute(db).items() if any(data[f] for f in rollups.ROLLUP_FIELDS)}
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - started, result
+
+
+def run(sizes):
+    results = []
+    for size in sizes:
+        store = datastore.create_store('memory')
+        seed.seed(store, sales=size, expenses=size // 3, tasks=0)
+        store = store.tenant(seed.BENCH_UID)
+        end = datetime.combine(seed.END_DATE, datetime.min.time())
+        start = end - timedelta(days=364)
+        start_key, end_key = start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+
+        full_s, full = timed(full_chart, store, start, end)
+        projected_s, projected = timed(projected_chart, store, start, end)
+        if full != projected:
+            raise AssertionError(f'Projected chart data differs at {size} sales')
+        chart_bytes = {
+            projected_flag: sum(wire_bytes(range_query(store, repository, start_key, end_key, projected_flag).stream(),
+                                           repository.collection)
+                                for repository in (store.sales, store.expenses))
+            for projected_flag in (False, True)
+        }
+
+        if full_compute(store.db) != projected_compute(store.db):
+            raise AssertionError(f'Projected rollup computation differs at {size} sales')
+        compute_bytes = {
+            projected_flag: sum(wire_bytes((store.db.collection(collection)
+                                            .select(models.LEDGER_MODELS[collection].AGGREGATE_FIELDS)
+                                            if projected_flag else store.db.collection(collection)).stream(),
+                                           collection)
+                                for collection in rollups.LEDGER_COLLECTIONS)
+            for projected_flag in (False, True)
+        }
+        for name, sizes_by_flag in (('chart', chart_bytes), ('rollups', compute_bytes)):
+            if sizes_by_flag[True] >= sizes_by_flag[False]:
+                raise AssertionError(f'The {name} projection is not smaller at {size} sales')
+
+        results.append({
+            'sales': size,
+            'chart_full_bytes': chart_bytes[False],
+            'chart_projected_bytes': chart_bytes[True],
+            'chart_full_s': round(full_s, 4),
+            'chart_projected_s': round(projected_s, 4),
+            'rollups_full_bytes': compute_bytes[False],
+            'rollups_projected_bytes': compute_bytes[True],
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check and measure the projected aggregate reads.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000])
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    results = run(args.sizes)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'sales':>8} {'chart KiB':>18} {'chart time':>18} {'rollups KiB':>20}")
+    for row in results:
+        print(f"{row['sales']:>8} "
+              f"{row['chart_full_bytes'] / 1024:>8.0f} -> {row['chart_projected_bytes'] / 1024:<6.0f} "
+              f"{row['chart_full_s']:>7.3f}s -> {row['chart_projected_s']:<6.3f}s "
+              f"{row['rollups_full_bytes'] / 1024:>9.0f} -> {row['rollups_projected_bytes'] / 1024:<7.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# benchmarks/bench_reports.py
+#
+# Profit-and-loss report jobs (jobs.py, reports.py) end to end on the memory
+# backend: submit, wait for the job thread to finish, download. The first
+# request for a period generates the file; a repeat at the same ledger
+# versions is served from the job database without running anything.
+#
+#   python benchmarks/bench_reports.py                    # 20k sales, CSV and XLSX
+#   python benchmarks/bench_reports.py --sales 100000 --json
+#
+# Every run checks the report's revenue and expenses against the rollups
+# of the same year, that a repeat returns the same job and bytes, and that a
+# new ledger version makes a new job.
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault('DATA_BACKEND', 'memory')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import datastore  # noqa: E402
+import jobs  # noqa: E402
+import reports  # noqa: E402
+import rollups  # noqa: E402
+from benchmarks import seed  # noqa: E402
+
+
+def download(queue, tenant, kind, period, fmt):
+    """(job, file bytes, seconds) from submitting a report to having its file."""
+    started = time.perf_counter()
+    job = queue.submit(tenant.tenant_id, kind, period, fmt, tenant.rollups.versions())
+    while job['status'] in ('queued', 'running'):
+        time.sleep(0.002)
+        job = queue.job(job['id'], tenant.tenant_id)
+    job, content = queue.result(job['id'], tenant.tenant_id)
+    if content is None:
+        raise AssertionError(f"job {job['id']} {job['status']}: {job['error']}")
+    return job, content, time.perf_counter() - started
+
+
+def check_totals(tenant, year):
+    report = reports.compute(tenant.db, 'annual', year)
+    summary = {row[0]: row for row in report['sections'][0][1]}
+    months = [totals for month, totals in rollups.read_months(tenant.db) if month.startswith(year)]
+    revenue = sum(m['sales_paid'] + m['sales_pending'] for m in months)
+    expenses = sum(m['expenses_paid'] + m['expenses_pending'] for m in months)
+    if abs(summary['Revenue'][3] - revenue) > 0.01 or abs(summary['Expenses'][3] - expenses) > 0.01:
+        raise AssertionError(f"report {summary['Revenue'][3]}/{summary['Expenses'][3]} "
+                             f"!= rollups {revenue}/{expenses}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure report jobs: first generation against a repeat download.')
+    parser.add_argument('--sales', type=int, default=20000)
+    parser.add_argument('--expenses', type=int, default=None, help='Default: a third of --sales')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    store = datastore.create_store('memory')
+    seed.seed(store, sales=args.sales, expenses=args.expenses if args.expenses is not None else args.sales // 3,
+              tasks=0)
+    tenant = store.tenant(seed.BENCH_UID)
+    year = str(seed.END_DATE.year - 1)
+    month = f'{year}-06'
+    check_totals(tenant, year)
+
+    results, ids = [], {}
+    with tempfile.TemporaryDirectory() as directory:
+        queue = jobs.JobQueue(os.path.join(directory, 'jobs.sqlite3'))
+        stop = threading.Event()
+        runner = threading.Thread(target=jobs.work, args=(queue, store, stop), daemon=True)
+        runner.start()
+        try:
+            for kind, period in (('monthly', month), ('annual', year)):
+                for fmt in reports.FORMATS:
+                    job, content, first = download(queue, tenant, kind, period, fmt)
+                    again, repeat_content, repeat = download(queue, tenant, kind, period, fmt)
+                    if again['id'] != job['id'] or repeat_content != content:
+                        raise AssertionError(f'{kind} {fmt}: a repeat made a new job or a different file')
+                    ids[kind, fmt] = job['id']
+                    results.append({'report': kind, 'period': period, 'format': fmt, 'bytes': len(content),
+                                    'first_ms': round(first * 1000, 1), 'repeat_ms': round(repeat * 1000, 2)})
+            # Any ledger write bumps the versions, and with them the job key
+            batch = tenant.db.batch()
+            rollups.bump_version(batch, tenant.db, 'sales')
+            batch.commit()
+            newer, _, _ = download(queue, tenant, 'annual', year, 'csv')
+            if newer['id'] == ids['annual', 'csv']:
+                raise AssertionError('a new ledger version reused the old job')
+        finally:
+            stop.set()
+            runner.join()
+
+    if args.json:
+        print(json.dumps({'sales': args.sales, 'reports': results}, indent=2))
+        return
+    print(f"{args.sales} sales")
+    for r in results:
+        print(f"{r['report']:>8} {r['period']:<8} {r['format']:<5} {r['bytes']:>8} bytes: "
+              f"first {r['first_ms']:>8} ms, repeat {r['repeat_ms']:>6} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+# benchmarks/bench_resilience.py
+#
+# Tail latency of Firestore reads under injected faults (memory_firestore
+# Faults), with and without resilience.py. Each simulated request reads one
+# document and one page of a query from a pool of threads, as a gunicorn
+# worker's threads would; the protected client gets a request budget,
+# retries and its own circuit breaker, the bare one none of them.
+#
+#   python benchmarks/bench_resilience.py                 # 400 requests a phase
+#   python benchmarks/bench_resilience.py --requests 1000 --budget 0.5 --json
+#
+# Phases: healthy; flaky (a share of RPCs fail); stalls (a share of RPCs hang
+# well past the budget); outage (every RPC fails), then recovery. Every run
+# checks that retries raise the success rate of the flaky phase, that no
+# protected request outlasts its budget by much, that the outage trips the
+# breaker and is rejected without calling Firestore, and that the breaker
+# closes again once Firestore is back.
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('DATA_BACKEND', 'memory')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import memory_firestore  # noqa: E402
+import metrics  # noqa: E402
+import resilience  # noqa: E402
+
+DOCUMENTS = 200
+
+
+class CountingFaults(memory_firestore.Faults):
+    """Faults that also count the RPCs that reached the fake, failed or not."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.rpcs = 0
+
+    def draw(self):
+        with self._lock:
+            self.rpcs += 1
+        return super().draw()
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def make_client(latency, protected, breaker):
+    db = memory_firestore.Client(latency=latency)
+    db.load('sales', {f'sale{i:04d}': {'customer_name': f'Customer {i % 20}', 'sale_amount': float(i)}
+                      for i in range(DOCUMENTS)})
+    db = metrics.instrument_client(db)
+    return resilience.protect_client(db, breaker) if protected else db
+
+
+def one_request(db, index, budget):
+    """Seconds taken and the outcome ('ok', 'error' or 'rejected') of one simulated request."""
+    token = resilience.start_budget(budget) if budget else None
+    started = time.perf_counter()
+    try:
+        db.collection('sales').document(f'sale{index % DOCUMENTS:04d}').get()
+        list(db.collection('sales').order_by('sale_amount').limit(20).stream())
+        outcome = 'ok'
+    except resilience.CircuitOpen:
+        outcome = 'rejected'
+    except Exception:
+        outcome = 'error'
+    finally:
+        if token is not None:
+            resilience.end_budget(token)
+    return time.perf_counter() - started, outcome
+
+
+def run_phase(db, faults, requests, threads, budget):
+    db.faults = faults
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        results = list(pool.map(lambda i: one_request(db, i, budget), range(requests)))
+    wall = time.perf_counter() - started
+    latencies = sorted(seconds for seconds, _ in results)
+    outcomes = [outcome for _, outcome in results]
+    return {
+        'ok': outcomes.count('ok'),
+        'errors': outcomes.count('error'),
+        'rejected': outcomes.count('rejected'),
+        'rpcs': faults.rpcs,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'max_ms': round(latencies[-1] * 1000, 1),
+        'wall_s': round(wall, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure Firestore tail latency under injected faults.')
+    parser.add_argument('--requests', type=int, default=400, help='Requests per phase')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--latency-ms', type=float, default=2.0, help='Simulated round trip')
+    parser.add_argument('--budget', type=float, default=0.25, help='Request budget in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.1, help='Failing RPCs in the flaky phase')
+    parser.add_argument('--slow-rate', type=float, default=0.03, help='Stalled RPCs in the stalls phase')
+    parser.add_argument('--slow-seconds', type=float, default=1.0)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    phases = [
+        ('healthy', lambda: CountingFaults()),
+        ('flaky', lambda: CountingFaults(error_rate=args.error_rate, seed=1)),
+        ('stalls', lambda: CountingFaults(slow_rate=args.slow_rate, slow_seconds=args.slow_seconds, seed=2)),
+        ('outage', lambda: CountingFaults(error_rate=1.0, seed=3)),
+    ]
+    # A short window, so the outage is judged on its own calls rather than the phases before it
+    breaker = resilience.CircuitBreaker(window_seconds=1, open_seconds=0.5)
+    clients = {
+        'bare': make_client(args.latency_ms / 1000, False, None),
+        'protected': make_client(args.latency_ms / 1000, True, breaker),
+    }
+    results = {}
+    for name, faults in phases:
+        for label, db in clients.items():
+            results[name, label] = run_phase(db, faults(), args.requests, args.threads,
+                                             args.budget if label == 'protected' else None)
+    # Still open (or probing) right after the outage, before open_seconds have passed
+    state_after_outage = breaker.state
+
+    # Firestore is back: the first call after open_seconds probes and closes the breaker
+    # (calls made while the probe is out are still rejected), then traffic flows again
+    time.sleep(breaker.open_seconds)
+    probe = run_phase(clients['protected'], CountingFaults(), 1, 1, args.budget)
+    recovery = run_phase(clients['protected'], CountingFaults(), args.requests, args.threads, args.budget)
+
+    flaky_bare, flaky = results['flaky', 'bare'], results['flaky', 'protected']
+    if flaky['ok'] <= flaky_bare['ok']:
+        raise AssertionError(f"retries did not help: {flaky['ok']} ok against {flaky_bare['ok']} without")
+    for name, _ in phases:
+        if results[name, 'protected']['max_ms'] > args.budget * 1000 * 1.5:
+            raise AssertionError(f"{name}: a request took {results[name, 'protected']['max_ms']} ms "
+                                 f"with a {args.budget} s budget")
+    outage = results['outage', 'protected']
+    if state_after_outage == breaker.CLOSED or not outage['rejected']:
+        raise AssertionError(f'the outage did not trip the breaker: {state_after_outage}, {outage}')
+    if probe['ok'] != 1 or breaker.state != breaker.CLOSED or recovery['ok'] != args.requests:
+        raise AssertionError(f'the breaker did not recover: {breaker.state}, {probe}, {recovery}')
+
+    if args.json:
+        print(json.dumps({'requests': args.requests, 'threads': args.threads, 'budget_s': args.budget,
+                          'phases': [dict(phase=name, client=label, **r) for (name, label), r in results.items()],
+                          'recovery': recovery}, indent=2))
+        return
+    print(f"{args.requests} requests a phase, {args.threads} threads, {args.budget} s budget")
+    rows = [(name, label, r) for (name, label), r in results.items()] + [('recovery', 'protected', recovery)]
+    for name, label, r in rows:
+        print(f"{name:>8} {label:<9}: ok {r['ok']:>5}  err {r['errors']:>5}  rejected {r['rejected']:>5}  "
+              f"rpcs {r['rpcs']:>5}  p50 {r['p50_ms']:>7} ms  p99 {r['p99_ms']:>7} ms  "
+              f"max {r['max_ms']:>7} ms  wall {r['wall_s']:>5} s")
+
+
+if __name__ == '__main__':
+    main()
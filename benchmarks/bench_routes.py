@@ -0,0 +1,304 @@
+# benchmarks/bench_routes.py
+#
+# Load and latency benchmark for the main pages and /api/chart-data on the
+# in-memory backend, seeded with synthetic data (see seed.py).
+#
+#   python benchmarks/bench_routes.py                          # test client only
+#   python benchmarks/bench_routes.py --mode both --sizes 1000 20000 --output run.json
+#   python benchmarks/bench_routes.py --compare run.json       # fail on p95 regressions
+#   python benchmarks/bench_routes.py --latency-ms 20          # add a simulated network round trip
+#
+# "test-client" drives the app in-process with Flask's test client, so it
+# measures the request handling itself. "gunicorn" starts a real gunicorn
+# (gunicorn.conf.py with --workers=2 --threads=2, unless overridden) and hits it
+# over HTTP from concurrent clients. Results are JSON, one entry per
+# (mode, size, concurrency, route), tagged with the git commit.
+
+import argparse
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks import seed  # noqa: E402
+
+_window_end = seed.END_DATE
+ROUTES = [
+    ('dashboard', '/dashboard'),
+    ('sales', '/sales'),
+    ('expenses', '/expenses'),
+    ('calendar', f"/calendar?month={_window_end.strftime('%Y-%m')}"),
+    ('chart_data_30d', f'/api/chart-data?start_date={_window_end - timedelta(days=29)}&end_date={_window_end}'),
+    ('chart_data_365d', f'/api/chart-data?start_date={_window_end - timedelta(days=364)}&end_date={_window_end}'),
+]
+
+
+def dataset(size, expense_ratio, task_ratio):
+    return {'sales': size, 'expenses': int(size * expense_ratio), 'tasks': int(size * task_ratio)}
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    ms = lambda value: None if value is None else round(value * 1000, 3)  # noqa: E731
+    return {
+        'requests': count,
+        'errors': errors,
+        'throughput_rps': round(count / elapsed, 1) if elapsed else None,
+        'mean_ms': ms(sum(latencies) / count) if count else None,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(latencies[-1]) if count else None,
+    }
+
+
+def drive(make_client, request_fn, path, total, concurrency):
+    """Issue `total` GETs of `path` from `concurrency` clients; returns the summary."""
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    per_client = [total // concurrency + (1 if i < total % concurrency else 0) for i in range(concurrency)]
+
+    def worker(count):
+        nonlocal errors
+        client = make_client()
+        local, failed = [], 0
+        for _ in range(count):
+            started = time.perf_counter()
+            status = request_fn(client, path)
+            local.append(time.perf_counter() - started)
+            if status != 200:
+                failed += 1
+        with lock:
+            latencies.extend(local)
+            errors += failed
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, per_client))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+# ---- In-process, through the Flask test client ----
+
+def run_test_client(sizes, args):
+    os.environ['DATA_BACKEND'] = 'memory'
+    os.environ['MEMORY_FIRESTORE_LATENCY_MS'] = str(args.latency_ms)
+    import app as app_module
+
+    flask_app = app_module.app
+    flask_app.config['WTF_CSRF_ENABLED'] = False
+    # Per-request INFO logging would dominate the numbers and the output
+    logging.disable(logging.INFO)
+    results = []
+    for size in sizes:
+        counts = dataset(size, args.expense_ratio, args.task_ratio)
+        # A fresh store per size; routes look the module global up per request
+        app_module.create_app({'DATA_BACKEND': 'memory'})
+        app_module.session_cache.clear()
+        seeded = time.perf_counter()
+        seed.seed(app_module.store, random_seed=args.seed, **counts)
+        seed_s = time.perf_counter() - seeded
+
+        def make_client():
+            client = flask_app.test_client()
+            client.post('/login', data={'email': seed.BENCH_EMAIL, 'password': seed.BENCH_PASSWORD})
+            return client
+
+        def request_fn(client, path):
+            return client.get(path).status_code
+
+        for concurrency in args.concurrency:
+            for name, path in ROUTES:
+                drive(make_client, request_fn, path, args.warmup, 1)
+                stats = drive(make_client, request_fn, path, args.requests, concurrency)
+                results.append({'mode': 'test-client', 'dataset': counts, 'seed_s': round(seed_s, 3),
+                                 'concurrency': concurrency, 'route': name, **stats})
+                report(results[-1])
+    return results
+
+
+# ---- Over HTTP, against a real gunicorn ----
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(counts, args):
+    port = free_port()
+    env = dict(os.environ,
+               BENCH_SALES=str(counts['sales']), BENCH_EXPENSES=str(counts['expenses']),
+               BENCH_TASKS=str(counts['tasks']), BENCH_SEED=str(args.seed),
+               MEMORY_FIRESTORE_LATENCY_MS=str(args.latency_ms),
+               # Every worker must accept the session cookie issued by any other
+               FLASK_SECRET_KEY='bench-secret-key')
+    command = [sys.executable, '-m', 'gunicorn', 'benchmarks.bench_app:app',
+               f'--bind=127.0.0.1:{port}', f'--workers={args.workers}', f'--threads={args.threads}',
+               '--timeout=120', '--log-level=warning']
+    process = subprocess.Popen(command, cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    import requests
+    deadline = time.monotonic() + args.startup_timeout
+    # Workers only accept connections once seeded and warmed up; require a
+    # run of ready answers so slower workers have a chance to finish too
+    ready = 0
+    while ready < args.workers * 3:
+        if process.poll() is not None:
+            raise RuntimeError(f'gunicorn exited with status {process.returncode}')
+        if time.monotonic() > deadline:
+            process.terminate()
+            raise RuntimeError(f'gunicorn did not become ready within {args.startup_timeout}s')
+        try:
+            ready = ready + 1 if requests.get(f'{base_url}/readyz', timeout=5).ok else 0
+        except requests.RequestException:
+            ready = 0
+            time.sleep(0.2)
+    return process, base_url
+
+
+def run_gunicorn(sizes, args):
+    import requests
+
+    results = []
+    for size in sizes:
+        counts = dataset(size, args.expense_ratio, args.task_ratio)
+        started = time.perf_counter()
+        process, base_url = start_gunicorn(counts, args)
+        startup_s = time.perf_counter() - started
+        try:
+            def make_client():
+                session = requests.Session()
+                session.post(f'{base_url}/login',
+                             data={'email': seed.BENCH_EMAIL, 'password': seed.BENCH_PASSWORD})
+                return session
+
+            def request_fn(session, path):
+                try:
+                    return session.get(base_url + path, allow_redirects=False, timeout=120).status_code
+                except requests.RequestException:
+                    return None
+
+            for concurrency in args.concurrency:
+                for name, path in ROUTES:
+                    drive(make_client, request_fn, path, args.warmup, 1)
+                    stats = drive(make_client, request_fn, path, args.requests, concurrency)
+                    results.append({'mode': 'gunicorn', 'dataset': counts, 'startup_s': round(startup_s, 3),
+                                    'workers': args.workers, 'threads': args.threads,
+                                    'concurrency': concurrency, 'route': name, **stats})
+                    report(results[-1])
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+    return results
+
+
+# ---- Reporting ----
+
+def report(row):
+    print(f"{row['mode']:<11} {row['dataset']['sales']:>8} c={row['concurrency']:<3} {row['route']:<16} "
+          f"{row['throughput_rps']:>8} rps  p50 {row['p50_ms']:>8} ms  p95 {row['p95_ms']:>8} ms  "
+          f"p99 {row['p99_ms']:>8} ms  errors {row['errors']}", file=sys.stderr, flush=True)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(row):
+    return (row['mode'], row['dataset']['sales'], row['concurrency'], row['route'])
+
+
+def compare(baseline, results, threshold):
+    """Print p95 changes against a baseline run; returns the regressed rows."""
+    previous = {result_key(row): row for row in baseline['results']}
+    regressions = []
+    for row in results:
+        before = previous.get(result_key(row))
+        if not before or not before['p95_ms'] or row['p95_ms'] is None:
+            continue
+        change = row['p95_ms'] / before['p95_ms'] - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(row)
+            flag = '  REGRESSION'
+        print(f"{'/'.join(str(part) for part in result_key(row)):<45} p95 {before['p95_ms']:>8} -> "
+              f"{row['p95_ms']:>8} ms ({change:+.0%}){flag}", file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark route latency and throughput on synthetic data.')
+    parser.add_argument('--mode', choices=['test-client', 'gunicorn', 'both'], default='test-client')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                        help='Number of sales per dataset')
+    parser.add_argument('--expense-ratio', type=float, default=0.3, help='Expenses per sale')
+    parser.add_argument('--task-ratio', type=float, default=0.1, help='Calendar tasks per sale')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency-ms', type=float, default=0,
+                        help='Simulated round trip per Firestore RPC on the in-memory backend')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per route and concurrency level')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=2)
+    parser.add_argument('--startup-timeout', type=float, default=120)
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare', metavar='BASELINE', help='Compare p95 latency with an earlier --output file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Relative p95 increase reported as a regression (default 0.2)')
+    args = parser.parse_args()
+
+    results = []
+    if args.mode in ('test-client', 'both'):
+        results += run_test_client(args.sizes, args)
+    if args.mode in ('gunicorn', 'both'):
+        results += run_gunicorn(args.sizes, args)
+
+    document = {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.platform(),
+        'cpus': os.cpu_count(),
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2)
+    else:
+        print(json.dumps(document, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# benchmarks/bench_shared_cache.py
+#
+# The shared read cache (shared_cache.py) across forked processes, as
+# gunicorn workers use it: how many scans run when every process misses the
+# same key at once, and what a hit costs next to the scan it saves.
+#
+#   python benchmarks/bench_shared_cache.py                  # 8 processes, 4 threads each
+#   python benchmarks/bench_shared_cache.py --scan-ms 200 --json
+#
+# The scan is simulated: --scan-ms of sleep returning a list of --rows
+# tuples, about the shape of a table page or chart payload. Every run checks
+# that all callers got the scan's value, and that a bump makes the next read
+# scan again.
+
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import shared_cache  # noqa: E402
+
+SCOPE = 'bench/sales'
+
+
+def scan(scan_ms, rows, counter):
+    with counter.get_lock():
+        counter.value += 1
+    time.sleep(scan_ms / 1000)
+    return [(i, f'customer {i}', i * 1.5) for i in range(rows)]
+
+
+def worker(cache, args, counter, start, results):
+    start.wait()
+    values = []
+
+    def read():
+        values.append(len(cache.get_or_compute(['page'], [SCOPE], lambda: scan(args.scan_ms, args.rows, counter))))
+    threads = [threading.Thread(target=read) for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(values)
+
+
+def stampede(cache, args):
+    """(scans, seconds) for every thread of every process missing one key at once."""
+    context = multiprocessing.get_context('fork')
+    counter = context.Value('i', 0)
+    start = context.Event()
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(cache, args, counter, start, results))
+                 for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    started = time.perf_counter()
+    start.set()
+    values = [value for _ in processes for value in results.get()]
+    elapsed = time.perf_counter() - started
+    for process in processes:
+        process.join()
+    if values != [args.rows] * (args.processes * args.threads):
+        raise AssertionError('a caller got a different value')
+    return counter.value, elapsed
+
+
+def hit_us(cache, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        cache.get_or_compute(['page'], [SCOPE], lambda: None)
+        times.append(time.perf_counter() - started)
+    return statistics.median(times) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the shared read cache across processes.')
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=4, help='Threads per process')
+    parser.add_argument('--scan-ms', type=float, default=100)
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=1000, help='Hits timed')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = shared_cache.SharedCache(os.path.join(directory, 'cache.sqlite3'))
+        scans, stampede_s = stampede(cache, args)
+        hit = hit_us(cache, args.repeat)
+        cache.bump(SCOPE)
+        rescans, _ = stampede(cache, args)
+        if scans != 1 or rescans != 1:
+            raise AssertionError(f'{scans} and {rescans} scans, expected one each')
+        results = {'callers': args.processes * args.threads, 'scans': scans,
+                   'stampede_ms': round(stampede_s * 1000, 1), 'scan_ms': args.scan_ms,
+                   'hit_us': round(hit, 1), 'scans_after_bump': rescans}
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{results['callers']} concurrent misses: {results['scans']} scan, "
+          f"all answered in {results['stampede_ms']} ms (scan {args.scan_ms:g} ms)")
+    print(f"hit: {results['hit_us']} us; after a bump: {results['scans_after_bump']} scan")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+# benchmarks/bench_startup.py
+#
+# Cold start and memory per worker of the production gunicorn profile
+# (gunicorn.conf.py) on the in-memory backend, with and without preload_app.
+#
+#   python benchmarks/bench_startup.py                      # 2 workers, 10k sales
+#   python benchmarks/bench_startup.py --workers 4 --sales 50000 --json
+#
+# Reported per run:
+#   import_s     `import app` in a fresh interpreter (DATA_BACKEND=firestore
+#                without credentials: the import must not connect or retry)
+#   ready_s      from starting gunicorn until every worker answered /readyz
+#   first_ms     the first login + dashboard request once ready
+#   rss / pss / uss  per worker and for the master, in MiB, once ready and
+#                again after --requests requests. PSS splits pages shared
+#                after fork between the processes sharing them; USS counts
+#                only a process's own pages, what another worker would add.
+#
+# Linux only: memory is read from /proc/<pid>/smaps_rollup.
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks import seed  # noqa: E402
+from benchmarks.bench_routes import free_port  # noqa: E402
+
+IMPORT_SNIPPET = 'import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)'
+
+
+def import_seconds(repeat):
+    env = dict(os.environ, DATA_BACKEND='firestore', FIREBASE_CREDENTIALS='')
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', IMPORT_SNIPPET], cwd=ROOT, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        times.append(float(output.strip().splitlines()[-1]))
+    return statistics.median(times)
+
+
+def memory_mib(pid):
+    """{'rss', 'pss', 'uss'} of a process in MiB."""
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(':') and parts[1].isdigit():
+                fields[parts[0][:-1]] = int(parts[1])
+    uss = fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)
+    return {'rss': round(fields['Rss'] / 1024, 1), 'pss': round(fields['Pss'] / 1024, 1),
+            'uss': round(uss / 1024, 1)}
+
+
+def worker_pids(master_pid):
+    with open(f'/proc/{master_pid}/task/{master_pid}/children') as f:
+        return [int(pid) for pid in f.read().split()]
+
+
+def memory_report(master_pid):
+    workers = [memory_mib(pid) for pid in worker_pids(master_pid)]
+    return {'master': memory_mib(master_pid),
+            'worker_mean': {key: round(statistics.mean(w[key] for w in workers), 1) for key in ('rss', 'pss', 'uss')}}
+
+
+def run(preload, args):
+    import requests
+
+    port = free_port()
+    env = dict(os.environ, DATA_BACKEND='memory', GUNICORN_PRELOAD='1' if preload else '0',
+               BENCH_SALES=str(args.sales), BENCH_EXPENSES=str(args.sales // 3), BENCH_TASKS=str(args.sales // 10),
+               FLASK_SECRET_KEY='bench-secret-key')
+    base_url = f'http://127.0.0.1:{port}'
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', 'benchmarks.bench_app:app', '-c', 'gunicorn.conf.py',
+                                f'--bind=127.0.0.1:{port}', f'--workers={args.workers}', '--log-level=warning'],
+                               cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        # Each connection lands on some worker; wait until every one has answered ready
+        ready_pids = set()
+        deadline = time.monotonic() + args.startup_timeout
+        while len(ready_pids) < args.workers:
+            if process.poll() is not None:
+                raise RuntimeError(f'gunicorn exited with status {process.returncode}')
+            if time.monotonic() > deadline:
+                raise RuntimeError(f'gunicorn did not become ready within {args.startup_timeout}s')
+            try:
+                response = requests.get(f'{base_url}/readyz', timeout=5)
+                if response.ok:
+                    ready_pids.add(response.json()['pid'])
+                    continue
+            except requests.RequestException:
+                pass
+            time.sleep(0.05)
+        ready_s = time.perf_counter() - started
+        ready_memory = memory_report(process.pid)
+
+        session = requests.Session()
+        first = time.perf_counter()
+        session.post(f'{base_url}/login', data={'email': seed.BENCH_EMAIL, 'password': seed.BENCH_PASSWORD})
+        session.get(f'{base_url}/dashboard')
+        first_ms = (time.perf_counter() - first) * 1000
+        for i in range(args.requests):
+            # A new connection each time, so the requests spread over the workers
+            session.close()
+            session.get(f"{base_url}/{('sales', 'expenses', 'dashboard')[i % 3]}")
+        return {'preload': preload, 'workers': args.workers, 'sales': args.sales,
+                'ready_s': round(ready_s, 3), 'first_ms': round(first_ms, 1),
+                'memory_ready': ready_memory, 'memory_after': memory_report(process.pid)}
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure gunicorn cold start and memory per worker.')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--sales', type=int, default=10_000)
+    parser.add_argument('--requests', type=int, default=60, help='Requests made before the second memory reading')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs of the import measurement')
+    parser.add_argument('--startup-timeout', type=float, default=120)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    results = {'import_s': round(import_seconds(args.repeat), 3),
+               'runs': [run(preload, args) for preload in (False, True)]}
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"import app: {results['import_s']:.3f}s")
+    print(f"{'preload':>8} {'ready':>8} {'first':>9} {'worker rss/pss/uss MiB':>24} "
+          f"{'after requests':>18} {'master rss':>11}")
+    for row in results['runs']:
+        ready, after = row['memory_ready']['worker_mean'], row['memory_after']['worker_mean']
+        print(f"{str(row['preload']):>8} {row['ready_s']:>7.2f}s {row['first_ms']:>7.1f}ms "
+              f"{ready['rss']:>8}/{ready['pss']}/{ready['uss']:<8} "
+              f"{after['rss']:>8}/{after['pss']}/{after['uss']:<6} {row['memory_ready']['master']['rss']:>9}")
+
+
+if __name__ == '__main__':
+    main()
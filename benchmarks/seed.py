@@ -0,0 +1,85 @@
+# benchmarks/seed.py
+#
+# Deterministic synthetic data for the in-memory backend. The same sizes and
+# seed always produce the same documents, so every gunicorn worker (each with
+# its own in-memory store) serves identical data.
+
+import random
+from datetime import date, timedelta
+
+import search
+import task_dates
+import tenants
+
+BENCH_UID = 'bench-user'
+BENCH_EMAIL = 'bench@example.com'
+BENCH_PASSWORD = 'bench-password'
+
+# Data spans this many days ending on END_DATE
+SPAN_DAYS = 3 * 365
+END_DATE = date(2025, 6, 30)
+
+
+def _day(rng):
+    return (END_DATE - timedelta(days=rng.randrange(SPAN_DAYS))).strftime('%Y-%m-%d')
+
+
+def make_sales(count, rng):
+    sales = {}
+    for i in range(count):
+        quantity = rng.randint(1, 50)
+        price = round(rng.uniform(5, 40), 2)
+        sales[f'sale{i:08d}'] = {
+            'customer_name': f'Customer {rng.randrange(300)}',
+            'quantity': quantity,
+            'price_per_unit': price,
+            'sale_date': _day(rng),
+            'sale_amount': quantity * price,
+            'status': 'Paid' if rng.random() < 0.8 else 'Pending',
+        }
+    return sales
+
+
+def make_expenses(count, rng):
+    expenses = {}
+    for i in range(count):
+        expenses[f'expense{i:08d}'] = {
+            'name': rng.choice(['Ice bags', 'Fuel', 'Electricity', 'Wages', 'Repairs']),
+            'amount': round(rng.uniform(10, 3000), 2),
+            'date': _day(rng),
+            'status': 'Paid' if rng.random() < 0.7 else 'Pending',
+        }
+    return expenses
+
+
+def make_tasks(count, rng):
+    tasks = {}
+    for i in range(count):
+        tasks[f'task{i:08d}'] = {
+            'name': f'Delivery {i}',
+            **task_dates.due_fields(date.fromisoformat(_day(rng)), f'{rng.randint(6, 18):02d}:00'),
+            'priority': rng.choice(['normal', 'high']),
+            'done': rng.random() < 0.5,
+            'price': round(rng.uniform(0, 500), 2),
+        }
+    return tasks
+
+
+def seed(store, sales=1000, expenses=300, tasks=200, random_seed=0):
+    """Fill an in-memory DataStore and create the benchmark user, in a tenant of their own."""
+    rng = random.Random(random_seed)
+    tenant = store.tenant(BENCH_UID)
+    tenants.ensure(store.db, BENCH_UID, name='bench')
+    # As the app writes them, with the customer search field
+    store.db.load(tenant.db.path('sales'),
+                  {doc_id: search.indexed('sales', data) for doc_id, data in make_sales(sales, rng).items()})
+    store.db.load(tenant.db.path('expenses'), make_expenses(expenses, rng))
+    store.db.load(tenant.db.path('calendar_tasks'), make_tasks(tasks, rng))
+    tenant.rollups.rebuild()
+    tenant.receivables.rebuild()
+
+    user = store.auth.create_user(email=BENCH_EMAIL, password=BENCH_PASSWORD,
+                                  display_name='bench', uid=BENCH_UID)
+    store.users.create(user.uid, {'username': 'bench', 'email': BENCH_EMAIL, 'role': 'user',
+                                  'tenant_id': BENCH_UID})
+    return user
@@ -0,0 +1,622 @@
+# datastore.py
+#
+# Data-access layer. Routes go through the repositories on a DataStore
+# instead of calling db.collection(...) directly. The store is backed by
+# Firestore (DATA_BACKEND=firestore, the default) or by the in-process
+# memory_firestore client (DATA_BACKEND=memory), which needs no credentials
+# and is what local runs, load tests and profiling use.
+#
+# Business data is partitioned per tenant (see tenants.py): the DataStore
+# holds the client, auth and the global users, and store.tenant(id) returns
+# the TenantStore whose repositories read and write that tenant's
+# collections only.
+#
+# With MIRROR=1 the sales, expenses and task repositories read from an
+# in-process mirror of their collection whenever it is ready (see mirror.py)
+# and from Firestore otherwise. Writes always go to Firestore.
+#
+# With SHARED_CACHE=1 the routes read through TenantStore.cached, a cache
+# shared by the workers of the host (see shared_cache.py). Every repository
+# write bumps the version of its collection there once it has been made.
+#
+# The app holds a LazyStore: importing the app opens no connection, the
+# DataStore is built on first use, and a Firestore-backed one is built again
+# in a forked child (gunicorn --preload), because gRPC channels and the
+# threads behind them do not survive fork(). gunicorn.conf.py warms each
+# worker's store up before it takes requests; /readyz reports its state.
+#
+# Every RPC the client issues is timed (metrics.py) and then bounded by the
+# request's deadline budget, retried on transient errors and failed fast
+# while Firestore is failing (resilience.py).
+
+import contextlib
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from datetime import datetime
+
+import firebase_admin
+from firebase_admin import auth, credentials, firestore, initialize_app
+from google.api_core import exceptions as gcp_exceptions
+
+import exports
+import imports
+import metrics
+import mirror
+import models
+import pagination
+import parallel
+import receivables
+import resilience
+import rollups
+import search
+import shared_cache
+import tenants
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('firestore', 'memory')
+
+# Seconds between warm-up attempts of a store that failed to come up
+WARM_UP_RETRY_SECONDS = float(os.getenv('WARM_UP_RETRY_SECONDS', 10))
+
+
+# Initialize Firebase with retry mechanism
+def initialize_firebase(max_retries=3, delay=1):
+    """(Firestore client, Auth client) of a Firebase app owned by this process.
+
+    firebase_admin caches its clients per app, so a child process reusing
+    the default app of its parent would inherit the parent's channels; each
+    process initializes an app named after its pid instead.
+    """
+    name = f'store-{os.getpid()}'
+    for attempt in range(max_retries):
+        try:
+            firebase_credentials = os.getenv('FIREBASE_CREDENTIALS')
+            if not firebase_credentials:
+                logger.error("FIREBASE_CREDENTIALS environment variable is not set")
+                raise ValueError("FIREBASE_CREDENTIALS environment variable is not set")
+
+            try:
+                cred_dict = json.loads(firebase_credentials)
+            except json.JSONDecodeError as e:
+                logger.error(f"Invalid JSON in FIREBASE_CREDENTIALS: {str(e)}")
+                raise ValueError("Invalid JSON in FIREBASE_CREDENTIALS")
+
+            try:
+                firebase_app = firebase_admin.get_app(name)
+            except ValueError:
+                firebase_app = initialize_app(credentials.Certificate(cred_dict), name=name)
+            db = firestore.client(firebase_app)
+            logger.info("Firebase initialized successfully")
+            return db, auth.Client(firebase_app)
+        except Exception as e:
+            logger.error(f"Firebase initialization attempt {attempt + 1} failed: {str(e)}")
+            if attempt < max_retries - 1:
+                time.sleep(delay)
+            else:
+                logger.error("All Firebase initialization attempts failed")
+                raise
+
+
+# ------------------ Repositories ------------------ #
+def _scope(db, collection):
+    """The shared cache scope of a tenant's collection."""
+    return f'{db.tenant_id}/{collection}'
+
+
+@contextlib.contextmanager
+def _writing(db, collection, mirror, cache):
+    """Around a write: tell the mirror before it, invalidate the shared cache after it (even a failed one)."""
+    if mirror is not None:
+        mirror.note_write()
+    try:
+        yield
+    finally:
+        if cache is not None:
+            cache.bump(_scope(db, collection))
+
+
+def _from_mirror(model, docs):
+    """Decode mirror.Documents straight from their shared data, without copying it."""
+    decode = model.from_dict
+    return [decode(doc.id, doc.data) for doc in docs]
+
+
+class LedgerRepository:
+    """Sales or expenses: dated amounts with a Paid/Pending status.
+
+    Reads return `model` records (models.Sale or models.Expense). Every
+    write also maintains the rollup documents (see rollups.py).
+    """
+
+    def __init__(self, db, collection, date_field, model, mirror=None, cache=None):
+        self.db = db
+        self.collection = collection
+        self.date_field = date_field
+        self.model = model
+        self.mirror = mirror
+        self.cache = cache
+
+    def _mirrored(self):
+        """The collection's mirror when it can serve a read, else None."""
+        return self.mirror if self.mirror is not None and self.mirror.ready() else None
+
+    def _write(self):
+        return _writing(self.db, self.collection, self.mirror, self.cache)
+
+    def add(self, data):
+        with self._write():
+            return rollups.add_document(self.db, self.collection, search.indexed(self.collection, data))
+
+    def delete(self, doc_id):
+        """Returns False when the document does not exist."""
+        with self._write():
+            return rollups.delete_document(self.db, self.collection, doc_id)
+
+    def update_status(self, doc_id, status):
+        """Returns False when the document does not exist."""
+        with self._write():
+            return rollups.update_status(self.db, self.collection, doc_id, status)
+
+    def bulk_update_status(self, doc_ids, status):
+        """Returns (updated, missing)."""
+        with self._write():
+            return rollups.bulk_update_status(self.db, self.collection, doc_ids, status)
+
+    def bulk_delete(self, doc_ids):
+        """Returns (deleted, missing)."""
+        with self._write():
+            return rollups.bulk_delete(self.db, self.collection, doc_ids)
+
+    def page(self, page_size, after=None, before=None, filters=search.NO_FILTERS):
+        """One pagination.Page whose `docs` are model records, narrowed to search.Filters."""
+        mirrored = self._mirrored()
+        if mirrored is not None:
+            if filters == search.NO_FILTERS:
+                keys, docs = mirrored.sorted_by(self.date_field)
+            else:
+                matches = search.matcher(filters, self.date_field)
+                docs = [doc for doc in mirrored.between(self.date_field, filters.start_date or '',
+                                                        filters.end_date or mirror.LAST_KEY)
+                        if matches(doc.data)]
+                keys = [(doc.data[self.date_field], doc.id) for doc in docs]
+            page = pagination.slice_page(keys, docs, self.date_field, page_size, after=after, before=before)
+            return page._replace(docs=_from_mirror(self.model, page.docs))
+        query = search.apply(self.db.collection(self.collection), filters, self.date_field)
+        page = pagination.fetch_page(query, self.date_field, page_size, after=after, before=before)
+        return page._replace(docs=[self.model.from_snapshot(doc) for doc in page.docs])
+
+    def in_range(self, start, end):
+        """Records whose 'YYYY-MM-DD' date lies within [start, end], for aggregating.
+
+        Only the model's AGGREGATE_FIELDS are read from Firestore; the other
+        attributes keep their defaults.
+        """
+        mirrored = self._mirrored()
+        if mirrored is not None:
+            return _from_mirror(self.model, mirrored.between(self.date_field, start, end))
+        decode = self.model.from_aggregate
+        query = (self.db.collection(self.collection)
+                 .where(filter=firestore.FieldFilter(self.date_field, '>=', start))
+                 .where(filter=firestore.FieldFilter(self.date_field, '<=', end))
+                 .select(self.model.AGGREGATE_FIELDS))
+        records = []
+        for doc in query.stream():
+            # Stop streaming as soon as a sibling read in parallel.run_all fails
+            parallel.raise_if_cancelled()
+            records.append(decode(doc))
+        return records
+
+    def export(self, fmt, **filters):
+        return exports.generate(self.db, self.collection, fmt, **filters)
+
+    def import_csv(self, lines, form_class, **options):
+        """Bulk-import CSV lines; see imports.run for the events it yields."""
+        if self.mirror is not None:
+            self.mirror.note_write()
+        events = imports.run(self.db, self.collection, lines, form_class, **options)
+        return events if self.cache is None else self._invalidating(events)
+
+    def _invalidating(self, events):
+        """Pass on import events, invalidating the cache after each committed batch and at the end."""
+        try:
+            for event in events:
+                if event['event'] == 'progress':
+                    self.cache.bump(_scope(self.db, self.collection))
+                yield event
+        finally:
+            self.cache.bump(_scope(self.db, self.collection))
+
+
+class RollupRepository:
+    def __init__(self, db, cache=None):
+        self.db = db
+        self.cache = cache
+
+    def totals(self):
+        return rollups.read_totals(self.db)
+
+    def versions(self):
+        """{'sales': n, 'expenses': m}: counters bumped by every write to either collection."""
+        return rollups.read_versions(self.db)
+
+    def monthly_chart(self, fields):
+        """Chart labels and values from the monthly rollups, summing `fields` per month."""
+        labels, values = [], []
+        for month, totals in rollups.read_months(self.db):
+            value = sum(totals[field] for field in fields)
+            if value:
+                labels.append(datetime.strptime(month, '%Y-%m').strftime('%b %Y'))
+                values.append(value)
+        return labels, values
+
+    def rebuild(self):
+        try:
+            return rollups.rebuild(self.db)
+        finally:
+            # Totals and monthly charts come from the rollups
+            if self.cache is not None:
+                self.cache.bump(*(_scope(self.db, collection) for collection in rollups.LEDGER_COLLECTIONS))
+
+    def reconcile(self):
+        return rollups.reconcile(self.db)
+
+
+class ReceivablesRepository:
+    """Per-customer totals and aging, maintained by the sales writes (see receivables.py)."""
+
+    def __init__(self, db, cache=None):
+        self.db = db
+        self.cache = cache
+
+    def read(self, include_settled=False):
+        """(customers, totals); see receivables.read."""
+        return receivables.read(self.db, include_settled=include_settled)
+
+    def rebuild(self):
+        try:
+            count = receivables.rebuild(self.db)
+        finally:
+            if self.cache is not None:
+                self.cache.bump(_scope(self.db, 'sales'))
+        # The receivables page is validated by the sales version
+        batch = self.db.batch()
+        rollups.bump_version(batch, self.db, 'sales')
+        batch.commit()
+        return count
+
+    def reconcile(self):
+        return receivables.reconcile(self.db)
+
+
+class TaskRepository:
+    collection = 'calendar_tasks'
+
+    def __init__(self, db, mirror=None, cache=None):
+        self.db = db
+        self.mirror = mirror
+        self.cache = cache
+
+    def _write(self):
+        return _writing(self.db, self.collection, self.mirror, self.cache)
+
+    def add(self, data):
+        with self._write():
+            _, ref = self.db.collection(self.collection).add(data)
+        return ref
+
+    def due_between(self, start, end):
+        """models.Task records due in [start, end) (aware datetimes), soonest first.
+
+        A range query on `due` alone, served by its single-field index, so
+        the cost follows the tasks in the range rather than all of them.
+        """
+        if self.mirror is not None and self.mirror.ready():
+            return _from_mirror(models.Task, self.mirror.between('due', start, end, value_type=datetime,
+                                                                 end_inclusive=False))
+        query = (self.db.collection(self.collection)
+                 .where(filter=firestore.FieldFilter('due', '>=', start))
+                 .where(filter=firestore.FieldFilter('due', '<', end))
+                 .order_by('due'))
+        return [models.Task.from_snapshot(doc) for doc in query.stream()]
+
+    def get(self, task_id):
+        """The models.Task, or None when it does not exist."""
+        snapshot = self.db.collection(self.collection).document(task_id).get()
+        return models.Task.from_snapshot(snapshot) if snapshot.exists else None
+
+    def update(self, task_id, fields):
+        with self._write():
+            self.db.collection(self.collection).document(task_id).update(fields)
+
+    def delete(self, task_id):
+        with self._write():
+            self.db.collection(self.collection).document(task_id).delete()
+
+    def bulk_update(self, task_ids, fields):
+        """Apply the same fields to many tasks; returns (updated, missing)."""
+        with self._write():
+            # update() carries an exists precondition of its own
+            return self._bulk(task_ids, lambda batch, ref: batch.update(ref, fields))
+
+    def bulk_delete(self, task_ids):
+        """Returns (deleted, missing)."""
+        exists = self.db.write_option(exists=True)
+        with self._write():
+            return self._bulk(task_ids, lambda batch, ref: batch.delete(ref, option=exists))
+
+    def _bulk(self, task_ids, write):
+        """One batch per BATCH_LIMIT ids, without reading them first.
+
+        Only when a batch fails because some tasks are gone are the
+        remaining ones looked up and written again.
+        """
+        ids = list(dict.fromkeys(task_ids))
+        target = self.db.collection(self.collection)
+        changed = missing = 0
+        for start in range(0, len(ids), rollups.BATCH_LIMIT):
+            refs = [target.document(task_id) for task_id in ids[start:start + rollups.BATCH_LIMIT]]
+            try:
+                self._commit_each(refs, write)
+            except gcp_exceptions.NotFound:
+                existing = [snapshot.reference for snapshot in self.db.get_all(refs) if snapshot.exists]
+                if existing:
+                    self._commit_each(existing, write)
+                missing += len(refs) - len(existing)
+                refs = existing
+            changed += len(refs)
+        return changed, missing
+
+    def _commit_each(self, refs, write):
+        batch = self.db.batch()
+        for ref in refs:
+            write(batch, ref)
+        batch.commit()
+
+
+class UserRepository:
+    collection = 'users'
+
+    def __init__(self, db):
+        self.db = db
+
+    def create(self, uid, data):
+        self.db.collection(self.collection).document(uid).set(data)
+
+    def get(self, uid):
+        """The users/{uid} document as a dict, or None."""
+        snapshot = self.db.collection(self.collection).document(uid).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def tenant_of(self, uid):
+        """The tenant id of a user (their own uid unless assigned to a shop), or None without a profile."""
+        data = self.get(uid)
+        return tenants.tenant_of(uid, data) if data is not None else None
+
+
+# ------------------ Local auth ------------------ #
+class LocalUser:
+    def __init__(self, uid, email, display_name, disabled=False):
+        self.uid = uid
+        self.email = email
+        self.display_name = display_name
+        self.disabled = disabled
+
+
+class LocalAuth:
+    """In-process replacement for the firebase_admin.auth calls the app makes."""
+
+    UserNotFoundError = auth.UserNotFoundError
+    EmailAlreadyExistsError = auth.EmailAlreadyExistsError
+
+    def __init__(self):
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def create_user(self, email, password=None, display_name=None, email_verified=False, uid=None):
+        with self._lock:
+            if any(user.email == email for user in self._users.values()):
+                raise auth.EmailAlreadyExistsError(f'Email already exists: {email}', None, None)
+            user = LocalUser(uid or secrets.token_hex(14), email, display_name)
+            self._users[user.uid] = user
+            return user
+
+    def get_user(self, uid):
+        with self._lock:
+            user = self._users.get(uid)
+        if user is None:
+            raise auth.UserNotFoundError(f'No user record found for uid: {uid}', None, None)
+        return user
+
+    def get_user_by_email(self, email):
+        with self._lock:
+            user = next((user for user in self._users.values() if user.email == email), None)
+        if user is None:
+            raise auth.UserNotFoundError(f'No user record found for email: {email}', None, None)
+        return user
+
+    def update_user(self, uid, disabled=None, display_name=None):
+        user = self.get_user(uid)
+        if disabled is not None:
+            user.disabled = disabled
+        if display_name is not None:
+            user.display_name = display_name
+        return user
+
+
+# ------------------ Store ------------------ #
+class TenantStore:
+    """The repositories of one tenant's data."""
+
+    def __init__(self, db, mirror=None, cache=None):
+        # A tenants.TenantDB
+        self.db = db
+        self.tenant_id = db.tenant_id
+        # The tenant's in-process mirror (mirror.Mirror) when MIRROR=1, else None
+        self.mirror = mirror
+        # The host's shared_cache.SharedCache when SHARED_CACHE=1, else None
+        self.cache = cache
+        collection = mirror.collection if mirror is not None else (lambda name: None)
+        self.sales = LedgerRepository(db, 'sales', 'sale_date', models.Sale, collection('sales'), cache)
+        self.expenses = LedgerRepository(db, 'expenses', 'date', models.Expense, collection('expenses'), cache)
+        self.rollups = RollupRepository(db, cache)
+        self.receivables = ReceivablesRepository(db, cache)
+        self.tasks = TaskRepository(db, collection('calendar_tasks'), cache)
+
+    def cached(self, parts, collections, compute):
+        """compute(), through the shared cache when there is one.
+
+        `parts` identify the value within this tenant, parts[0] naming its
+        kind; `collections` are those it is computed from, so a write to any
+        of them invalidates it.
+        """
+        if self.cache is None:
+            return compute()
+        return self.cache.get_or_compute([parts[0], self.tenant_id, *parts[1:]],
+                                         [_scope(self.db, name) for name in collections], compute)
+
+    def invalidate(self, *collections):
+        """Drop cached values of `collections`, for writes made around the repositories."""
+        if self.cache is not None:
+            self.cache.bump(*(_scope(self.db, name) for name in collections))
+
+
+class DataStore:
+    def __init__(self, db, auth_client, mirrored=False, cache=None):
+        self.db = db
+        self.auth = auth_client
+        self.users = UserRepository(db)
+        self.cache = cache
+        # Every tenant's mirror counts against one MIRROR_MAX_DOCUMENTS ceiling
+        self._budget = mirror.Budget() if mirrored else None
+        self._tenants = {}
+        self._lock = threading.Lock()
+
+    def tenant(self, tenant_id):
+        """The TenantStore of `tenant_id`, created on first use and kept for the life of the process."""
+        store = self._tenants.get(tenant_id)
+        if store is None:
+            with self._lock:
+                store = self._tenants.get(tenant_id)
+                if store is None:
+                    db = tenants.TenantDB(self.db, tenant_id)
+                    mirrored = mirror.Mirror(db, budget=self._budget) if self._budget is not None else None
+                    store = TenantStore(db, mirrored, self.cache)
+                    self._tenants[tenant_id] = store
+        return store
+
+    def session_generation(self, key):
+        """Revocation counter of the sessions of user `key`, shared by the workers of the host (0 without SHARED_CACHE)."""
+        return self.cache.version(f'session:{key}') if self.cache is not None else 0
+
+    def revoke_sessions(self, *keys):
+        """Make every worker of the host re-validate the sessions of users `keys` (see session_cache.py)."""
+        if self.cache is not None:
+            self.cache.bump(*(f'session:{key}' for key in keys))
+
+    def tenant_ids(self):
+        """Ids of every tenant with a tenants/{id} document."""
+        return tenants.list_ids(self.db)
+
+
+def create_store(backend='firestore'):
+    """Build the DataStore for a DATA_BACKEND value."""
+    if backend == 'firestore':
+        db, auth_client = initialize_firebase()
+        return _store(resilience.protect_client(metrics.instrument_client(db)), auth_client, backend)
+    if backend == 'memory':
+        import memory_firestore
+        logger.info("Using the in-memory data backend; data is lost on restart")
+        # Optional simulated round trip per RPC, for load tests and profiling
+        latency = float(os.getenv('MEMORY_FIRESTORE_LATENCY_MS', 0)) / 1000
+        # Optional injected failures and stalls, for exercising resilience.py
+        faults = None
+        if os.getenv('MEMORY_FIRESTORE_ERROR_RATE') or os.getenv('MEMORY_FIRESTORE_SLOW_RATE'):
+            faults = memory_firestore.Faults(error_rate=float(os.getenv('MEMORY_FIRESTORE_ERROR_RATE', 0)),
+                                             slow_rate=float(os.getenv('MEMORY_FIRESTORE_SLOW_RATE', 0)),
+                                             slow_seconds=float(os.getenv('MEMORY_FIRESTORE_SLOW_MS', 5000)) / 1000)
+        db = memory_firestore.Client(latency=latency, faults=faults)
+        return _store(resilience.protect_client(metrics.instrument_client(db)), LocalAuth(), backend)
+    raise ValueError(f"Unknown DATA_BACKEND {backend!r}; expected one of {', '.join(BACKENDS)}")
+
+
+def _store(db, auth_client, backend):
+    cache = shared_cache.from_env(backend)
+    if os.getenv('MIRROR', '0') == '1':
+        logger.info("Serving sales, expenses and task reads from an in-process mirror")
+        return DataStore(db, auth_client, mirrored=True, cache=cache)
+    return DataStore(db, auth_client, cache=cache)
+
+
+class LazyStore:
+    """The DataStore of this process for a DATA_BACKEND, built on first use.
+
+    Reads like the DataStore itself (store.users, store.tenant(...)). A
+    Firestore-backed store is rebuilt after a fork; a memory one is kept, as
+    its data is plain objects that the child inherits (so a --preload master
+    can seed it once for every worker).
+    """
+
+    def __init__(self, backend):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown DATA_BACKEND {backend!r}; expected one of {', '.join(BACKENDS)}")
+        self.backend = backend
+        self._store = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # Warm-up state of this process: (pid, ready, error, time of the last attempt)
+        self._warm = (None, False, None, 0.0)
+        # Pid of the process running a background warm-up, if any
+        self._warming = None
+
+    def _current(self):
+        store = self._store
+        if store is not None and (self._pid == os.getpid() or self.backend == 'memory'):
+            return store
+        with self._lock:
+            if self._store is None or (self._pid != os.getpid() and self.backend != 'memory'):
+                started = time.perf_counter()
+                self._store = create_store(self.backend)
+                self._pid = os.getpid()
+                logger.info(f"Data store ({self.backend}) created in process {self._pid} "
+                            f"in {(time.perf_counter() - started) * 1000:.0f}ms")
+            return self._store
+
+    def __getattr__(self, name):
+        return getattr(self._current(), name)
+
+    def warm_up(self):
+        """Build the store and make one read, so the first request does not pay for connecting. True on success."""
+        started = time.monotonic()
+        try:
+            list(self._current().db.collection(tenants.TENANT_COLLECTION).limit(1).stream(timeout=10))
+        except Exception as e:
+            logger.error(f"Data store warm-up failed: {str(e)}")
+            self._warm = (os.getpid(), False, str(e), started)
+            return False
+        self._warm = (os.getpid(), True, None, started)
+        logger.info(f"Data store warmed up in {(time.monotonic() - started) * 1000:.0f}ms")
+        return True
+
+    def readiness(self):
+        """(ready, error) for this process. Starts a background warm-up when one is due."""
+        pid, ready, error, attempted = self._warm
+        if pid == os.getpid() and ready:
+            return True, None
+        if pid != os.getpid() or time.monotonic() - attempted >= WARM_UP_RETRY_SECONDS:
+            with self._lock:
+                start = self._warming != os.getpid()
+                self._warming = os.getpid()
+            if start:
+                threading.Thread(target=self._background_warm_up, name='store-warm-up', daemon=True).start()
+        return False, error if pid == os.getpid() else None
+
+    def _background_warm_up(self):
+        try:
+            self.warm_up()
+        finally:
+            self._warming = None
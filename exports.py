@@ -0,0 +1,114 @@
+# exports.py
+#
+# Streaming CSV / NDJSON exports of sales and expenses. Documents are read in
+# fixed-size pages and encoded one row at a time, so a worker never holds
+# more than one page of the result set in memory.
+
+import csv
+import io
+import json
+
+from firebase_admin import firestore
+
+import search
+
+EXPORT_PAGE_SIZE = 500
+
+DATE_FIELDS = {
+    'sales': 'sale_date',
+    'expenses': 'date',
+}
+
+# (document field, CSV header) in output order
+EXPORT_COLUMNS = {
+    'sales': [
+        ('customer_name', 'Customer Name'),
+        ('quantity', 'Quantity'),
+        ('price_per_unit', 'Price per Unit'),
+        ('sale_amount', 'Total Amount'),
+        ('sale_date', 'Date'),
+        ('status', 'Status'),
+    ],
+    'expenses': [
+        ('name', 'Expense Name'),
+        ('amount', 'Amount (THB)'),
+        ('date', 'Date'),
+        ('status', 'Status'),
+    ],
+}
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def build_query(db, collection, start_date=None, end_date=None, status=None, customer=None):
+    """`customer` is a normalized customer name prefix (see search.py); sales only."""
+    date_field = DATE_FIELDS[collection]
+    query = db.collection(collection)
+    if customer:
+        query = query.where(filter=firestore.FieldFilter(search.FIELD, 'array_contains', customer))
+    if status:
+        query = query.where(filter=firestore.FieldFilter('status', '==', status))
+    if start_date:
+        query = query.where(filter=firestore.FieldFilter(date_field, '>=', start_date))
+    if end_date:
+        query = query.where(filter=firestore.FieldFilter(date_field, '<=', end_date))
+    return query.order_by(date_field).order_by('__name__')
+
+
+def iter_documents(query, page_size=EXPORT_PAGE_SIZE):
+    """Yield every document of an ordered query, fetching page_size documents per RPC."""
+    last = None
+    while True:
+        page = query.start_after(last) if last is not None else query
+        count = 0
+        for doc in page.limit(page_size).stream():
+            count += 1
+            last = doc
+            yield doc
+        if count < page_size:
+            return
+
+
+def _row(doc, columns):
+    data = doc.to_dict()
+    return [data.get(field, '') for field, _ in columns]
+
+
+def csv_lines(docs, collection):
+    """Yield the CSV export line by line, header first."""
+    columns = EXPORT_COLUMNS[collection]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        value = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        return value
+
+    writer.writerow(['ID'] + [header for _, header in columns])
+    yield flush()
+    for doc in docs:
+        writer.writerow([doc.id] + _row(doc, columns))
+        yield flush()
+
+
+def ndjson_lines(docs, collection):
+    """Yield one JSON object per line."""
+    columns = EXPORT_COLUMNS[collection]
+    for doc in docs:
+        record = dict(zip((field for field, _ in columns), _row(doc, columns)))
+        record['id'] = doc.id
+        yield json.dumps(record, ensure_ascii=False, default=str) + '\n'
+
+
+def generate(db, collection, fmt, start_date=None, end_date=None, status=None, customer=None,
+             page_size=EXPORT_PAGE_SIZE):
+    query = build_query(db, collection, start_date, end_date, status, customer)
+    docs = iter_documents(query, page_size)
+    if fmt == 'ndjson':
+        return ndjson_lines(docs, collection)
+    return csv_lines(docs, collection)
@@ -0,0 +1,135 @@
+# gunicorn.conf.py
+#
+# Production worker profile; gunicorn reads it from the working directory
+# (`gunicorn` alone, or `gunicorn -c gunicorn.conf.py`). Command-line flags
+# override anything set here.
+#
+# Sizing: requests mostly wait on Firestore, so concurrency comes from
+# threads, and processes are sized by CPU for the work that does hold the
+# GIL (templates, chart aggregation, CSV parsing). Each worker keeps its own
+# store, session cache and, with MIRROR=1, its own copy of the mirrored
+# collections, so extra workers cost memory without adding throughput.
+#
+#   WEB_CONCURRENCY     workers (default: available CPUs, at least 2)
+#   GUNICORN_THREADS    threads per worker (default 8, plus LIVE_MAX_STREAMS
+#                       with MIRROR=1, as every /api/live stream holds one)
+#   GUNICORN_PRELOAD    0 to import the app in each worker instead of once
+#                       in the master (default 1; the import opens no
+#                       connection, see datastore.LazyStore)
+#   GUNICORN_TIMEOUT    seconds before a silent worker is restarted (120)
+#   GUNICORN_MAX_REQUESTS  recycle a worker after this many requests
+#                       (default 0, never: a new worker starts cold)
+#   LOG_LEVEL           gunicorn log level (info)
+#   JOBS_PROCESSES      report job runners forked by the master next to the
+#                       workers (default 1; 0 to run jobs in the workers,
+#                       see jobs.py). None on the memory backend.
+#
+# Cold start and memory per worker: benchmarks/bench_startup.py.
+
+import importlib
+import logging
+import os
+import signal
+import sys
+import threading
+
+
+def available_cpus():
+    """CPUs this process may use: its affinity mask, capped by a cgroup v2 CPU quota."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cpus = min(cpus, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+wsgi_app = 'app:create_app()'
+
+workers = int(os.getenv('WEB_CONCURRENCY', max(2, available_cpus())))
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+if os.getenv('MIRROR', '0') == '1':
+    threads += int(os.getenv('LIVE_MAX_STREAMS', 4))
+worker_class = 'gthread'
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') != '0'
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+# The worker heartbeat file; on a container's overlay filesystem a write can stall long enough to get killed
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.getenv('LOG_LEVEL', 'info')
+
+
+def post_worker_init(worker):
+    """Connect this worker's data store before it accepts requests."""
+    app_module = sys.modules.get('app')
+    if app_module is None:
+        return
+    if not app_module.store.warm_up():
+        # The worker still starts; /readyz answers 503 and retries in the background
+        logging.getLogger('gunicorn.error').warning(f"Worker {worker.pid} started with its data store unavailable")
+
+
+# Pids of the report job runners this master started
+job_runners = []
+
+
+def _run_jobs(server):
+    """Body of a job runner process: run report jobs until SIGTERM."""
+    stop = threading.Event()
+    for listener in server.LISTENERS:
+        listener.close()
+    # The master's handlers would act on the arbiter from this process
+    for signum in (signal.SIGINT, signal.SIGHUP, signal.SIGQUIT, signal.SIGUSR1, signal.SIGUSR2,
+                   signal.SIGWINCH, signal.SIGTTIN, signal.SIGTTOU, signal.SIGCHLD):
+        signal.signal(signum, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    app_module = importlib.import_module('app')
+    if app_module.report_jobs is None:
+        return
+    import jobs
+    jobs.work(app_module.report_jobs, app_module.store, stop)
+
+
+def when_ready(server):
+    """Fork the report job runners once the master is listening."""
+    count = int(os.getenv('JOBS_PROCESSES', 1))
+    if os.getenv('DATA_BACKEND', 'firestore') == 'memory':
+        # Each worker has its own data; jobs run in the worker that queued them
+        count = 0
+    for _ in range(count):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _run_jobs(server)
+            except BaseException:
+                logging.getLogger('gunicorn.error').exception('Report job runner failed')
+                code = 1
+            finally:
+                os._exit(code)
+        job_runners.append(pid)
+        server.log.info(f"Started report job runner {pid}")
+
+
+def on_exit(server):
+    """Stop the report job runners; a job cut short is run again by the next runner."""
+    for pid in job_runners:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
@@ -0,0 +1,81 @@
+# http_cache.py
+#
+# Conditional GETs for the read-heavy endpoints. Every write to sales or
+# expenses bumps that collection's counter in versions/ledger in the same
+# commit (see rollups.bump_version). A response's ETag hashes the request
+# parameters together with the versions it was built from, so a request
+# whose If-None-Match still matches gets a 304 after reading that single
+# document instead of scanning the collections.
+#
+# Read the versions before the data: a write landing in between then only
+# makes the ETag older than the body, which costs one extra 200 later and
+# never serves a stale body under a current tag.
+#
+# Responses are sent with "Cache-Control: private, no-cache": browsers keep
+# them but revalidate on every use, and shared caches must not store pages
+# that carry a user's name and CSRF token.
+
+import hashlib
+import json
+import os
+import time
+
+from flask import current_app, request
+
+CACHE_CONTROL = 'private, no-cache'
+
+_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def _code_fingerprint():
+    """Hash of the templates and modules, so a deploy invalidates every tag."""
+    digest = hashlib.sha256()
+    paths = [os.path.join(_ROOT, name) for name in os.listdir(_ROOT) if name.endswith('.py')]
+    for directory, _, files in os.walk(os.path.join(_ROOT, 'templates')):
+        paths.extend(os.path.join(directory, name) for name in files)
+    for path in sorted(paths):
+        digest.update(os.path.relpath(path, _ROOT).encode('utf-8'))
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+# The same in every worker of a deploy, so any worker can answer a tag another issued
+BUILD_ID = os.getenv('APP_VERSION') or _code_fingerprint()
+
+
+def etag_for(*parts):
+    """A strong ETag value for a response determined by the JSON-serialisable `parts`."""
+    payload = json.dumps([BUILD_ID, *parts], sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+
+def token_window(time_limit):
+    """Time bucket for pages that embed a CSRF token valid for `time_limit` seconds.
+
+    Part of a page's ETag, so a browser never revalidates a page whose token
+    is older than half the limit.
+    """
+    if not time_limit:
+        return 0
+    return int(time.time() // (time_limit / 2))
+
+
+def is_fresh(etag):
+    """True when the request's If-None-Match already names `etag`."""
+    return etag is not None and request.if_none_match.contains(etag)
+
+
+def not_modified(etag):
+    response = current_app.response_class(status=304)
+    return tag(response, etag)
+
+
+def tag(response, etag):
+    """Attach `etag` to a full response; without one, forbid storing it."""
+    if etag is None:
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
@@ -0,0 +1,211 @@
+# imports.py
+#
+# Bulk CSV import of sales and expenses. Each row is validated with the same
+# WTForms class as the entry form, and valid rows are packed into write
+# batches of at most BATCH_LIMIT writes: the rows themselves plus their
+# rollup increments, summed per rollup document. A batch therefore lands
+# atomically together with its share of the dashboard totals.
+#
+# Rows with a row key are idempotent: the document id is derived from the
+# key, ids that already exist are skipped and new ones are written with
+# create(), so re-running a file (or racing another import of it) never
+# writes a row twice. Rows without a key get a fresh id on every run.
+
+import csv
+import hashlib
+from collections import namedtuple
+
+from google.api_core import exceptions
+from werkzeug.datastructures import MultiDict
+
+import receivables
+import rollups
+import search
+
+KEY_COLUMNS = ('row_key', 'row key')
+
+# Lower-cased CSV header -> form field. Both the export headers and the
+# document field names are accepted, so an export can be imported back.
+COLUMNS = {
+    'sales': {
+        'customer name': 'customerName',
+        'customer_name': 'customerName',
+        'quantity': 'quantity',
+        'price per unit': 'pricePerUnit',
+        'price_per_unit': 'pricePerUnit',
+        'date': 'saleDate',
+        'sale_date': 'saleDate',
+        'status': 'saleStatus',
+    },
+    'expenses': {
+        'expense name': 'expenseName',
+        'name': 'expenseName',
+        'amount (thb)': 'expenseAmount',
+        'amount': 'expenseAmount',
+        'date': 'expenseDate',
+        'status': 'expenseStatus',
+    },
+}
+
+DATE_FIELDS = {
+    'sales': 'sale_date',
+    'expenses': 'date',
+}
+
+# Retries when a concurrent import created some of a batch's rows first
+MAX_COMMIT_ATTEMPTS = 3
+
+_Row = namedtuple('_Row', ['line', 'key', 'doc_id', 'data'])
+
+
+def sale_document(form):
+    """The sales document for a validated SalesForm, as the /sales route writes it."""
+    return search.indexed('sales', {
+        'customer_name': form.customerName.data,
+        'quantity': int(form.quantity.data),
+        'price_per_unit': float(form.pricePerUnit.data),
+        'sale_date': form.saleDate.data.strftime('%Y-%m-%d'),
+        'sale_amount': float(form.quantity.data) * float(form.pricePerUnit.data),
+        'status': form.saleStatus.data,
+    })
+
+
+def expense_document(form):
+    """The expenses document for a validated ExpensesForm, as the /expenses route writes it."""
+    return {
+        'name': form.expenseName.data,
+        'amount': float(form.expenseAmount.data),
+        'date': form.expenseDate.data.strftime('%Y-%m-%d'),
+        'status': form.expenseStatus.data,
+    }
+
+
+DOCUMENT_BUILDERS = {
+    'sales': sale_document,
+    'expenses': expense_document,
+}
+
+
+def document_id(row_key):
+    return 'import_' + hashlib.sha256(row_key.encode('utf-8')).hexdigest()[:32]
+
+
+def format_errors(errors):
+    """'Column: message; ...' for the errors of an error event."""
+    return '; '.join(f"{column}: {message}" for column, messages in errors.items() for message in messages)
+
+
+def _header_map(collection, fieldnames):
+    """Map the file's headers to form fields; returns (header -> field, key header or None)."""
+    if not fieldnames:
+        raise ValueError('The CSV file is empty')
+    columns, key_column = {}, None
+    for header in fieldnames:
+        name = (header or '').strip().lower()
+        field = COLUMNS[collection].get(name)
+        if field and field not in columns.values():
+            columns[header] = field
+        elif name in KEY_COLUMNS and key_column is None:
+            key_column = header
+    missing = []
+    for field in dict.fromkeys(COLUMNS[collection].values()):
+        if field not in columns.values():
+            missing.append(' or '.join(repr(h) for h, f in COLUMNS[collection].items() if f == field))
+    if missing:
+        raise ValueError(f"The CSV file is missing columns: {', '.join(missing)}")
+    return columns, key_column
+
+
+def run(db, collection, lines, form_class, dry_run=False, batch_limit=rollups.BATCH_LIMIT):
+    """Import CSV `lines` (an iterable of text lines) into `collection`.
+
+    Raises ValueError at once if the header lacks a required column;
+    otherwise returns a generator of events, dicts with an 'event' key:
+
+      error     one invalid row: line, row_key and {column: [messages]}
+      progress  after every committed batch: processed/imported/skipped/failed
+      done      the final counts
+
+    With dry_run=True rows are validated and checked for existing keys but
+    nothing is written.
+    """
+    reader = csv.DictReader(lines)
+    columns, key_column = _header_map(collection, reader.fieldnames)
+    return _events(db, collection, reader, columns, key_column, form_class, dry_run, batch_limit)
+
+
+def _events(db, collection, reader, columns, key_column, form_class, dry_run, batch_limit):
+    headers = {field: header for header, field in columns.items()}
+    build = DOCUMENT_BUILDERS[collection]
+    date_field = DATE_FIELDS[collection]
+    counts = {'processed': 0, 'imported': 0, 'skipped': 0, 'failed': 0}
+    seen_keys = {}
+    pending, touched = [], set()
+
+    def flush():
+        written, skipped = _commit(db, collection, pending, dry_run)
+        counts['imported'] += written
+        counts['skipped'] += skipped
+        pending.clear()
+        touched.clear()
+        return dict(counts, event='progress')
+
+    for row in reader:
+        line = reader.line_num
+        counts['processed'] += 1
+        key = (row.get(key_column) or '').strip() if key_column else ''
+        form = form_class(formdata=MultiDict({field: (row.get(header) or '').strip()
+                                              for header, field in columns.items()}),
+                          meta={'csrf': False})
+        errors = None
+        if not form.validate():
+            errors = {headers[field]: messages for field, messages in form.errors.items()}
+        elif key in seen_keys:
+            errors = {key_column: [f'Duplicate row key, first used on line {seen_keys[key]}']}
+        if errors:
+            counts['failed'] += 1
+            yield {'event': 'error', 'line': line, 'row_key': key or None, 'errors': errors}
+            continue
+        if key:
+            seen_keys[key] = line
+            data = dict(build(form), import_key=key)
+        else:
+            data = build(form)
+
+        # One write per row, one per distinct rollup or customer document in the batch and the version bump
+        doc_ids = rollups.rollup_doc_ids(data[date_field]) + receivables.customer_doc_ids(collection, data)
+        if pending and len(pending) + 2 + len(touched.union(doc_ids)) > batch_limit:
+            yield flush()
+        pending.append(_Row(line, key, document_id(key) if key else None, data))
+        touched.update(doc_ids)
+
+    if pending:
+        yield flush()
+    yield dict(counts, event='done', dry_run=dry_run)
+
+
+def _commit(db, collection, rows, dry_run):
+    """Write rows and their rollup increments in one batch; returns (written, skipped)."""
+    target = db.collection(collection)
+    for attempt in range(MAX_COMMIT_ATTEMPTS):
+        keyed = [target.document(row.doc_id) for row in rows if row.doc_id]
+        existing = {snapshot.id for snapshot in db.get_all(keyed) if snapshot.exists} if keyed else set()
+        fresh = [row for row in rows if row.doc_id not in existing]
+        if dry_run or not fresh:
+            return len(fresh), len(rows) - len(fresh)
+
+        batch = db.batch()
+        for row in fresh:
+            if row.doc_id:
+                batch.create(target.document(row.doc_id), row.data)
+            else:
+                batch.set(target.document(), row.data)
+        rollups.record_many(batch, db, collection, [row.data for row in fresh])
+        rollups.bump_version(batch, db, collection)
+        try:
+            batch.commit()
+        except exceptions.AlreadyExists:
+            if attempt == MAX_COMMIT_ATTEMPTS - 1:
+                raise
+            continue
+        return len(fresh), len(rows) - len(fresh)
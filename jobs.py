@@ -0,0 +1,325 @@
+# jobs.py
+#
+# Background jobs for work too slow for a request: the profit-and-loss
+# reports of reports.py. A job is a row in a SQLite database on local disk,
+# shared by the processes of a host like the shared read cache
+# (shared_cache.py), and goes queued -> running -> done | failed. The file
+# it produces is stored on the row until it expires.
+#
+# A job is keyed by tenant, report, period, format and the tenant's ledger
+# versions (rollups.read_versions) when it is submitted. Submitting the same
+# report again returns the same job: still queued or running, or done, in
+# which case the file is served at once. Any sale or expense write bumps the
+# versions, so the next request for the period makes a new job.
+#
+# Who runs the jobs:
+#   - Under gunicorn, JOBS_PROCESSES runner processes (default 1) forked by
+#     the master (gunicorn.conf.py), so report generation does not compete
+#     with requests for a worker's threads and GIL.
+#   - When no runner process has checked in for RUNNER_STALE_SECONDS (the
+#     development server, JOBS_PROCESSES=0, a runner that died), each web
+#     process that queues or polls a job runs one job thread itself.
+#   - `flask --app app run-jobs` runs one in the foreground.
+# On the memory backend every process has its own data, so jobs are kept
+# per process and always run on that process's job thread.
+#
+# A runner holds a lease on the job it runs and renews it while it works; a
+# job whose lease ran out (its runner was killed) is picked up again, at
+# most MAX_ATTEMPTS times. Finished jobs are deleted after JOBS_RESULT_TTL
+# seconds, and the least recently downloaded first past JOBS_MAX_MB.
+
+import hashlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+import metrics
+import reports
+import shared_cache
+
+logger = logging.getLogger(__name__)
+
+PROCESSES = int(os.getenv('JOBS_PROCESSES', 1))
+LEASE_SECONDS = float(os.getenv('JOBS_LEASE_SECONDS', 60))
+RESULT_TTL = float(os.getenv('JOBS_RESULT_TTL', 7 * 24 * 3600))
+MAX_BYTES = int(float(os.getenv('JOBS_MAX_MB', 256)) * 1024 * 1024)
+
+MAX_ATTEMPTS = 3
+# How often an idle runner looks for a queued job
+POLL_SECONDS = 0.5
+# A runner process that has not checked in for this long is taken for dead
+RUNNER_STALE_SECONDS = 30
+# How often a runner records that it is alive
+HEARTBEAT_SECONDS = 5
+
+STATUSES = ('queued', 'running', 'done', 'failed')
+
+REPORT_JOBS = metrics.REGISTRY.register(metrics.Counter(
+    'report_jobs_total', 'Report requests, by report and result (cached, joined, queued).', ['kind', 'result']))
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY, key TEXT NOT NULL UNIQUE, namespace TEXT NOT NULL, tenant TEXT NOT NULL,
+    kind TEXT NOT NULL, period TEXT NOT NULL, format TEXT NOT NULL, versions TEXT NOT NULL,
+    status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, owner TEXT, lease REAL,
+    error TEXT, result BLOB, size INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL, started REAL, finished REAL, accessed REAL);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (namespace, status, created);
+CREATE INDEX IF NOT EXISTS jobs_tenant ON jobs (tenant, created);
+CREATE TABLE IF NOT EXISTS runners (owner TEXT PRIMARY KEY, seen REAL NOT NULL);
+'''
+
+# The columns of a job as the status endpoint shows it
+_COLUMNS = ('id', 'tenant', 'kind', 'period', 'format', 'status', 'attempts', 'error', 'size',
+            'created', 'started', 'finished')
+
+
+def default_path():
+    """The job database, next to the shared cache's in the per-user temp directory."""
+    return os.path.join(os.path.dirname(shared_cache.default_path()), 'jobs.sqlite3')
+
+
+class JobQueue:
+    """Report jobs in a SQLite file shared by the processes of a host."""
+
+    def __init__(self, path, per_process=False, lease_seconds=LEASE_SECONDS, result_ttl=RESULT_TTL,
+                 max_bytes=MAX_BYTES):
+        shared_cache.private_directory(path)
+        self.path = path
+        # Keep each process's jobs apart, for data that is not shared either
+        self.per_process = per_process
+        self.lease_seconds = lease_seconds
+        self.result_ttl = result_ttl
+        self.max_bytes = max_bytes
+        self._connections = threading.local()
+        self._lock = threading.Lock()
+        # (pid, thread) of this process's job thread, if it started one
+        self._thread = (None, None)
+        # Set by submit, so a runner in this process need not wait for its next poll
+        self.submitted = threading.Event()
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self):
+        """This thread's connection; a new one after a fork."""
+        local = self._connections
+        if getattr(local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.row_factory = sqlite3.Row
+            local.db, local.pid = db, os.getpid()
+        return local.db
+
+    def namespace(self):
+        return str(os.getpid()) if self.per_process else ''
+
+    # -- submitting and reading --
+    def submit(self, tenant_id, kind, period, fmt, versions):
+        """The job producing this report at these ledger `versions`, queued unless one exists.
+
+        A failed job is queued again. Returns the job as job() does.
+        """
+        reports.parse_period(kind, period)
+        if fmt not in reports.FORMATS:
+            raise ValueError(f"Format must be one of {', '.join(reports.FORMATS)}")
+        versions = json.dumps(versions, sort_keys=True)
+        key = hashlib.sha256(json.dumps([self.namespace(), tenant_id, kind, period, fmt, versions])
+                             .encode('utf-8')).hexdigest()
+        now = time.time()
+        db = self._connection()
+        inserted = db.execute(
+            'INSERT OR IGNORE INTO jobs (id, key, namespace, tenant, kind, period, format, versions, status, created) '
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'queued', ?)",
+            (uuid.uuid4().hex, key, self.namespace(), tenant_id, kind, period, fmt, versions, now)).rowcount
+        if not inserted:
+            db.execute("UPDATE jobs SET status = 'queued', attempts = 0, error = NULL, owner = NULL, lease = NULL, "
+                       "created = ?, started = NULL, finished = NULL WHERE key = ? AND status = 'failed'", (now, key))
+        job = self._row('key', key)
+        if job['status'] == 'queued':
+            self.submitted.set()
+        REPORT_JOBS.inc((kind, 'queued' if inserted else 'cached' if job['status'] == 'done' else 'joined'))
+        return job
+
+    def _row(self, column, value):
+        row = self._connection().execute(
+            f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE {column} = ?", (value,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def job(self, job_id, tenant_id):
+        """The job's state (no result), or None when it does not exist or belongs to another tenant."""
+        job = self._row('id', job_id)
+        return job if job is not None and job['tenant'] == tenant_id else None
+
+    def result(self, job_id, tenant_id):
+        """(job, file bytes) of a done job of the tenant, or (job, None) while it has none."""
+        db = self._connection()
+        row = db.execute('SELECT tenant, status, result FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None or row['tenant'] != tenant_id:
+            return None, None
+        if row['status'] != 'done':
+            return self._row('id', job_id), None
+        db.execute('UPDATE jobs SET accessed = ? WHERE id = ?', (time.time(), job_id))
+        return self._row('id', job_id), row['result']
+
+    def recent(self, tenant_id, limit=10):
+        """The tenant's latest jobs of this namespace, newest first."""
+        rows = self._connection().execute(
+            f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE tenant = ? AND namespace = ? "
+            'ORDER BY created DESC LIMIT ?', (tenant_id, self.namespace(), limit))
+        return [dict(row) for row in rows]
+
+    # -- running --
+    def claim(self, owner):
+        """Take the oldest queued job, or one whose runner's lease ran out; None when there is none."""
+        now = time.time()
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            while True:
+                row = db.execute(
+                    "SELECT id, attempts FROM jobs WHERE namespace = ? AND (status = 'queued' OR "
+                    "(status = 'running' AND lease <= ?)) ORDER BY created LIMIT 1",
+                    (self.namespace(), now)).fetchone()
+                if row is None or row['attempts'] < MAX_ATTEMPTS:
+                    break
+                db.execute("UPDATE jobs SET status = 'failed', error = ?, finished = ?, owner = NULL, lease = NULL "
+                           'WHERE id = ?', (f'Stopped {MAX_ATTEMPTS} times before finishing', now, row['id']))
+            if row is not None:
+                db.execute("UPDATE jobs SET status = 'running', owner = ?, lease = ?, started = ?, "
+                           'attempts = attempts + 1 WHERE id = ?', (owner, now + self.lease_seconds, now, row['id']))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return self._row('id', row['id']) if row is not None else None
+
+    def renew(self, job_id, owner):
+        """Extend the lease on a running job; False when the runner lost it."""
+        return bool(self._connection().execute(
+            "UPDATE jobs SET lease = ? WHERE id = ? AND owner = ? AND status = 'running'",
+            (time.time() + self.lease_seconds, job_id, owner)).rowcount)
+
+    def complete(self, job_id, owner, result):
+        now = time.time()
+        db = self._connection()
+        db.execute("UPDATE jobs SET status = 'done', result = ?, size = ?, finished = ?, accessed = ?, "
+                   "owner = NULL, lease = NULL WHERE id = ? AND owner = ? AND status = 'running'",
+                   (result, len(result), now, now, job_id, owner))
+        self._evict(db, now)
+
+    def fail(self, job_id, owner, error):
+        self._connection().execute(
+            "UPDATE jobs SET status = 'failed', error = ?, finished = ?, owner = NULL, lease = NULL "
+            "WHERE id = ? AND owner = ? AND status = 'running'", (error, time.time(), job_id, owner))
+
+    def _evict(self, db, now):
+        db.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished <= ?", (now - self.result_ttl,))
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM jobs WHERE status = 'done'").fetchone()[0]
+        while total > self.max_bytes:
+            oldest = db.execute("SELECT id, size FROM jobs WHERE status = 'done' ORDER BY accessed LIMIT 8").fetchall()
+            if not oldest:
+                break
+            db.executemany('DELETE FROM jobs WHERE id = ?', [(row['id'],) for row in oldest])
+            total -= sum(row['size'] for row in oldest)
+
+    # -- runners --
+    def check_in(self, owner):
+        """Record that a runner process is alive."""
+        self._connection().execute('INSERT OR REPLACE INTO runners (owner, seen) VALUES (?, ?)', (owner, time.time()))
+
+    def check_out(self, owner):
+        self._connection().execute('DELETE FROM runners WHERE owner = ?', (owner,))
+
+    def runners_alive(self):
+        """Whether a runner process has checked in within RUNNER_STALE_SECONDS."""
+        now = time.time()
+        db = self._connection()
+        db.execute('DELETE FROM runners WHERE seen <= ?', (now - 10 * RUNNER_STALE_SECONDS,))
+        return db.execute('SELECT 1 FROM runners WHERE seen > ? LIMIT 1', (now - RUNNER_STALE_SECONDS,)).fetchone() \
+            is not None
+
+    def ensure_running(self, store):
+        """Start this process's job thread when jobs would otherwise wait for a runner that is not there."""
+        pid, thread = self._thread
+        if pid == os.getpid() and thread.is_alive():
+            return
+        if not self.per_process and self.runners_alive():
+            return
+        with self._lock:
+            pid, thread = self._thread
+            if pid == os.getpid() and thread.is_alive():
+                return
+            thread = threading.Thread(target=work, args=(self, store, threading.Event()), kwargs={'process': False},
+                                      name='report-jobs', daemon=True)
+            self._thread = (os.getpid(), thread)
+            thread.start()
+
+
+def _run(queue, store, job, owner):
+    """Generate one claimed job's report, renewing its lease until it is done."""
+    done = threading.Event()
+
+    def renew():
+        while not done.wait(queue.lease_seconds / 3):
+            if not queue.renew(job['id'], owner):
+                logger.warning(f"Lost the lease on report job {job['id']}")
+                return
+
+    renewer = threading.Thread(target=renew, name='report-job-lease', daemon=True)
+    renewer.start()
+    started = time.perf_counter()
+    try:
+        tenant = store.tenant(job['tenant'])
+        result = reports.generate(tenant.db, job['kind'], job['period'], job['format'])
+    except Exception as e:
+        logger.error(f"Report job {job['id']} ({job['kind']} {job['period']} for {job['tenant']}) failed: {str(e)}")
+        queue.fail(job['id'], owner, str(e) or type(e).__name__)
+        return
+    finally:
+        done.set()
+        renewer.join()
+    queue.complete(job['id'], owner, result)
+    logger.info(f"Report job {job['id']} ({job['kind']} {job['period']} {job['format']} for {job['tenant']}) "
+                f"done in {(time.perf_counter() - started) * 1000:.0f}ms, {len(result)} bytes")
+
+
+def work(queue, store, stop, process=True):
+    """Run queued jobs until `stop` is set. A runner process (`process`) checks in as one."""
+    owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+    checked_in = 0.0
+    logger.info(f"Report job runner {owner} started")
+    try:
+        while not stop.is_set():
+            try:
+                if process and time.monotonic() - checked_in >= HEARTBEAT_SECONDS:
+                    queue.check_in(owner)
+                    checked_in = time.monotonic()
+                job = queue.claim(owner)
+            except sqlite3.Error as e:
+                logger.error(f"Report job queue unavailable: {str(e)}")
+                stop.wait(RUNNER_STALE_SECONDS / 3)
+                continue
+            if job is None:
+                queue.submitted.wait(POLL_SECONDS)
+                queue.submitted.clear()
+                continue
+            _run(queue, store, job, owner)
+    finally:
+        if process:
+            queue.check_out(owner)
+        logger.info(f"Report job runner {owner} stopped")
+
+
+def from_env(backend):
+    """The JobQueue at JOBS_PATH (default: next to the shared cache), or None when it cannot be opened."""
+    path = os.getenv('JOBS_PATH') or default_path()
+    try:
+        return JobQueue(path, per_process=backend == 'memory')
+    except (OSError, ValueError, sqlite3.Error) as e:
+        logger.error(f"Report jobs disabled: {str(e)}")
+        return None
@@ -0,0 +1,996 @@
+# memory_firestore.py
+#
+# In-process stand-in for the subset of the google-cloud-firestore client API
+# this app uses: collections and subcollections, add/set/update/delete with
+# write options, where/order_by/cursor/limit/select queries, count(), write
+# batches, transactions (compatible with firestore.transactional) and the
+# Increment, ArrayUnion/ArrayRemove, SERVER_TIMESTAMP and DELETE_FIELD
+# transforms.
+#
+# Each collection keeps sorted views per order_by shape, maintained on write,
+# so ordered, ranged and paged queries cost roughly what they would against
+# Firestore: proportional to the rows returned, not the collection size.
+# Meant for local development, benchmarks and tests, not production.
+#
+# `latency` (seconds) is slept at the start of every RPC, outside any lock,
+# to stand in for the network round trip a real client pays. A `Faults`
+# makes RPCs fail or stall at given rates, for exercising retries, deadlines
+# and the circuit breaker (resilience.py). An RPC given a `timeout` shorter
+# than its round trip raises DeadlineExceeded once the timeout has passed,
+# like a gRPC deadline.
+#
+# on_snapshot() listeners get the same callback(docs, changes, read_time)
+# calls as with the real client: a full snapshot first, then one call per
+# commit that changed a matching document, on the listener's own thread and
+# in commit order, `latency` after the commit. drop_listeners() ends every
+# listener the way a broken stream would, for exercising resync paths.
+
+import bisect
+import copy
+import datetime
+import enum
+import functools
+import itertools
+import logging
+import queue
+import random
+import secrets
+import string
+import threading
+import time
+
+from google.api_core import exceptions
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+logger = logging.getLogger(__name__)
+
+ASCENDING = 'ASCENDING'
+DESCENDING = 'DESCENDING'
+
+_ID_ALPHABET = string.ascii_letters + string.digits
+_RANGE_OPS = ('<', '<=', '>', '>=', '!=', 'not-in')
+
+
+def _auto_id():
+    return ''.join(secrets.choice(_ID_ALPHABET) for _ in range(20))
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _get_path(data, field_path):
+    value = data
+    for part in field_path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            raise KeyError(field_path)
+        value = value[part]
+    return value
+
+
+def _set_path(data, field_path, value):
+    parts = field_path.split('.')
+    for part in parts[:-1]:
+        data = data.setdefault(part, {})
+    data[parts[-1]] = value
+
+
+def _delete_path(data, field_path):
+    parts = field_path.split('.')
+    for part in parts[:-1]:
+        data = data.get(part)
+        if not isinstance(data, dict):
+            return
+    data.pop(parts[-1], None)
+
+
+class _Max:
+    """Compares greater than any sort key; used to build exclusive bisect bounds."""
+
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+    def __eq__(self, other):
+        return isinstance(other, _Max)
+
+    __hash__ = object.__hash__
+
+
+_MAX = _Max()
+
+
+# Firestore orders values of different types by type first
+def _sort_key(value):
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return (3, value.timestamp())
+    if isinstance(value, str):
+        return (4, value)
+    if isinstance(value, bytes):
+        return (5, value)
+    if isinstance(value, DocumentReference):
+        return (6, value.path)
+    if isinstance(value, list):
+        return (8, tuple(_sort_key(v) for v in value))
+    if isinstance(value, dict):
+        return (9, tuple(sorted((k, _sort_key(v)) for k, v in value.items())))
+    return (10, repr(value))
+
+
+def _flatten(data, merge, prefix=''):
+    """Yield (field_path, value); with merge, nested dicts are merged field by field."""
+    for key, value in data.items():
+        path = f'{prefix}{key}'
+        if merge and isinstance(value, dict) and value:
+            yield from _flatten(value, merge, f'{path}.')
+        else:
+            yield path, value
+
+
+def _apply_write(current, data, merge, timestamp):
+    """Return the new document body after writing data on top of current."""
+    result = copy.deepcopy(current) if (merge and current is not None) else {}
+    for key, value in _flatten(data, merge):
+        if value is transforms.DELETE_FIELD:
+            _delete_path(result, key)
+        elif value is transforms.SERVER_TIMESTAMP:
+            _set_path(result, key, timestamp)
+        elif isinstance(value, transforms.Increment):
+            try:
+                base = _get_path(result, key)
+            except KeyError:
+                base = 0
+            if not isinstance(base, (int, float)) or isinstance(base, bool):
+                base = 0
+            _set_path(result, key, base + value.value)
+        elif isinstance(value, transforms.ArrayUnion):
+            try:
+                base = list(_get_path(result, key))
+            except (KeyError, TypeError):
+                base = []
+            base.extend(v for v in value.values if v not in base)
+            _set_path(result, key, base)
+        elif isinstance(value, transforms.ArrayRemove):
+            try:
+                base = list(_get_path(result, key))
+            except (KeyError, TypeError):
+                base = []
+            _set_path(result, key, [v for v in base if v not in value.values])
+        else:
+            _set_path(result, key, copy.deepcopy(value))
+    return result
+
+
+class _Stored:
+    """One stored document version. Never mutated once committed."""
+
+    __slots__ = ('data', 'create_time', 'update_time')
+
+    def __init__(self, data, create_time, update_time):
+        self.data = data
+        self.create_time = create_time
+        self.update_time = update_time
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data, create_time=None, update_time=None, read_time=None):
+        self.reference = reference
+        self._data = data
+        self.create_time = create_time
+        self.update_time = update_time
+        self.read_time = read_time
+
+    @property
+    def id(self):
+        return self.reference.id
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        if self._data is None:
+            return None
+        return copy.deepcopy(_get_path(self._data, field_path))
+
+
+class DocumentReference:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+
+    @property
+    def id(self):
+        return self.path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self):
+        return CollectionReference(self._client, self.path.rsplit('/', 1)[0])
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __repr__(self):
+        return f'<DocumentReference {self.path}>'
+
+    def collection(self, collection_id):
+        return CollectionReference(self._client, f'{self.path}/{collection_id}')
+
+    def collections(self):
+        return self._client._child_collections(self.path)
+
+    def get(self, field_paths=None, transaction=None, **kwargs):
+        return self._client._snapshot(self, field_paths)
+
+    def create(self, document_data):
+        return self._client._commit([('create', self, document_data, None)])[0]
+
+    def set(self, document_data, merge=False):
+        return self._client._commit([('set', self, document_data, merge)])[0]
+
+    def update(self, field_updates, option=None):
+        return self._client._commit([('update', self, field_updates, option)])[0]
+
+    def delete(self, option=None):
+        return self._client._commit([('delete', self, None, option)])[0]
+
+
+class Query:
+    ASCENDING = ASCENDING
+    DESCENDING = DESCENDING
+
+    def __init__(self, parent, filters=(), orders=(), limit=None, offset=None,
+                 start=None, end=None, projection=None):
+        self._parent = parent
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._offset = offset
+        # (cursor, inclusive) pairs
+        self._start = start
+        self._end = end
+        self._projection = projection
+
+    def _copy(self, **changes):
+        state = {
+            'filters': self._filters, 'orders': self._orders, 'limit': self._limit,
+            'offset': self._offset, 'start': self._start, 'end': self._end,
+            'projection': self._projection,
+        }
+        state.update(changes)
+        return Query(self._parent, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, *, filter=None):
+        if filter is None:
+            filter = FieldFilter(field_path, op_string, value)
+        return self._copy(filters=self._filters + (filter,))
+
+    def order_by(self, field_path, direction=ASCENDING):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def offset(self, num_to_skip):
+        return self._copy(offset=num_to_skip)
+
+    def select(self, field_paths):
+        return self._copy(projection=tuple(field_paths))
+
+    def start_at(self, document_fields_or_snapshot):
+        return self._copy(start=(document_fields_or_snapshot, True))
+
+    def start_after(self, document_fields_or_snapshot):
+        return self._copy(start=(document_fields_or_snapshot, False))
+
+    def end_at(self, document_fields_or_snapshot):
+        return self._copy(end=(document_fields_or_snapshot, True))
+
+    def end_before(self, document_fields_or_snapshot):
+        return self._copy(end=(document_fields_or_snapshot, False))
+
+    def stream(self, transaction=None, **kwargs):
+        return self._parent._client._run_query(self)
+
+    def get(self, transaction=None, **kwargs):
+        return list(self.stream(transaction=transaction))
+
+    def count(self, alias=None):
+        return _CountQuery(self, alias)
+
+    def on_snapshot(self, callback):
+        return Watch(self._parent._client, self, callback)
+
+
+class _CountResult:
+    def __init__(self, alias, value):
+        self.alias = alias
+        self.value = value
+
+
+class _CountQuery:
+    def __init__(self, query, alias):
+        self._query = query
+        self._alias = alias or 'count'
+
+    def get(self, transaction=None, **kwargs):
+        count = sum(1 for _ in self._query.select([]).stream())
+        return [[_CountResult(self._alias, count)]]
+
+
+class CollectionReference(Query):
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        super().__init__(self)
+
+    @property
+    def id(self):
+        return self.path.rsplit('/', 1)[-1]
+
+    def document(self, document_id=None):
+        return DocumentReference(self._client, f'{self.path}/{document_id or _auto_id()}')
+
+    def add(self, document_data, document_id=None):
+        ref = self.document(document_id)
+        result = ref.create(document_data)
+        return result.update_time, ref
+
+    def list_documents(self, page_size=None):
+        with self._client._lock:
+            ids = list(self._client._collections.get(self.path, {}))
+        return [self.document(doc_id) for doc_id in ids]
+
+
+class ChangeType(enum.Enum):
+    ADDED = 1
+    REMOVED = 2
+    MODIFIED = 3
+
+
+class DocumentChange:
+    def __init__(self, type, document, old_index, new_index):
+        # Indexes are not tracked here and are always -1
+        self.type = type
+        self.document = document
+        self.old_index = old_index
+        self.new_index = new_index
+
+
+class Watch:
+    """A snapshot listener; see the module docstring."""
+
+    def __init__(self, client, query, callback):
+        self._client = client
+        self._query = query
+        self._callback = callback
+        self._queue = queue.Queue()
+        self._active = True
+        self._thread = threading.Thread(target=self._run, name=f'watch-{query._parent.id}', daemon=True)
+        with client._lock:
+            client._watches.append(self)
+            state = client._watch_state(self)
+            changes = [(ChangeType.ADDED, doc_id, stored) for doc_id, stored in state]
+            self._queue.put((state, changes, client._timestamp()))
+        self._thread.start()
+
+    @property
+    def is_active(self):
+        return self._active
+
+    def unsubscribe(self):
+        self.close()
+
+    def close(self, reason=None):
+        with self._client._lock:
+            if not self._active:
+                return
+            self._active = False
+            self._client._watches.remove(self)
+        self._queue.put(None)
+        if reason:
+            logger.info(f"Listener on {self._query._parent.path} closed: {reason}")
+
+    def _matches(self, stored):
+        return stored is not None and all(self._client._matches(stored.data, flt) for flt in self._query._filters)
+
+    def _run(self):
+        path = self._query._parent.path
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            # Delivery lag only; faults are for RPCs
+            if self._client.latency:
+                time.sleep(self._client.latency)
+            if not self._active:
+                return
+            state, changes, read_time = item
+
+            def snapshot(doc_id, stored):
+                # Stored bodies are never mutated and to_dict() copies, so they can be shared
+                ref = DocumentReference(self._client, f'{path}/{doc_id}')
+                return DocumentSnapshot(ref, stored.data, stored.create_time, stored.update_time, read_time)
+
+            docs = [snapshot(doc_id, stored) for doc_id, stored in sorted(state, key=lambda entry: entry[0])]
+            changes = [DocumentChange(kind, snapshot(doc_id, stored), -1, -1) for kind, doc_id, stored in changes]
+            try:
+                self._callback(docs, changes, read_time)
+            except Exception as e:
+                # The real client's stream dies with its callback, too
+                logger.exception(f"Snapshot callback on {path} failed")
+                self.close(reason=e)
+                return
+
+
+class WriteResult:
+    def __init__(self, update_time):
+        self.update_time = update_time
+
+
+class WriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def create(self, reference, document_data):
+        self._writes.append(('create', reference, document_data, None))
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(('set', reference, document_data, merge))
+
+    def update(self, reference, field_updates, option=None):
+        self._writes.append(('update', reference, field_updates, option))
+
+    def delete(self, reference, option=None):
+        self._writes.append(('delete', reference, None, option))
+
+    def __len__(self):
+        return len(self._writes)
+
+    def commit(self, **kwargs):
+        writes, self._writes = self._writes, []
+        return self._client._commit(writes)
+
+
+class Transaction(WriteBatch):
+    """Serializable transaction: holds the client lock from _begin to commit/rollback.
+
+    Implements the private hooks firestore.transactional relies on.
+    """
+
+    def __init__(self, client, max_attempts=5, read_only=False):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._read_only = read_only
+        self._id = None
+
+    @property
+    def in_progress(self):
+        return self._id is not None
+
+    @property
+    def id(self):
+        return self._id
+
+    def _clean_up(self):
+        self._writes = []
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._client._lock.acquire()
+        self._id = _auto_id().encode('ascii')
+
+    def _commit(self):
+        try:
+            return self._client._commit(self._writes)
+        finally:
+            self._release()
+
+    def _rollback(self):
+        self._release()
+
+    def _release(self):
+        if self._id is not None:
+            self._clean_up()
+            self._client._lock.release()
+
+    def get(self, ref_or_query, **kwargs):
+        if isinstance(ref_or_query, DocumentReference):
+            return iter([ref_or_query.get()])
+        return ref_or_query.stream()
+
+
+class _SortedView:
+    """Documents of one collection sorted ascending by a tuple of fields."""
+
+    __slots__ = ('keys', 'entries')
+
+    def __init__(self, keys, entries):
+        self.keys = keys
+        self.entries = entries
+
+
+class Faults:
+    """Injected RPC failures: each RPC fails with ServiceUnavailable at `error_rate`,
+    and takes `slow_seconds` longer at `slow_rate`. The rates may be changed while in use.
+    """
+
+    def __init__(self, error_rate=0.0, slow_rate=0.0, slow_seconds=0.0, seed=None):
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_seconds = slow_seconds
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def draw(self):
+        """(extra seconds, fail) for one RPC."""
+        with self._lock:
+            slow = self._random.random() < self.slow_rate
+            fail = self._random.random() < self.error_rate
+        return (self.slow_seconds if slow else 0.0), fail
+
+
+class Client:
+    """In-memory Firestore client. Thread-safe; every commit is atomic."""
+
+    def __init__(self, latency=0.0, faults=None):
+        self._collections = {}
+        self._views = {}
+        self._lock = threading.RLock()
+        self._clock = itertools.count(1)
+        self.latency = latency
+        # A Faults, or None
+        self.faults = faults
+        self._watches = []
+        self.rpc_count = 0
+        self.documents_read = 0
+
+    # -- public API --
+    def collection(self, *path):
+        return CollectionReference(self, '/'.join(path))
+
+    def document(self, *path):
+        return DocumentReference(self, '/'.join(path))
+
+    def collections(self):
+        return self._child_collections('')
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def transaction(self, max_attempts=5, read_only=False):
+        return Transaction(self, max_attempts=max_attempts, read_only=read_only)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        return self._batch_get(list(references), field_paths)
+
+    @staticmethod
+    def write_option(**kwargs):
+        from google.cloud.firestore_v1.client import Client as FirestoreClient
+        return FirestoreClient.write_option(**kwargs)
+
+    def close(self):
+        pass
+
+    def drop_listeners(self, reason='stream dropped'):
+        """End every on_snapshot listener, as a broken stream would."""
+        for watch in list(self._watches):
+            watch.close(reason=reason)
+
+    def load(self, collection_path, documents):
+        """Bulk-insert {doc_id: data} without per-document commits (for seeding)."""
+        with self._lock:
+            timestamp = self._timestamp()
+            docs = self._collections.setdefault(collection_path, {})
+            written = []
+            for doc_id, data in documents.items():
+                stored = _Stored(copy.deepcopy(data), timestamp, timestamp)
+                written.append((f'{collection_path}/{doc_id}', docs.get(doc_id), stored))
+                docs[doc_id] = stored
+            self._drop_views(collection_path)
+            self._notify(written, timestamp)
+
+    # -- internals --
+    def _timestamp(self):
+        # Strictly increasing, so last_update_time preconditions behave
+        return _now().replace(microsecond=0) + datetime.timedelta(microseconds=next(self._clock) % 1000000)
+
+    @staticmethod
+    def _split(path):
+        collection_path, _, doc_id = path.rpartition('/')
+        return collection_path, doc_id
+
+    def _stored(self, path):
+        collection_path, doc_id = self._split(path)
+        return self._collections.get(collection_path, {}).get(doc_id)
+
+    @staticmethod
+    def _project(data, field_paths):
+        if field_paths is None:
+            return data
+        projected = {}
+        for field_path in field_paths:
+            try:
+                _set_path(projected, field_path, _get_path(data, field_path))
+            except KeyError:
+                continue
+        return projected
+
+    def _round_trip(self, timeout=None):
+        delay, fail = self.latency, False
+        if self.faults is not None:
+            extra, fail = self.faults.draw()
+            delay += extra
+        if timeout is not None and delay > timeout:
+            time.sleep(max(timeout, 0))
+            raise exceptions.DeadlineExceeded('Deadline Exceeded')
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise exceptions.ServiceUnavailable('Injected fault')
+
+    def _snapshot(self, ref, field_paths=None, timeout=None):
+        self._round_trip(timeout)
+        with self._lock:
+            self.rpc_count += 1
+            stored = self._stored(ref.path)
+        return self._read(ref, stored, field_paths)
+
+    def _batch_get(self, refs, field_paths=None, timeout=None):
+        # One round trip for every reference, like BatchGetDocuments
+        self._round_trip(timeout)
+        with self._lock:
+            self.rpc_count += 1
+            stored = [self._stored(ref.path) for ref in refs]
+        return [self._read(ref, entry, field_paths) for ref, entry in zip(refs, stored)]
+
+    def _read(self, ref, stored, field_paths):
+        if stored is None:
+            return DocumentSnapshot(ref, None, read_time=_now())
+        self.documents_read += 1
+        data = copy.deepcopy(self._project(stored.data, field_paths))
+        return DocumentSnapshot(ref, data, stored.create_time, stored.update_time, _now())
+
+    def _child_collections(self, doc_path):
+        prefix = doc_path + '/' if doc_path else ''
+        names = set()
+        with self._lock:
+            for collection_path, docs in self._collections.items():
+                if not docs or not collection_path.startswith(prefix):
+                    continue
+                rest = collection_path[len(prefix):]
+                if not doc_path:
+                    names.add(rest.split('/', 1)[0])
+                elif '/' not in rest:
+                    names.add(rest)
+        return [CollectionReference(self, prefix + name) for name in sorted(names)]
+
+    @staticmethod
+    def _check_option(stored, option):
+        if option is None:
+            return
+        exists = getattr(option, '_exists', None)
+        # Same errors Firestore returns for a failed exists precondition
+        if exists is not None and bool(exists) and stored is None:
+            raise exceptions.NotFound('Document does not exist')
+        if exists is not None and not bool(exists) and stored is not None:
+            raise exceptions.AlreadyExists('Document already exists')
+        last_update = getattr(option, '_last_update_time', None)
+        if last_update is not None:
+            if stored is None:
+                raise exceptions.NotFound('Document does not exist')
+            if hasattr(last_update, 'ToDatetime'):
+                last_update = last_update.ToDatetime(tzinfo=datetime.timezone.utc)
+            if stored.update_time != last_update:
+                raise exceptions.FailedPrecondition('Document was modified since it was read')
+
+    def _commit(self, writes, timeout=None):
+        self._round_trip(timeout)
+        with self._lock:
+            self.rpc_count += 1
+            timestamp = self._timestamp()
+            staged = {}
+
+            def current(path):
+                return staged[path] if path in staged else self._stored(path)
+
+            for kind, ref, data, extra in writes:
+                stored = current(ref.path)
+                if kind == 'create':
+                    if stored is not None:
+                        raise exceptions.AlreadyExists(f'Document already exists: {ref.path}')
+                    staged[ref.path] = _Stored(_apply_write(None, data, False, timestamp), timestamp, timestamp)
+                elif kind == 'set':
+                    body = _apply_write(stored.data if stored else None, data, bool(extra), timestamp)
+                    staged[ref.path] = _Stored(body, stored.create_time if stored else timestamp, timestamp)
+                elif kind == 'update':
+                    if stored is None:
+                        raise exceptions.NotFound(f'No document to update: {ref.path}')
+                    self._check_option(stored, extra)
+                    body = copy.deepcopy(stored.data)
+                    for key, value in data.items():
+                        # update() treats dotted keys as paths and replaces nested maps wholesale
+                        if isinstance(value, dict):
+                            _set_path(body, key, copy.deepcopy(value))
+                        else:
+                            body = _apply_write(body, {key: value}, True, timestamp)
+                    staged[ref.path] = _Stored(body, stored.create_time, timestamp)
+                elif kind == 'delete':
+                    self._check_option(stored, extra)
+                    staged[ref.path] = None
+
+            written = []
+            for path, stored in staged.items():
+                collection_path, doc_id = self._split(path)
+                docs = self._collections.setdefault(collection_path, {})
+                before = docs.get(doc_id)
+                if stored is None:
+                    docs.pop(doc_id, None)
+                else:
+                    docs[doc_id] = stored
+                self._update_views(collection_path, doc_id, before, stored)
+                written.append((path, before, stored))
+            self._notify(written, timestamp)
+        return [WriteResult(timestamp) for _ in writes]
+
+    # -- listeners --
+    def _watch_state(self, watch):
+        """(doc_id, stored) of every document the watch's query matches. Call with the lock held."""
+        docs = self._collections.get(watch._query._parent.path, {})
+        return [(doc_id, stored) for doc_id, stored in docs.items() if watch._matches(stored)]
+
+    def _notify(self, written, timestamp):
+        """Queue the changes in `written` ((path, before, after) triples) for every listener they concern."""
+        for watch in self._watches:
+            path = watch._query._parent.path
+            changes = []
+            for doc_path, before, after in written:
+                collection_path, doc_id = self._split(doc_path)
+                if collection_path != path:
+                    continue
+                was, now = watch._matches(before), watch._matches(after)
+                if now:
+                    changes.append((ChangeType.MODIFIED if was else ChangeType.ADDED, doc_id, after))
+                elif was:
+                    changes.append((ChangeType.REMOVED, doc_id, before))
+            if changes:
+                watch._queue.put((self._watch_state(watch), changes, timestamp))
+
+    # -- sorted views --
+    @staticmethod
+    def _view_key(fields, doc_id, data):
+        """Sort key of a document for a view, or None if it lacks an ordered field."""
+        key = []
+        for field in fields:
+            if field == '__name__':
+                key.append((6, doc_id))
+            else:
+                try:
+                    key.append(_sort_key(_get_path(data, field)))
+                except KeyError:
+                    return None
+        return tuple(key)
+
+    def _view(self, collection_path, fields):
+        view = self._views.get((collection_path, fields))
+        if view is None:
+            rows = []
+            for doc_id, stored in self._collections.get(collection_path, {}).items():
+                key = self._view_key(fields, doc_id, stored.data)
+                if key is not None:
+                    rows.append((key, doc_id, stored))
+            rows.sort(key=lambda row: row[0])
+            view = _SortedView([row[0] for row in rows], [(row[1], row[2]) for row in rows])
+            self._views[(collection_path, fields)] = view
+        return view
+
+    def _drop_views(self, collection_path):
+        for key in [key for key in self._views if key[0] == collection_path]:
+            del self._views[key]
+
+    def _update_views(self, collection_path, doc_id, before, after):
+        for (path, fields), view in list(self._views.items()):
+            if path != collection_path:
+                continue
+            # Copy on write: running queries keep iterating the old lists
+            keys, entries = list(view.keys), list(view.entries)
+            if before is not None:
+                old_key = self._view_key(fields, doc_id, before.data)
+                if old_key is not None:
+                    index = bisect.bisect_left(keys, old_key)
+                    while index < len(keys) and keys[index] == old_key and entries[index][0] != doc_id:
+                        index += 1
+                    if index < len(keys) and entries[index][0] == doc_id:
+                        del keys[index]
+                        del entries[index]
+            if after is not None:
+                new_key = self._view_key(fields, doc_id, after.data)
+                if new_key is not None:
+                    index = bisect.bisect_right(keys, new_key)
+                    keys.insert(index, new_key)
+                    entries.insert(index, (doc_id, after))
+            self._views[(path, fields)] = _SortedView(keys, entries)
+
+    # -- queries --
+    def _matches(self, data, flt):
+        try:
+            value = _get_path(data, flt.field_path)
+        except KeyError:
+            return False
+        op, target = flt.op_string, flt.value
+        if op == '==':
+            return value == target
+        if op == '!=':
+            return value != target
+        if op == 'in':
+            return value in target
+        if op == 'not-in':
+            return value not in target
+        # The client spells these with underscores
+        if op in ('array_contains', 'array-contains'):
+            return isinstance(value, list) and target in value
+        if op in ('array_contains_any', 'array-contains-any'):
+            return isinstance(value, list) and any(t in value for t in target)
+        # Range comparisons only match values of the same type
+        left, right = _sort_key(value), _sort_key(target)
+        if left[0] != right[0]:
+            return False
+        if op == '<':
+            return left < right
+        if op == '<=':
+            return left <= right
+        if op == '>':
+            return left > right
+        if op == '>=':
+            return left >= right
+        raise ValueError(f'Unsupported operator: {op}')
+
+    @staticmethod
+    def _effective_orders(query):
+        orders = list(query._orders)
+        # An inequality filter implies ordering by that field first
+        for flt in query._filters:
+            if flt.op_string in _RANGE_OPS:
+                if not any(field == flt.field_path for field, _ in orders):
+                    orders.insert(0, (flt.field_path, ASCENDING))
+                break
+        if not any(field == '__name__' for field, _ in orders):
+            last = orders[-1][1] if orders else ASCENDING
+            orders.append(('__name__', last))
+        return orders
+
+    def _cursor_key(self, collection_path, cursor, fields):
+        if isinstance(cursor, DocumentSnapshot):
+            stored = self._stored(cursor.reference.path)
+            data = stored.data if stored is not None else (cursor._data or {})
+            return self._view_key(fields, cursor.id, data)
+        if isinstance(cursor, dict):
+            values = []
+            for field in fields:
+                if field not in cursor:
+                    break
+                values.append(cursor[field])
+        else:
+            values = list(cursor)
+        key = []
+        for field, value in zip(fields, values):
+            if field == '__name__':
+                if isinstance(value, DocumentReference):
+                    value = value.id
+                key.append((6, value))
+            else:
+                key.append(_sort_key(value))
+        return tuple(key)
+
+    def _run_query(self, query, timeout=None):
+        collection_path = query._parent.path
+        orders = self._effective_orders(query)
+        fields = tuple(field for field, _ in orders)
+        directions = {direction for _, direction in orders}
+
+        self._round_trip(timeout)
+        with self._lock:
+            self.rpc_count += 1
+            view = self._view(collection_path, fields)
+            start = end = None
+            if query._start is not None:
+                start = (self._cursor_key(collection_path, query._start[0], fields), query._start[1])
+            if query._end is not None:
+                end = (self._cursor_key(collection_path, query._end[0], fields), query._end[1])
+
+        keys, entries = view.keys, view.entries
+        if len(directions) == 1:
+            indices = self._slice(keys, orders, query._filters, start, end, directions.pop() == DESCENDING)
+        else:
+            indices = self._mixed_order(keys, orders, start, end)
+        return self._iterate(indices, keys, entries, query)
+
+    @staticmethod
+    def _slice(keys, orders, filters, start, end, descending):
+        lo, hi = 0, len(keys)
+        # Narrow by range filters on the leading order field
+        first = orders[0][0]
+        for flt in filters:
+            if flt.field_path != first or flt.op_string not in ('==', '<', '<=', '>', '>='):
+                continue
+            bound = _sort_key(flt.value)
+            if flt.op_string in ('==', '>='):
+                lo = max(lo, bisect.bisect_left(keys, (bound,)))
+            if flt.op_string == '>':
+                lo = max(lo, bisect.bisect_left(keys, (bound, _MAX)))
+            if flt.op_string in ('==', '<='):
+                hi = min(hi, bisect.bisect_left(keys, (bound, _MAX)))
+            if flt.op_string == '<':
+                hi = min(hi, bisect.bisect_left(keys, (bound,)))
+
+        # Cursors are expressed in query order, which is reversed for DESCENDING
+        low_cursor, high_cursor = (end, start) if descending else (start, end)
+        if low_cursor is not None:
+            key, inclusive = low_cursor
+            lo = max(lo, bisect.bisect_left(keys, key if inclusive else key + (_MAX,)))
+        if high_cursor is not None:
+            key, inclusive = high_cursor
+            hi = min(hi, bisect.bisect_left(keys, key + (_MAX,) if inclusive else key))
+        if hi <= lo:
+            return range(0)
+        return range(hi - 1, lo - 1, -1) if descending else range(lo, hi)
+
+    @staticmethod
+    def _mixed_order(keys, orders, start, end):
+        def compare(key, cursor_key):
+            for (_, direction), left, right in zip(orders, key, cursor_key):
+                if left != right:
+                    result = -1 if left < right else 1
+                    return -result if direction == DESCENDING else result
+            return 0
+
+        def order_cmp(a, b):
+            return compare(keys[a], keys[b])
+
+        indices = sorted(range(len(keys)), key=functools.cmp_to_key(order_cmp))
+        if start is not None:
+            key, inclusive = start
+            indices = [i for i in indices if compare(keys[i], key) >= (0 if inclusive else 1)]
+        if end is not None:
+            key, inclusive = end
+            indices = [i for i in indices if compare(keys[i], key) <= (0 if inclusive else -1)]
+        return indices
+
+    def _iterate(self, indices, keys, entries, query):
+        collection_path = query._parent.path
+        skip = query._offset or 0
+        remaining = query._limit
+        read_time = _now()
+        for index in indices:
+            if remaining is not None and remaining <= 0:
+                return
+            doc_id, stored = entries[index]
+            if not all(self._matches(stored.data, flt) for flt in query._filters):
+                continue
+            if skip:
+                skip -= 1
+                continue
+            if remaining is not None:
+                remaining -= 1
+            self.documents_read += 1
+            data = copy.deepcopy(self._project(stored.data, query._projection))
+            yield DocumentSnapshot(DocumentReference(self, f'{collection_path}/{doc_id}'), data,
+                                   stored.create_time, stored.update_time, read_time)
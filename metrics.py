@@ -0,0 +1,331 @@
+# metrics.py
+#
+# Request and Firestore instrumentation with a Prometheus text exposition.
+#
+# Every Firestore RPC is timed where the client issues it (the GAPIC methods
+# of a google-cloud-firestore client, or the RPC entry points of the
+# memory_firestore stand-in) and charged to the request being served. At the
+# end of the request the totals go into per-endpoint histograms and, when
+# enabled, into a Server-Timing response header.
+#
+# Metrics live in process memory: under gunicorn each worker exposes its own
+# series on /metrics and Prometheus should scrape every worker (or sum them).
+# Bodies streamed after the view returns (exports) are not part of the
+# request totals; their RPCs still show up in firestore_rpc_duration_seconds.
+
+import bisect
+import contextvars
+import threading
+import time
+
+from flask import before_render_template, g, request, template_rendered
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+DOCUMENT_BUCKETS = (0, 1, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+# ------------------ Metric types ------------------ #
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} counter'
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (last is +Inf), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} histogram'
+        with self._lock:
+            series = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._series.items())
+        for labels, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = _format_labels(self.labelnames, labels, [('le', _format_value(bound))])
+                yield f'{self.name}_bucket{le} {cumulative}'
+            label_text = _format_labels(self.labelnames, labels)
+            yield f'{self.name}_sum{label_text} {_format_value(total)}'
+            yield f'{self.name}_count{label_text} {cumulative}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'http_request_duration_seconds', 'Time spent handling a request, excluding streamed bodies.',
+    ['endpoint', 'method', 'status']))
+REQUEST_FIRESTORE_SECONDS = REGISTRY.register(Histogram(
+    'http_request_firestore_seconds', 'Time a request spent waiting on Firestore RPCs.', ['endpoint']))
+REQUEST_RENDER_SECONDS = REGISTRY.register(Histogram(
+    'http_request_render_seconds', 'Time a request spent rendering templates.', ['endpoint']))
+REQUEST_FIRESTORE_RPCS = REGISTRY.register(Histogram(
+    'http_request_firestore_rpcs', 'Firestore RPCs issued per request.', ['endpoint'], COUNT_BUCKETS))
+REQUEST_DOCUMENTS_READ = REGISTRY.register(Histogram(
+    'http_request_firestore_documents_read', 'Firestore documents read per request.', ['endpoint'],
+    DOCUMENT_BUCKETS))
+FIRESTORE_RPC_SECONDS = REGISTRY.register(Histogram(
+    'firestore_rpc_duration_seconds', 'Duration of Firestore RPCs, including streamed results.', ['method']))
+FIRESTORE_DOCUMENTS_READ = REGISTRY.register(Counter(
+    'firestore_documents_read_total', 'Firestore documents returned by reads.', ['method']))
+FIRESTORE_RPC_ERRORS = REGISTRY.register(Counter(
+    'firestore_rpc_errors_total', 'Firestore RPCs that raised.', ['method']))
+
+
+def render():
+    return REGISTRY.render()
+
+
+# ------------------ Per-request accounting ------------------ #
+class RequestStats:
+    """Firestore and template totals for one request."""
+
+    __slots__ = ('rpcs', 'documents', 'firestore_seconds', 'render_seconds', '_lock')
+
+    def __init__(self):
+        self.rpcs = 0
+        self.documents = 0
+        self.firestore_seconds = 0.0
+        self.render_seconds = 0.0
+        # Reads may be issued from worker threads on behalf of the request
+        self._lock = threading.Lock()
+
+    def add_rpc(self, seconds, documents):
+        with self._lock:
+            self.rpcs += 1
+            self.documents += documents
+            self.firestore_seconds += seconds
+
+
+_current = contextvars.ContextVar('request_stats', default=None)
+
+
+def current_stats():
+    """The RequestStats of the request being served, or None outside one."""
+    return _current.get()
+
+
+def record_rpc(method, seconds, documents=0, failed=False):
+    FIRESTORE_RPC_SECONDS.observe((method,), seconds)
+    if documents:
+        FIRESTORE_DOCUMENTS_READ.inc((method,), documents)
+    if failed:
+        FIRESTORE_RPC_ERRORS.inc((method,))
+    stats = _current.get()
+    if stats is not None:
+        stats.add_rpc(seconds, documents)
+
+
+# ------------------ Client instrumentation ------------------ #
+def _timed_call(method, fn, count_documents):
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            record_rpc(method, time.perf_counter() - started, failed=True)
+            raise
+        record_rpc(method, time.perf_counter() - started, count_documents(result))
+        return result
+    return wrapper
+
+
+def _timed_stream(method, fn, is_document):
+    """Wrap an RPC returning an iterator; only time spent inside next() is charged."""
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            iterator = iter(fn(*args, **kwargs))
+        except Exception:
+            record_rpc(method, time.perf_counter() - started, failed=True)
+            raise
+        waited = time.perf_counter() - started
+
+        def stream():
+            nonlocal waited
+            documents = 0
+            failed = False
+            try:
+                while True:
+                    resumed = time.perf_counter()
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        waited += time.perf_counter() - resumed
+                        return
+                    waited += time.perf_counter() - resumed
+                    if is_document(item):
+                        documents += 1
+                    yield item
+            except Exception:
+                failed = True
+                raise
+            finally:
+                record_rpc(method, waited, documents, failed)
+        return stream()
+    return wrapper
+
+
+def _none(result):
+    return 0
+
+
+def _has_field(name):
+    return lambda response: response._pb.HasField(name)
+
+
+# GAPIC methods the google-cloud-firestore client calls, by result shape
+_GAPIC_UNARY = ('begin_transaction', 'commit', 'rollback', 'list_collection_ids', 'list_documents',
+                'partition_query')
+_GAPIC_STREAMS = {
+    'run_query': _has_field('document'),
+    'batch_get_documents': _has_field('found'),
+    'run_aggregation_query': _has_field('result'),
+}
+
+
+def instrument_client(db):
+    """Time and count every RPC the client `db` issues. Safe to call once per client."""
+    import memory_firestore
+
+    if getattr(db, '_metrics_instrumented', False):
+        return db
+    if isinstance(db, memory_firestore.Client):
+        db._snapshot = _timed_call('get_document', db._snapshot, lambda snapshot: int(snapshot.exists))
+        db._batch_get = _timed_call('batch_get_documents', db._batch_get,
+                                    lambda snapshots: sum(snapshot.exists for snapshot in snapshots))
+        db._commit = _timed_call('commit', db._commit, _none)
+        db._run_query = _timed_stream('run_query', db._run_query, lambda snapshot: True)
+    else:
+        api = db._firestore_api
+        for name in _GAPIC_UNARY:
+            setattr(api, name, _timed_call(name, getattr(api, name), _none))
+        for name, is_document in _GAPIC_STREAMS.items():
+            setattr(api, name, _timed_stream(name, getattr(api, name), is_document))
+    db._metrics_instrumented = True
+    return db
+
+
+# ------------------ Flask integration ------------------ #
+def _endpoint():
+    return request.endpoint or 'unmatched'
+
+
+def _start_render(sender, template, context, **extra):
+    g._render_started = time.perf_counter()
+
+
+def _end_render(sender, template, context, **extra):
+    stats = _current.get()
+    started = g.pop('_render_started', None)
+    if stats is not None and started is not None:
+        stats.render_seconds += time.perf_counter() - started
+
+
+def _server_timing(total, stats):
+    return (f'app;dur={total * 1000:.1f}, '
+            f'firestore;dur={stats.firestore_seconds * 1000:.1f};desc="{stats.rpcs} rpc {stats.documents} docs", '
+            f'render;dur={stats.render_seconds * 1000:.1f}')
+
+
+def init_app(app):
+    """Register the request hooks. Call before any other before_request handler."""
+    app.config.setdefault('SERVER_TIMING', True)
+
+    @app.before_request
+    def start_request_metrics():
+        g._metrics_started = time.perf_counter()
+        g._metrics_token = _current.set(RequestStats())
+
+    @app.after_request
+    def finish_request_metrics(response):
+        stats = _current.get()
+        started = g.get('_metrics_started')
+        if stats is None or started is None:
+            return response
+        total = time.perf_counter() - started
+        endpoint = _endpoint()
+        REQUEST_SECONDS.observe((endpoint, request.method, str(response.status_code)), total)
+        REQUEST_FIRESTORE_SECONDS.observe((endpoint,), stats.firestore_seconds)
+        REQUEST_RENDER_SECONDS.observe((endpoint,), stats.render_seconds)
+        REQUEST_FIRESTORE_RPCS.observe((endpoint,), stats.rpcs)
+        REQUEST_DOCUMENTS_READ.observe((endpoint,), stats.documents)
+        if app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = _server_timing(total, stats)
+        return response
+
+    @app.teardown_request
+    def reset_request_metrics(exc):
+        token = g.pop('_metrics_token', None)
+        if token is not None:
+            try:
+                _current.reset(token)
+            except ValueError:
+                # Torn down in a different context than the one it started in
+                _current.set(None)
+
+    before_render_template.connect(_start_render, app)
+    template_rendered.connect(_end_render, app)
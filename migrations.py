@@ -0,0 +1,117 @@
+# migrations.py
+#
+# One-off data migrations, run through the Flask CLI (see app.py).
+
+import logging
+from datetime import date, datetime
+
+from firebase_admin import firestore
+
+import search
+import task_dates
+
+logger = logging.getLogger(__name__)
+
+# Firestore allows at most 500 writes per batch
+BATCH_LIMIT = 500
+
+# Date fields that range queries rely on, per collection
+DATE_FIELDS = {
+    'sales': 'sale_date',
+    'expenses': 'date',
+}
+
+_LEGACY_DATE_FORMATS = ('%Y-%m-%d', '%Y/%m/%d', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%d/%m/%Y')
+
+
+def normalize_date(value):
+    """Return value as a zero-padded 'YYYY-MM-DD' string, or None if it cannot be parsed."""
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d')
+    if isinstance(value, date):
+        return value.strftime('%Y-%m-%d')
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    for fmt in _LEGACY_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    return None
+
+
+def _commit_updates(db, updates):
+    for start in range(0, len(updates), BATCH_LIMIT):
+        batch = db.batch()
+        for ref, fields in updates[start:start + BATCH_LIMIT]:
+            batch.update(ref, fields)
+        batch.commit()
+
+
+def normalize_dates(db, dry_run=False):
+    """Rewrite sale and expense dates as ISO strings so range queries see every row.
+
+    Returns a dict of collection name to (rewritten, unparseable) counts.
+    """
+    report = {}
+    for collection, field in DATE_FIELDS.items():
+        updates = []
+        unparseable = 0
+        for doc in db.collection(collection).stream():
+            value = doc.to_dict().get(field)
+            normalized = normalize_date(value)
+            if normalized is None:
+                unparseable += 1
+                logger.warning(f"Cannot parse {collection}/{doc.id}.{field}: {value!r}")
+            elif normalized != value:
+                updates.append((doc.reference, {field: normalized}))
+        if not dry_run:
+            _commit_updates(db, updates)
+        report[collection] = (len(updates), unparseable)
+        logger.info(f"Normalized {len(updates)} {collection} dates ({unparseable} unparseable)")
+    return report
+
+
+def migrate_task_dates(db, dry_run=False):
+    """Convert the free-form `datetime` strings of calendar tasks into `due` timestamps.
+
+    Tasks that already have `due` are left alone, so the command can be run
+    again. Returns (migrated, unparseable) counts.
+    """
+    updates = []
+    unparseable = 0
+    for doc in db.collection('calendar_tasks').stream():
+        task = doc.to_dict()
+        if 'due' in task:
+            continue
+        fields = task_dates.legacy_fields(task.get('datetime'))
+        if fields is None:
+            unparseable += 1
+            logger.warning(f"Cannot parse calendar_tasks/{doc.id}.datetime: {task.get('datetime')!r}")
+            continue
+        fields['datetime'] = firestore.DELETE_FIELD
+        updates.append((doc.reference, fields))
+    if not dry_run:
+        _commit_updates(db, updates)
+    logger.info(f"Migrated {len(updates)} task dates ({unparseable} unparseable)")
+    return len(updates), unparseable
+
+
+def index_customers(db, dry_run=False):
+    """Write the customer_search field of sales that lack it or whose name changed since.
+
+    Only the name and the search field are read. Returns (updated, total) counts.
+    """
+    updates = []
+    total = 0
+    for doc in db.collection('sales').select(['customer_name', search.FIELD]).stream():
+        total += 1
+        data = doc.to_dict()
+        expected = search.prefixes(data.get('customer_name'))
+        if data.get(search.FIELD) != expected:
+            updates.append((doc.reference, {search.FIELD: expected}))
+    if not dry_run:
+        _commit_updates(db, updates)
+    logger.info(f"Indexed {len(updates)} of {total} sales for customer search")
+    return len(updates), total
@@ -0,0 +1,358 @@
+# mirror.py
+#
+# Optional in-process mirror of the sales, expenses and calendar_tasks
+# collections (MIRROR=1). Each worker process subscribes to them with
+# on_snapshot listeners and keeps their documents in memory, so the list
+# pages, /api/chart-data and the calendar read memory instead of downloading
+# the collections again, and /api/live can push fresh dashboard totals to
+# open browsers as soon as a change arrives.
+#
+# Staleness and resync:
+#
+#   * A collection's mirror serves reads only while it is ready: its
+#     listener is active and has delivered a full snapshot. Otherwise the
+#     repositories read Firestore exactly as without a mirror, so the mirror
+#     makes reads cheaper but never makes them fail.
+#   * Changes arrive with the listener's lag, usually well under a second,
+#     so a mirrored read can miss another worker's most recent writes.
+#     Writes made through this process's repositories are visible to its
+#     own later reads: after one, reads wait up to MIRROR_WRITE_WAIT_SECONDS
+#     for a newer snapshot, then read Firestore until it arrives.
+#   * A listener that stops (stream error, failed callback) is replaced at
+#     most every MIRROR_RETRY_SECONDS. The new one starts with a full
+#     snapshot that replaces the mirrored documents. Every
+#     MIRROR_RESYNC_SECONDS the same happens proactively, with the old
+#     listener serving until the new one has caught up.
+#
+# Memory: the mirrors of one process hold at most MIRROR_MAX_DOCUMENTS
+# documents between them, across every tenant's Mirror (see Budget). A
+# collection that would go over is dropped from the mirror for the life of
+# the process and read from Firestore.
+#
+# Listener threads do not survive fork(): listeners start in the process
+# that first reads, i.e. in each gunicorn worker, not in the master.
+
+import bisect
+import functools
+import logging
+import os
+import threading
+import time
+
+import metrics
+import rollups
+
+logger = logging.getLogger(__name__)
+
+COLLECTIONS = ('sales', 'expenses', 'calendar_tasks')
+
+MAX_DOCUMENTS = int(os.getenv('MIRROR_MAX_DOCUMENTS', 100000))
+WRITE_WAIT = float(os.getenv('MIRROR_WRITE_WAIT_SECONDS', 1))
+RETRY_SECONDS = float(os.getenv('MIRROR_RETRY_SECONDS', 5))
+RESYNC_SECONDS = float(os.getenv('MIRROR_RESYNC_SECONDS', 3600))
+
+MIRROR_READS = metrics.REGISTRY.register(metrics.Counter(
+    'mirror_reads_total', 'Reads of mirrored collections, by where they were served from.',
+    ['collection', 'source']))
+MIRROR_LISTENERS = metrics.REGISTRY.register(metrics.Counter(
+    'mirror_listeners_started_total', 'Snapshot listeners started, by reason.', ['collection', 'reason']))
+
+# Sorts after any document id, or any date string
+LAST_KEY = chr(0x10FFFF)
+
+
+def _is_active(watch):
+    return getattr(watch, 'is_active', True)
+
+
+def _unsubscribe(watches):
+    """Stop listeners on another thread: a listener cannot be joined from its own callback."""
+    def run():
+        for watch in watches:
+            try:
+                watch.unsubscribe()
+            except Exception as e:
+                logger.warning(f"Error stopping a snapshot listener: {str(e)}")
+    if watches:
+        threading.Thread(target=run, name='mirror-unsubscribe', daemon=True).start()
+
+
+class Document:
+    """A mirrored document, read like a DocumentSnapshot."""
+
+    __slots__ = ('id', 'data')
+
+    exists = True
+
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        # Shared with the mirror: read it, never change it
+        self.data = data
+
+    def to_dict(self):
+        return dict(self.data)
+
+    def get(self, field_path):
+        return self.data.get(field_path)
+
+
+class CollectionMirror:
+    """The documents of one collection, kept current by a snapshot listener."""
+
+    def __init__(self, owner, db, name):
+        self.name = name
+        self._owner = owner
+        self._db = db
+        self._lock = threading.Lock()
+        self._advanced = threading.Condition(self._lock)
+        self._reset()
+
+    def _reset(self):
+        self._docs = {}
+        # Listener generations; callbacks of superseded ones are ignored
+        self._epoch = 0
+        self._serving = None
+        self._serving_since = 0.0
+        self._watches = {}
+        self._retry_after = 0.0
+        # Snapshots applied so far, and the count when this process last wrote
+        self.generation = 0
+        self._written_at = None
+        self._write_deadline = 0.0
+        self._sorted = {}
+        self.disabled = False
+
+    # -- listener --
+    def _start(self, reason):
+        with self._lock:
+            self._epoch += 1
+            epoch = self._epoch
+            self._retry_after = time.monotonic() + RETRY_SECONDS
+            abandoned = [self._watches.pop(e) for e in list(self._watches) if e != self._serving]
+        _unsubscribe(abandoned)
+        MIRROR_LISTENERS.inc((self.name, reason))
+        try:
+            watch = self._db.collection(self.name).on_snapshot(functools.partial(self._on_snapshot, epoch))
+        except Exception as e:
+            logger.error(f"Could not start the {self.name} listener: {str(e)}")
+            return
+        with self._lock:
+            superseded = self.disabled or (self._serving is not None and epoch < self._serving)
+            if not superseded:
+                self._watches[epoch] = watch
+        if superseded:
+            _unsubscribe([watch])
+
+    def _on_snapshot(self, epoch, docs, changes, read_time):
+        try:
+            self._apply(epoch, docs, changes)
+        except Exception:
+            logger.exception(f"Could not apply a {self.name} snapshot; waiting for a resync")
+            with self._lock:
+                if epoch == self._serving:
+                    self._serving = None
+                    self._docs = {}
+
+    def _apply(self, epoch, docs, changes):
+        superseded = []
+        with self._lock:
+            if self.disabled:
+                return
+            if epoch == self._serving:
+                for change in changes:
+                    if change.type.name == 'REMOVED':
+                        self._docs.pop(change.document.id, None)
+                    else:
+                        self._docs[change.document.id] = change.document.to_dict()
+                count = len(self._docs)
+            elif epoch == self._epoch:
+                # First snapshot of the newest listener: it replaces the mirror
+                count = len(docs)
+            else:
+                return
+            if not self._owner.reserve(self.name, count):
+                superseded = list(self._watches.values())
+                self._disable()
+            else:
+                if epoch != self._serving:
+                    self._docs = {doc.id: doc.to_dict() for doc in docs}
+                    self._serving = epoch
+                    self._serving_since = time.monotonic()
+                    superseded = [self._watches.pop(e) for e in list(self._watches) if e < epoch]
+                self.generation += 1
+                self._sorted = {}
+                self._advanced.notify_all()
+        _unsubscribe(superseded)
+        self._owner.changed(self.name)
+
+    def _disable(self):
+        """Drop this collection from the mirror for good. Call with the lock held."""
+        logger.warning(f"Mirror of {self.name} would exceed MIRROR_MAX_DOCUMENTS ({self._owner.max_documents}); "
+                       f"reading it from Firestore from now on")
+        self.disabled = True
+        self._docs = {}
+        self._sorted = {}
+        self._serving = None
+        self._watches = {}
+        self._owner.reserve(self.name, 0)
+
+    # -- reads --
+    def ready(self):
+        """True when reads of this collection may be served from the mirror.
+
+        Restarts a stopped or old listener as a side effect, and waits for the
+        mirror to catch up with a recent write by this process.
+        """
+        self._owner.start()
+        restart = None
+        with self._lock:
+            if self.disabled:
+                return self._count(False)
+            watch = self._watches.get(self._serving)
+            # The first snapshot can arrive before on_snapshot() has returned the watch
+            live = self._serving is not None and (watch is None or _is_active(watch))
+            now = time.monotonic()
+            if now >= self._retry_after:
+                self._retry_after = now + RETRY_SECONDS
+                if not live:
+                    restart = 'failed' if self._serving is not None else 'retry'
+                    self._serving = None
+                    self._docs = {}
+                elif RESYNC_SECONDS and now - self._serving_since > RESYNC_SECONDS and self._epoch == self._serving:
+                    restart = 'resync'
+            if live and self._written_at is not None:
+                while self.generation <= self._written_at:
+                    remaining = self._write_deadline - time.monotonic()
+                    if remaining <= 0:
+                        live = False
+                        break
+                    self._advanced.wait(remaining)
+                else:
+                    self._written_at = None
+        if restart:
+            self._start(restart)
+        return self._count(live)
+
+    def _count(self, served):
+        MIRROR_READS.inc((self.name, 'mirror' if served else 'firestore'))
+        return served
+
+    def note_write(self):
+        """Call before writing the collection, so this process's next reads include the write."""
+        with self._lock:
+            self._written_at = self.generation
+            self._write_deadline = time.monotonic() + WRITE_WAIT
+
+    def rows(self):
+        """[(doc_id, data)] of every document. The dicts are shared: copy before changing them."""
+        with self._lock:
+            return list(self._docs.items())
+
+    def sorted_by(self, field, value_type=str):
+        """(keys, docs) of the documents whose `field` is a value_type, ascending by (field, id)."""
+        with self._lock:
+            cached = self._sorted.get(field)
+            if cached is None:
+                rows = sorted((data[field], doc_id, data) for doc_id, data in self._docs.items()
+                              if isinstance(data.get(field), value_type))
+                cached = self._sorted[field] = ([(value, doc_id) for value, doc_id, _ in rows],
+                                                [Document(doc_id, data) for _, doc_id, data in rows])
+            return cached
+
+    def between(self, field, start, end, value_type=str, end_inclusive=True):
+        """Documents whose `field` lies within [start, end] (or [start, end)), in field order."""
+        keys, docs = self.sorted_by(field, value_type)
+        lo = bisect.bisect_left(keys, (start,))
+        hi = bisect.bisect_right(keys, (end, LAST_KEY)) if end_inclusive else bisect.bisect_left(keys, (end,))
+        return docs[lo:hi]
+
+
+class Budget:
+    """The document ceiling shared by the Mirrors of one process."""
+
+    def __init__(self, max_documents=MAX_DOCUMENTS):
+        self.max_documents = max_documents
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, key, count):
+        """Record that `key` holds `count` documents; False if that breaks the ceiling."""
+        with self._lock:
+            if sum(n for other, n in self._counts.items() if other != key) + count > self.max_documents:
+                return False
+            self._counts[key] = count
+            return True
+
+    def release(self, owner):
+        """Forget the counts of every collection of `owner`."""
+        with self._lock:
+            self._counts = {key: n for key, n in self._counts.items() if key[0] is not owner}
+
+
+class Mirror:
+    """The mirrored collections of one process (of one tenant's database)."""
+
+    def __init__(self, db, collections=COLLECTIONS, budget=None):
+        self.budget = budget if budget is not None else Budget()
+        self._collections = {name: CollectionMirror(self, db, name) for name in collections}
+        self._pid = None
+        self._lock = threading.Lock()
+        # Bumped on every applied sales or expenses snapshot; see wait_for_change
+        self.version = 0
+        self._changed = threading.Condition()
+        self._totals = None
+
+    def collection(self, name):
+        return self._collections.get(name)
+
+    def start(self):
+        """Start the listeners, once per process."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # State copied from a parent process has no listener threads behind it
+            for collection in self._collections.values():
+                collection._reset()
+            self.budget.release(self)
+            self._pid = os.getpid()
+        for collection in self._collections.values():
+            collection._start('start')
+
+    @property
+    def max_documents(self):
+        return self.budget.max_documents
+
+    def reserve(self, name, count):
+        """Record that `name` holds `count` documents; False if that breaks the ceiling."""
+        return self.budget.reserve((self, name), count)
+
+    def changed(self, name):
+        if name in rollups.LEDGER_COLLECTIONS:
+            with self._changed:
+                self.version += 1
+                self._changed.notify_all()
+
+    def wait_for_change(self, version, timeout):
+        """Block until `version` is out of date or `timeout` passes; returns the current version."""
+        with self._changed:
+            if self.version == version:
+                self._changed.wait(timeout)
+            return self.version
+
+    def totals(self):
+        """All-time totals as rollups.read_totals returns them, or None when the ledgers are not ready."""
+        ledgers = [self._collections.get(name) for name in rollups.LEDGER_COLLECTIONS]
+        if not all(ledger is not None and ledger.ready() for ledger in ledgers):
+            return None
+        key = tuple(ledger.generation for ledger in ledgers)
+        cached = self._totals
+        if cached is not None and cached[0] == key:
+            return dict(cached[1])
+        totals = dict.fromkeys(rollups.ROLLUP_FIELDS, 0.0)
+        for ledger in ledgers:
+            for _, data in ledger.rows():
+                rollups.add_to_totals(totals, ledger.name, data)
+        self._totals = (key, totals)
+        return dict(totals)
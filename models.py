@@ -0,0 +1,146 @@
+# models.py
+#
+# Typed records for the documents the pages and APIs read. Each model
+# decodes a Firestore snapshot (or a mirror.Document) in one pass, filling
+# in the defaults the routes used to patch into every row dict, so routes,
+# templates and analytics all read the same attributes.
+#
+# The classes are slotted dataclasses: no per-instance __dict__, which
+# roughly halves the memory of a decoded row compared with the dict it
+# replaces (see benchmarks/bench_models.py).
+#
+# Amount fields are floats. A stored amount that is not a number decodes to
+# None, so analytics can drop the row as it always has; a missing one is 0.
+#
+# Decoding takes every field with one itemgetter call and only falls back
+# to per-field get() with defaults for documents missing some of them.
+#
+# AGGREGATE_FIELDS on Sale and Expense are the fields the totals are
+# computed from. Reads that only aggregate (the chart data, the rollup
+# rebuild, the reversal of a changed row's totals) request just those with
+# select()/field_paths instead of downloading whole documents.
+
+from dataclasses import dataclass
+from datetime import datetime
+from operator import itemgetter
+from typing import Any, Optional
+
+import task_dates
+
+_SALE_FIELDS = itemgetter('customer_name', 'quantity', 'price_per_unit', 'sale_amount', 'sale_date', 'status')
+_EXPENSE_FIELDS = itemgetter('name', 'amount', 'date', 'status')
+_TASK_FIELDS = itemgetter('name', 'due', 'has_time', 'priority', 'done', 'price')
+
+
+def _amount(value):
+    """float(value), 0.0 when missing or empty, None when it is not a number."""
+    if type(value) is float:
+        return value
+    try:
+        return float(value or 0)
+    except (ValueError, TypeError):
+        return None
+
+
+@dataclass(slots=True)
+class Sale:
+    id: str
+    customer_name: str = ''
+    # As stored; imported and hand-entered sales are ints
+    quantity: Any = 0
+    price_per_unit: Optional[float] = 0.0
+    sale_amount: Optional[float] = 0.0
+    sale_date: str = ''
+    status: str = 'Pending'
+
+    AGGREGATE_FIELDS = ('sale_date', 'sale_amount', 'status')
+
+    @classmethod
+    def from_snapshot(cls, doc):
+        return cls.from_dict(doc.id, doc.to_dict())
+
+    @classmethod
+    def from_aggregate(cls, doc):
+        """A Sale from a snapshot projected to AGGREGATE_FIELDS; other fields keep their defaults."""
+        get = doc.to_dict().get
+        return cls(doc.id, '', 0, 0.0, _amount(get('sale_amount')), get('sale_date', ''), get('status', 'Pending'))
+
+    @classmethod
+    def from_dict(cls, doc_id, data):
+        try:
+            name, quantity, price, amount, day, status = _SALE_FIELDS(data)
+        except KeyError:
+            get = data.get
+            name, quantity, price, amount, day, status = (
+                get('customer_name', ''), get('quantity', 0), get('price_per_unit'), get('sale_amount'),
+                get('sale_date', ''), get('status', 'Pending'))
+        return cls(doc_id, name, quantity, _amount(price), _amount(amount), day, status)
+
+
+@dataclass(slots=True)
+class Expense:
+    id: str
+    name: str = ''
+    amount: Optional[float] = 0.0
+    date: str = ''
+    status: str = 'Pending'
+
+    AGGREGATE_FIELDS = ('date', 'amount', 'status')
+
+    @classmethod
+    def from_snapshot(cls, doc):
+        return cls.from_dict(doc.id, doc.to_dict())
+
+    @classmethod
+    def from_aggregate(cls, doc):
+        """An Expense from a snapshot projected to AGGREGATE_FIELDS; other fields keep their defaults."""
+        get = doc.to_dict().get
+        return cls(doc.id, '', _amount(get('amount')), get('date', ''), get('status', 'Pending'))
+
+    @classmethod
+    def from_dict(cls, doc_id, data):
+        try:
+            name, amount, day, status = _EXPENSE_FIELDS(data)
+        except KeyError:
+            get = data.get
+            name, amount, day, status = get('name', ''), get('amount'), get('date', ''), get('status', 'Pending')
+        return cls(doc_id, name, _amount(amount), day, status)
+
+
+@dataclass(slots=True)
+class Task:
+    id: str
+    name: str = ''
+    # Aware UTC datetime; None for a task not migrated by migrate-task-dates yet
+    due: Optional[datetime] = None
+    has_time: bool = False
+    priority: str = 'normal'
+    done: bool = False
+    price: float = 0.0
+    # The free-form 'YYYY-MM-DD HH:MM' string of an unmigrated task
+    legacy_datetime: str = ''
+
+    @classmethod
+    def from_snapshot(cls, doc):
+        return cls.from_dict(doc.id, doc.to_dict())
+
+    @classmethod
+    def from_dict(cls, doc_id, data):
+        get = data.get
+        try:
+            name, due, has_time, priority, done, price = _TASK_FIELDS(data)
+        except KeyError:
+            name, due, has_time, priority, done, price = (
+                get('name', ''), get('due'), get('has_time', False), get('priority', 'normal'),
+                get('done', False), get('price'))
+        return cls(doc_id, name, due if isinstance(due, datetime) else None, bool(has_time), priority,
+                   bool(done), _amount(price) or 0.0, get('datetime', '') or '')
+
+    @property
+    def due_label(self):
+        """When the task is due as the calendar shows it; see task_dates.display."""
+        return task_dates.display(self)
+
+
+# The model of each ledger collection
+LEDGER_MODELS = {'sales': Sale, 'expenses': Expense}
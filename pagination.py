@@ -0,0 +1,104 @@
+# pagination.py
+#
+# Keyset (cursor) pagination for the sales and expenses tables. Rows are
+# ordered newest first by their date field, then by document id, and pages
+# are fetched with limit() + start_after() so the cost of a page does not
+# depend on how deep into the history it is.
+
+import base64
+import bisect
+import json
+from collections import namedtuple
+
+from firebase_admin import firestore
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+Page = namedtuple('Page', ['docs', 'next_cursor', 'prev_cursor'])
+
+
+def encode_cursor(date_value, doc_id):
+    raw = json.dumps([date_value, doc_id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Return (date_value, doc_id) from a cursor token, or None if it is invalid."""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        date_value, doc_id = json.loads(raw)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(date_value, str) or not isinstance(doc_id, str) or not doc_id:
+        return None
+    return date_value, doc_id
+
+
+def parse_page_size(value, default=DEFAULT_PAGE_SIZE):
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def fetch_page(query, date_field, page_size, after=None, before=None):
+    """Fetch one page of `query`, newest first.
+
+    `after` and `before` are cursor tokens from a previous Page: `after`
+    returns the next (older) page and `before` the previous (newer) one.
+    """
+    after = decode_cursor(after)
+    before = decode_cursor(before) if after is None else None
+    backwards = before is not None
+
+    direction = firestore.Query.ASCENDING if backwards else firestore.Query.DESCENDING
+    query = (query.order_by(date_field, direction=direction)
+                  .order_by('__name__', direction=direction))
+    cursor = before or after
+    if cursor is not None:
+        query = query.start_after({date_field: cursor[0], '__name__': cursor[1]})
+
+    # Fetch one extra row to learn whether there is another page beyond this one
+    docs = list(query.limit(page_size + 1).stream())
+    return _page(docs, date_field, page_size, after, backwards)
+
+
+def slice_page(keys, docs, date_field, page_size, after=None, before=None):
+    """fetch_page over documents held in memory.
+
+    `docs` are sorted ascending by `keys`, their (date, document id) pairs;
+    ordering, cursors and the returned Page are the same as fetch_page's.
+    """
+    after = decode_cursor(after)
+    before = decode_cursor(before) if after is None else None
+    backwards = before is not None
+    if backwards:
+        start = bisect.bisect_right(keys, tuple(before))
+        window = docs[start:start + page_size + 1]
+    else:
+        end = bisect.bisect_left(keys, tuple(after)) if after is not None else len(keys)
+        window = docs[max(0, end - page_size - 1):end][::-1]
+    return _page(window, date_field, page_size, after, backwards)
+
+
+def _page(docs, date_field, page_size, after, backwards):
+    """Build the Page from up to page_size + 1 documents in query order."""
+    has_more = len(docs) > page_size
+    docs = docs[:page_size]
+    if backwards:
+        docs.reverse()
+
+    def cursor_for(doc):
+        return encode_cursor(doc.get(date_field), doc.id)
+
+    if not docs:
+        return Page([], None, None)
+    has_next = has_more if not backwards else True
+    has_prev = has_more if backwards else after is not None
+    return Page(docs,
+                cursor_for(docs[-1]) if has_next else None,
+                cursor_for(docs[0]) if has_prev else None)
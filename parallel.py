@@ -0,0 +1,83 @@
+# parallel.py
+#
+# Runs a request's independent reads concurrently on a bounded, process-wide
+# thread pool. Firestore calls spend their time waiting on the network, so
+# threads overlap them despite the GIL and the request waits roughly as long
+# as its slowest read instead of the sum of all of them.
+#
+# Every call runs in a copy of the caller's context, so the Flask request
+# and the per-request metrics stay visible. All calls share one deadline. As
+# soon as one fails or the deadline passes, calls that have not started are
+# cancelled and running ones stop at their next raise_if_cancelled()
+# checkpoint; their results are discarded.
+#
+# Calls must not themselves use run_all: a saturated pool would deadlock.
+
+import contextvars
+import os
+import threading
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+
+POOL_SIZE = int(os.getenv('READ_POOL_SIZE', 8))
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+_cancel_event = contextvars.ContextVar('parallel_cancel_event', default=None)
+
+
+class Cancelled(Exception):
+    """Raised inside a call whose sibling failed or whose deadline passed."""
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised by run_all when the calls did not finish in time."""
+
+
+def _executor():
+    global _pool, _pool_pid
+    # Created lazily and again after a fork: threads do not survive fork()
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix='read')
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def raise_if_cancelled():
+    """Checkpoint for long-running calls; raises Cancelled once the batch is abandoned."""
+    event = _cancel_event.get()
+    if event is not None and event.is_set():
+        raise Cancelled()
+
+
+def _submit(pool, call, event):
+    context = contextvars.copy_context()
+    context.run(_cancel_event.set, event)
+    return pool.submit(context.run, call)
+
+
+def run_all(calls, timeout=None):
+    """Run zero-argument callables concurrently and return their results in order.
+
+    Raises the exception of the first call (in list order) that failed, or
+    DeadlineExceeded if they did not all finish within `timeout` seconds.
+    """
+    if len(calls) < 2:
+        return [call() for call in calls]
+    event = threading.Event()
+    pool = _executor()
+    futures = [_submit(pool, call, event) for call in calls]
+    done, not_done = wait(futures, timeout=timeout, return_when=FIRST_EXCEPTION)
+    failed = next((future for future in futures if future in done and future.exception()), None)
+    if failed is None and not not_done:
+        return [future.result() for future in futures]
+
+    event.set()
+    for future in not_done:
+        future.cancel()
+    if failed is not None:
+        raise failed.exception()
+    raise DeadlineExceeded(f'{len(not_done)} of {len(calls)} reads did not finish within {timeout}s')
@@ -0,0 +1,247 @@
+# receivables.py
+#
+# Per-customer running totals, answering "who owes us how much, and for how
+# long?" without reading the sales. One document per customer:
+#
+#   customers/{id}   key             normalized customer name (search.normalize)
+#                    name            the name as last written
+#                    sales_total     lifetime sales amount, any status
+#                    sales_count     lifetime number of sales
+#                    pending_total   outstanding (Pending) amount
+#                    pending_by_date {'YYYY-MM-DD': outstanding amount of that
+#                                    day's sales}, 'undated' for sales whose
+#                                    date cannot be read
+#
+# rollups.py queues these increments in the same batch or transaction as the
+# dashboard rollups, so every write path (the /sales form, status changes,
+# deletes, bulk actions and CSV imports) keeps them exact. The oldest unpaid
+# date and the aging buckets are derived at read time from pending_by_date,
+# against today's date in TASK_TIMEZONE. Days that are paid off stay in the
+# map with a zero amount until `flask --app app rebuild-receivables` drops
+# them; readers skip amounts below CENT.
+
+import hashlib
+import logging
+import re
+from collections import defaultdict
+from datetime import date
+
+from firebase_admin import firestore
+
+import search
+import task_dates
+
+logger = logging.getLogger(__name__)
+
+CUSTOMER_COLLECTION = 'customers'
+
+# The sale fields a row's contribution depends on
+FIELDS = ('customer_name', 'sale_date', 'sale_amount', 'status')
+
+UNDATED = 'undated'
+
+# (label, first day, last day) of the aging buckets; None is open-ended.
+# Undated amounts count as the oldest.
+AGING_BUCKETS = (('0-30', 0, 30), ('31-60', 31, 60), ('61-90', 61, 90), ('90+', 91, None))
+
+# Amounts below this are float residue of paid-off increments
+CENT = 0.005
+
+# Firestore allows at most 500 writes per batch
+BATCH_LIMIT = 500
+
+_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+def customer_id(name):
+    """The customers document id of a customer name; names that normalize alike share it."""
+    return 'c_' + hashlib.sha256(search.normalize(name).encode('utf-8')).hexdigest()[:32]
+
+
+def customer_doc_ids(collection, data):
+    """Ids of the customers documents a row of `collection` contributes to."""
+    return [customer_id(data.get('customer_name'))] if collection == 'sales' else []
+
+
+def _amount(value):
+    try:
+        return float(value or 0)
+    except (ValueError, TypeError):
+        return 0.0
+
+
+def _day(value):
+    return value if isinstance(value, str) and _DATE_RE.match(value) else UNDATED
+
+
+def record_many(writer, db, records, removed=()):
+    """Queue the customer increments of sales `records`, and the reversal of `removed`
+    ones, summed into one write per customer. Returns the number of writes queued.
+    """
+    customers = {}
+    for sign, rows in ((1, records), (-1, removed)):
+        for sale in rows:
+            name = sale.get('customer_name') or ''
+            doc_id = customer_id(name)
+            entry = customers.get(doc_id)
+            if entry is None:
+                entry = customers[doc_id] = {'name': None, 'key': search.normalize(name),
+                                             'totals': defaultdict(float), 'dates': defaultdict(float)}
+            if sign > 0:
+                entry['name'] = name
+            amount = sign * _amount(sale.get('sale_amount'))
+            entry['totals']['sales_count'] += sign
+            entry['totals']['sales_total'] += amount
+            if sale.get('status') != 'Paid':
+                entry['totals']['pending_total'] += amount
+                entry['dates'][_day(sale.get('sale_date'))] += amount
+    for doc_id, entry in customers.items():
+        data = {'key': entry['key']}
+        if entry['name'] is not None:
+            data['name'] = entry['name']
+        data.update({field: firestore.Increment(value) for field, value in entry['totals'].items() if value})
+        dates = {day: firestore.Increment(value) for day, value in entry['dates'].items() if value}
+        if dates:
+            data['pending_by_date'] = dates
+        writer.set(db.collection(CUSTOMER_COLLECTION).document(doc_id), data, merge=True)
+    return len(customers)
+
+
+def record(writer, db, sale, sign=1):
+    """Queue the customer increments of one sale (sign=-1 to reverse them)."""
+    if sign > 0:
+        record_many(writer, db, [sale])
+    else:
+        record_many(writer, db, [], removed=[sale])
+
+
+def _bucket(age_days):
+    for label, first, last in AGING_BUCKETS:
+        if age_days >= first and (last is None or age_days <= last):
+            return label
+    return AGING_BUCKETS[0][0]
+
+
+def summarize(doc_id, data, today=None):
+    """A customer's receivables from its document: totals, oldest unpaid date and aging buckets."""
+    today = today or task_dates.today()
+    aging = {label: 0.0 for label, _, _ in AGING_BUCKETS}
+    oldest = None
+    for day, amount in (data.get('pending_by_date') or {}).items():
+        amount = _amount(amount)
+        if abs(amount) < CENT:
+            continue
+        if day == UNDATED:
+            aging[AGING_BUCKETS[-1][0]] += amount
+            continue
+        oldest = day if oldest is None or day < oldest else oldest
+        aging[_bucket((today - date.fromisoformat(day)).days)] += amount
+    outstanding = _amount(data.get('pending_total'))
+    return {
+        'id': doc_id,
+        'name': data.get('name') or '',
+        'key': data.get('key') or '',
+        'sales_total': round(_amount(data.get('sales_total')), 2),
+        'sales_count': int(data.get('sales_count') or 0),
+        'outstanding': round(outstanding, 2) if abs(outstanding) >= CENT else 0.0,
+        'oldest_unpaid': oldest,
+        'days_outstanding': (today - date.fromisoformat(oldest)).days if oldest else None,
+        'aging': {label: round(value, 2) for label, value in aging.items()},
+    }
+
+
+def read(db, include_settled=False, today=None):
+    """Customer summaries, most owed first, with only customers that owe unless `include_settled`.
+
+    Returns (customers, totals) where totals sums the outstanding amount
+    and each aging bucket.
+    """
+    query = db.collection(CUSTOMER_COLLECTION)
+    if not include_settled:
+        query = query.where(filter=firestore.FieldFilter('pending_total', '>=', CENT))
+    customers = [summarize(doc.id, data, today) for doc in query.stream()
+                 if (data := doc.to_dict()).get('sales_count')]
+    customers.sort(key=lambda c: (-c['outstanding'], -c['sales_total'], c['name']))
+    totals = {'outstanding': round(sum((c['outstanding'] for c in customers), 0.0), 2),
+              'customers': sum(1 for c in customers if c['outstanding']),
+              'aging': {label: round(sum((c['aging'][label] for c in customers), 0.0), 2)
+                        for label, _, _ in AGING_BUCKETS}}
+    return customers, totals
+
+
+def compute(db):
+    """Every customers document, recomputed from the sales."""
+    docs = {}
+    for doc in db.collection('sales').select(FIELDS).stream():
+        sale = doc.to_dict()
+        name = sale.get('customer_name') or ''
+        entry = docs.setdefault(customer_id(name), {'key': search.normalize(name), 'name': name,
+                                                    'sales_total': 0.0, 'sales_count': 0,
+                                                    'pending_total': 0.0, 'pending_by_date': {}})
+        # The name as last written is unknown here; keep the one of the most recent sale
+        day = _day(sale.get('sale_date'))
+        if day != UNDATED and day >= entry.get('_latest', ''):
+            entry['name'], entry['_latest'] = name, day
+        amount = _amount(sale.get('sale_amount'))
+        entry['sales_total'] += amount
+        entry['sales_count'] += 1
+        if sale.get('status') != 'Paid':
+            entry['pending_total'] += amount
+            entry['pending_by_date'][day] = entry['pending_by_date'].get(day, 0.0) + amount
+    for entry in docs.values():
+        entry.pop('_latest', None)
+        entry['pending_by_date'] = {day: amount for day, amount in entry['pending_by_date'].items()
+                                    if abs(amount) >= CENT}
+    return docs
+
+
+def rebuild(db, batch_limit=BATCH_LIMIT):
+    """Overwrite the customers collection with freshly computed totals.
+
+    Customers without sales are deleted. As with rollups.rebuild, writes
+    made while it runs may be lost. Returns the number of customers written.
+    """
+    docs = compute(db)
+    collection = db.collection(CUSTOMER_COLLECTION)
+    stale = [doc.reference for doc in collection.select([]).stream() if doc.id not in docs]
+    writes = [(ref, None) for ref in stale]
+    writes += [(collection.document(doc_id), data) for doc_id, data in docs.items()]
+    for start in range(0, len(writes), batch_limit):
+        batch = db.batch()
+        for ref, data in writes[start:start + batch_limit]:
+            if data is None:
+                batch.delete(ref)
+            else:
+                batch.set(ref, data)
+        batch.commit()
+    logger.info(f"Rebuilt {len(docs)} customer receivables, removed {len(stale)} stale documents")
+    return len(docs)
+
+
+def reconcile(db, tolerance=CENT):
+    """Compare stored customer totals with freshly computed ones without writing.
+
+    Returns {doc_id: (stored, expected)} for every customer that drifted.
+    """
+    expected = compute(db)
+    stored = {doc.id: doc.to_dict() for doc in db.collection(CUSTOMER_COLLECTION).stream()}
+
+    def figures(data):
+        dates = {day: _amount(amount) for day, amount in (data.get('pending_by_date') or {}).items()
+                 if abs(_amount(amount)) >= tolerance}
+        return {'sales_total': _amount(data.get('sales_total')), 'sales_count': int(data.get('sales_count') or 0),
+                'pending_total': _amount(data.get('pending_total')), 'pending_by_date': dates}
+
+    def same(have, want):
+        if have['sales_count'] != want['sales_count'] or set(have['pending_by_date']) != set(want['pending_by_date']):
+            return False
+        pairs = [(have[f], want[f]) for f in ('sales_total', 'pending_total')]
+        pairs += [(have['pending_by_date'][day], want['pending_by_date'][day]) for day in want['pending_by_date']]
+        return all(abs(a - b) <= tolerance for a, b in pairs)
+
+    drift = {}
+    for doc_id in set(expected) | set(stored):
+        have, want = figures(stored.get(doc_id, {})), figures(expected.get(doc_id, {}))
+        if not same(have, want):
+            drift[doc_id] = (have, want)
+    return drift
@@ -0,0 +1,245 @@
+# reports.py
+#
+# Profit-and-loss reports of a month ('2025-03') or a year ('2025'), as CSV
+# or XLSX. They are generated by the background jobs in jobs.py, not in a
+# request: a year of a busy shop streams every sale and expense it had.
+#
+# A report has four sections, one sheet each in XLSX and one block each in
+# CSV:
+#
+#   Summary      revenue, expenses and net profit, paid and pending. The
+#                total counts pending amounts on both sides; the paid column
+#                is the cash actually in and out.
+#   Daily /      the same figures per day of the month, or per month of the
+#   Monthly      year, every period listed even when empty
+#   Expenses     per expense name, largest first
+#   Customers    per customer: number of sales, revenue and what is unpaid
+#
+# Only the fields the figures need are read (select()). Sales and expenses
+# with an unreadable date are outside every period, as on the dashboard.
+#
+# XLSX is written directly (a zip of a few SpreadsheetML parts with inline
+# strings) rather than through a spreadsheet library; the reports only need
+# text and number cells on plain sheets.
+
+import calendar
+import csv
+import io
+import re
+import zipfile
+from collections import defaultdict
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape
+
+from firebase_admin import firestore
+
+import search
+
+KINDS = ('monthly', 'annual')
+
+FORMATS = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+_PERIOD_RE = {'monthly': re.compile(r'^\d{4}-(0[1-9]|1[0-2])$'), 'annual': re.compile(r'^\d{4}$')}
+
+# collection -> (date field, amount field, field naming the row's group)
+_LEDGERS = {
+    'sales': ('sale_date', 'sale_amount', 'customer_name'),
+    'expenses': ('date', 'amount', 'name'),
+}
+
+
+def parse_period(kind, period):
+    """The (first, last) 'YYYY-MM-DD' dates of a report period; ValueError when invalid."""
+    if kind not in KINDS:
+        raise ValueError(f"Report must be one of {', '.join(KINDS)}")
+    if not _PERIOD_RE[kind].match(period or ''):
+        raise ValueError('Period must be a month as YYYY-MM' if kind == 'monthly' else 'Period must be a year as YYYY')
+    if kind == 'annual':
+        return f'{period}-01-01', f'{period}-12-31'
+    year, month = map(int, period.split('-'))
+    return f'{period}-01', f'{period}-{calendar.monthrange(year, month)[1]:02d}'
+
+
+def filename(kind, period, fmt):
+    return f"profit_and_loss_{period}.{fmt}" if kind == 'monthly' else f"profit_and_loss_{period}_annual.{fmt}"
+
+
+def _amount(value):
+    try:
+        return float(value or 0)
+    except (ValueError, TypeError):
+        return 0.0
+
+
+def _stream(db, collection, start, end):
+    date_field, amount_field, group_field = _LEDGERS[collection]
+    query = (db.collection(collection)
+             .where(filter=firestore.FieldFilter(date_field, '>=', start))
+             .where(filter=firestore.FieldFilter(date_field, '<=', end))
+             .select([date_field, amount_field, group_field, 'status']))
+    for doc in query.stream():
+        data = doc.to_dict()
+        yield data.get(date_field), _amount(data.get(amount_field)), data.get(group_field) or '', data.get('status')
+
+
+def _periods(kind, period):
+    """The row keys of the breakdown: each day of the month, or each month of the year."""
+    if kind == 'annual':
+        return [f'{period}-{month:02d}' for month in range(1, 13)]
+    year, month = map(int, period.split('-'))
+    return [f'{period}-{day:02d}' for day in range(1, calendar.monthrange(year, month)[1] + 1)]
+
+
+def compute(db, kind, period):
+    """The report's sections: {'title', 'sections': [(name, rows)]}, rows[0] being the header."""
+    start, end = parse_period(kind, period)
+    key_length = 7 if kind == 'annual' else 10
+    revenue = defaultdict(lambda: [0.0, 0.0])
+    spent = defaultdict(lambda: [0.0, 0.0])
+    by_name = defaultdict(lambda: [0.0, 0.0])
+    customers = {}
+    for day, amount, name, status in _stream(db, 'sales', start, end):
+        column = 0 if status == 'Paid' else 1
+        revenue[day[:key_length]][column] += amount
+        key = search.normalize(name)
+        entry = customers.setdefault(key, {'name': name, 'count': 0, 'total': 0.0, 'unpaid': 0.0})
+        entry['count'] += 1
+        entry['total'] += amount
+        if column:
+            entry['unpaid'] += amount
+    for day, amount, name, status in _stream(db, 'expenses', start, end):
+        column = 0 if status == 'Paid' else 1
+        spent[day[:key_length]][column] += amount
+        by_name[name][column] += amount
+
+    paid_in = sum((paid for paid, _ in revenue.values()), 0.0)
+    pending_in = sum((pending for _, pending in revenue.values()), 0.0)
+    paid_out = sum((paid for paid, _ in spent.values()), 0.0)
+    pending_out = sum((pending for _, pending in spent.values()), 0.0)
+    summary = [
+        ['Item', 'Paid', 'Pending', 'Total'],
+        ['Revenue', paid_in, pending_in, paid_in + pending_in],
+        ['Expenses', paid_out, pending_out, paid_out + pending_out],
+        ['Net profit', paid_in - paid_out, pending_in - pending_out, paid_in + pending_in - paid_out - pending_out],
+        ['Sales', sum(entry['count'] for entry in customers.values()), '', ''],
+    ]
+    breakdown = [['Month' if kind == 'annual' else 'Date', 'Revenue', 'Revenue pending',
+                  'Expenses', 'Expenses pending', 'Net profit']]
+    for key in _periods(kind, period):
+        paid_sales, pending_sales = revenue.get(key, (0.0, 0.0))
+        paid_costs, pending_costs = spent.get(key, (0.0, 0.0))
+        breakdown.append([key, paid_sales + pending_sales, pending_sales, paid_costs + pending_costs, pending_costs,
+                          paid_sales + pending_sales - paid_costs - pending_costs])
+    expenses = [['Expense', 'Paid', 'Pending', 'Total']]
+    expenses += [[name, paid, pending, paid + pending]
+                 for name, (paid, pending) in sorted(by_name.items(), key=lambda item: (-sum(item[1]), item[0]))]
+    buyers = [['Customer', 'Sales', 'Revenue', 'Unpaid']]
+    buyers += [[entry['name'], entry['count'], entry['total'], entry['unpaid']]
+               for entry in sorted(customers.values(), key=lambda e: (-e['total'], e['name']))]
+
+    title = (f"Profit and loss, {datetime.strptime(period, '%Y-%m').strftime('%B %Y')}" if kind == 'monthly'
+             else f"Profit and loss, {period}")
+    return {'title': title, 'start': start, 'end': end,
+            'sections': [('Summary', summary), ('Monthly' if kind == 'annual' else 'Daily', breakdown),
+                         ('Expenses', expenses), ('Customers', buyers)]}
+
+
+def _cell_value(value):
+    return round(value, 2) if isinstance(value, float) else value
+
+
+def to_csv(report):
+    """The report as CSV: the title, then each section under its name, separated by a blank line."""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow([report['title']])
+    writer.writerow([f"{report['start']} to {report['end']}"])
+    for name, rows in report['sections']:
+        writer.writerow([])
+        writer.writerow([name])
+        writer.writerows([_cell_value(value) for value in row] for row in rows)
+    # Excel reads UTF-8 (Thai customer names) only with the byte order mark
+    return '\ufeff'.encode('utf-8') + out.getvalue().encode('utf-8')
+
+
+def _column(index):
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def _sheet_xml(rows):
+    lines = ['<?xml version="1.0" encoding="UTF-8" standalone="yes"?>',
+             '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>']
+    for r, row in enumerate(rows, start=1):
+        cells = []
+        for c, value in enumerate(row):
+            ref = f'{_column(c)}{r}'
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                cells.append(f'<c r="{ref}"><v>{_cell_value(value)!r}</v></c>')
+            elif value not in (None, ''):
+                cells.append(f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{escape(str(value))}</t></is></c>')
+        lines.append(f'<row r="{r}">{"".join(cells)}</row>')
+    lines.append('</sheetData></worksheet>')
+    return ''.join(lines)
+
+
+def to_xlsx(report):
+    """The report as an XLSX workbook, one sheet per section."""
+    sections = report['sections']
+    sheets = ''.join(f'<sheet name="{escape(name)}" sheetId="{i}" r:id="rId{i}"/>'
+                     for i, (name, _) in enumerate(sections, start=1))
+    relationships = ''.join(
+        f'<Relationship Id="rId{i}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"'
+        f' Target="worksheets/sheet{i}.xml"/>' for i in range(1, len(sections) + 1))
+    overrides = ''.join(
+        f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+        f'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        for i in range(1, len(sections) + 1))
+    header = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    parts = {
+        '[Content_Types].xml': (
+            f'{header}<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            f'{overrides}</Types>'),
+        '_rels/.rels': (
+            f'{header}<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+            'Target="xl/workbook.xml"/></Relationships>'),
+        'xl/workbook.xml': (
+            f'{header}<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets>{sheets}</sheets></workbook>'),
+        'xl/_rels/workbook.xml.rels': (
+            f'{header}<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            f'{relationships}</Relationships>'),
+    }
+    for i, (_, rows) in enumerate(sections, start=1):
+        parts[f'xl/worksheets/sheet{i}.xml'] = _sheet_xml(rows)
+    out = io.BytesIO()
+    # A fixed timestamp, so the same report is the same bytes
+    stamp = datetime(1980, 1, 1, tzinfo=timezone.utc).timetuple()[:6]
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in parts.items():
+            archive.writestr(zipfile.ZipInfo(name, stamp), content.encode('utf-8'), zipfile.ZIP_DEFLATED)
+    return out.getvalue()
+
+
+RENDERERS = {'csv': to_csv, 'xlsx': to_xlsx}
+
+
+def generate(db, kind, period, fmt):
+    """The report file's bytes."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Format must be one of {', '.join(FORMATS)}")
+    return RENDERERS[fmt](compute(db, kind, period))
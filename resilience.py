@@ -0,0 +1,350 @@
+# resilience.py
+#
+# Deadlines, retries and a circuit breaker for every Firestore RPC, applied
+# where metrics.py times them (the GAPIC methods of a google-cloud-firestore
+# client, or the RPC entry points of memory_firestore).
+#
+# Deadline budget: each request gets FIRESTORE_BUDGET_SECONDS (default 20)
+# for all of its Firestore calls together, well inside the gunicorn worker
+# timeout. Every attempt is sent with the time left as its gRPC timeout, and
+# a call made once the budget is spent raises BudgetExceeded without being
+# sent. parallel.run_all copies the context, so concurrent reads share their
+# request's budget. Response bodies streamed after the view returns (CSV
+# exports and imports) and work outside a request (CLI commands, report
+# jobs, mirror listeners) have no budget, and each attempt gets the
+# client's default timeout.
+#
+# Retries: a call that fails with a transient error (unavailable, deadline
+# exceeded, internal, resource exhausted) is tried again up to
+# FIRESTORE_RETRY_ATTEMPTS times in all (default 3), after a full-jitter
+# exponential backoff starting at FIRESTORE_RETRY_BASE_MS (default 50),
+# never sleeping past the budget. Commits are retried only on the errors
+# that mean the write was not applied, as the client's own policy does. A
+# query stream is retried only when it fails before its first result. The
+# client's built-in retries, which keep going for 60 to 300 seconds, are
+# turned off in favour of these.
+#
+# Circuit breaker, one per process: when at least BREAKER_MIN_CALLS attempts
+# in the last BREAKER_WINDOW_SECONDS include BREAKER_FAILURE_RATIO or more
+# transient failures, the breaker opens and every call fails at once with
+# CircuitOpen for BREAKER_OPEN_SECONDS. Then a single probe call goes
+# through: success closes the breaker, failure opens it again. Errors that
+# say nothing about Firestore's health (not found, failed precondition,
+# aborted transactions) count as successes.
+#
+# The app turns CircuitOpen, BudgetExceeded and transient errors that
+# outlast the retries into 503 responses with a Retry-After header.
+
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+
+from google.api_core import exceptions as gcp_exceptions
+
+import metrics
+import parallel
+
+logger = logging.getLogger(__name__)
+
+BUDGET_SECONDS = float(os.getenv('FIRESTORE_BUDGET_SECONDS', 20))
+RETRY_ATTEMPTS = max(1, int(os.getenv('FIRESTORE_RETRY_ATTEMPTS', 3)))
+RETRY_BASE_SECONDS = float(os.getenv('FIRESTORE_RETRY_BASE_MS', 50)) / 1000
+RETRY_MAX_SECONDS = 1.0
+BREAKER_WINDOW_SECONDS = int(os.getenv('BREAKER_WINDOW_SECONDS', 10))
+BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', 20))
+BREAKER_FAILURE_RATIO = float(os.getenv('BREAKER_FAILURE_RATIO', 0.5))
+BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', 5))
+
+# An attempt is not sent with less time than this left in the budget
+MIN_ATTEMPT_SECONDS = 0.05
+
+# Errors that may go away on their own
+TRANSIENT_ERRORS = (gcp_exceptions.ServiceUnavailable, gcp_exceptions.DeadlineExceeded,
+                    gcp_exceptions.InternalServerError, gcp_exceptions.TooManyRequests)
+# Errors on which a commit is known not to have been applied
+COMMIT_RETRY_ERRORS = (gcp_exceptions.ServiceUnavailable, gcp_exceptions.ResourceExhausted)
+
+FIRESTORE_RETRIES = metrics.REGISTRY.register(metrics.Counter(
+    'firestore_retries_total', 'Firestore RPC attempts repeated after a transient error.', ['method']))
+FIRESTORE_BUDGET_EXCEEDED = metrics.REGISTRY.register(metrics.Counter(
+    'firestore_budget_exceeded_total', 'Firestore calls not sent because the request had no time left.',
+    ['method']))
+BREAKER_TRIPS = metrics.REGISTRY.register(metrics.Counter(
+    'firestore_breaker_trips_total', 'Times the Firestore circuit breaker opened.'))
+BREAKER_REJECTED = metrics.REGISTRY.register(metrics.Counter(
+    'firestore_breaker_rejected_total', 'Firestore calls failed fast by the open circuit breaker.', ['method']))
+
+
+class Unavailable(Exception):
+    """Firestore cannot be used for this request; retry after `retry_after` seconds."""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpen(Unavailable):
+    """Raised instead of calling Firestore while the circuit breaker is open."""
+
+
+class BudgetExceeded(Unavailable, TimeoutError):
+    """Raised instead of calling Firestore once the request's deadline budget is spent."""
+
+
+def is_unavailable(error):
+    """Whether `error` means Firestore is down or too slow, rather than a bug or bad input."""
+    return isinstance(error, (Unavailable, parallel.DeadlineExceeded) + TRANSIENT_ERRORS)
+
+
+def retry_after(error):
+    """Seconds a client should wait before retrying after `error`."""
+    return max(1, round(getattr(error, 'retry_after', 1)))
+
+
+# ------------------ Deadline budget ------------------ #
+_deadline = contextvars.ContextVar('firestore_deadline', default=None)
+
+
+def start_budget(seconds):
+    """Give the calls made in this context `seconds` in all; returns a token for end_budget."""
+    return _deadline.set(time.monotonic() + seconds if seconds else None)
+
+
+def end_budget(token):
+    try:
+        _deadline.reset(token)
+    except ValueError:
+        # Ended in a different context than the one it started in
+        _deadline.set(None)
+
+
+def remaining():
+    """Seconds left in this context's budget, or None when it has none."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+# ------------------ Circuit breaker ------------------ #
+class CircuitBreaker:
+    """Fails calls fast while the recent failure ratio is too high (see the module comment)."""
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, window_seconds=BREAKER_WINDOW_SECONDS, min_calls=BREAKER_MIN_CALLS,
+                 failure_ratio=BREAKER_FAILURE_RATIO, open_seconds=BREAKER_OPEN_SECONDS, clock=time.monotonic):
+        self.window_seconds = max(1, window_seconds)
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.open_seconds = open_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        # One [second, calls, failures] per second of the window
+        self._buckets = [[0, 0, 0] for _ in range(self.window_seconds)]
+
+    def allow(self):
+        """Let a call through, or raise CircuitOpen while the breaker is open.
+
+        Returns True for the probe call of a half-open breaker, else False;
+        pass it to record() with the outcome.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return False
+            wait = self._opened_at + self.open_seconds - self._clock()
+            if self.state == self.OPEN and wait <= 0:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+        raise CircuitOpen('Firestore is failing; not calling it for now', retry_after=max(wait, 1))
+
+    def record(self, ok, probe=False):
+        """Count the outcome of a call allow() let through."""
+        now = self._clock()
+        with self._lock:
+            if probe:
+                self._probing = False
+                if ok:
+                    self.state = self.CLOSED
+                    self._buckets = [[0, 0, 0] for _ in range(self.window_seconds)]
+                    logger.info("Firestore circuit breaker closed")
+                else:
+                    self._trip(now)
+                return
+            if self.state != self.CLOSED:
+                # Let through before the breaker opened
+                return
+            second = int(now)
+            bucket = self._buckets[second % self.window_seconds]
+            if bucket[0] != second:
+                bucket[:] = [second, 0, 0]
+            bucket[1] += 1
+            bucket[2] += 0 if ok else 1
+            if ok:
+                return
+            calls = failures = 0
+            for start, bucket_calls, bucket_failures in self._buckets:
+                if second - start < self.window_seconds:
+                    calls += bucket_calls
+                    failures += bucket_failures
+            if calls >= self.min_calls and failures >= self.failure_ratio * calls:
+                logger.error(f"Firestore circuit breaker opened: {failures} of {calls} calls failed "
+                             f"in {self.window_seconds}s")
+                self._trip(now)
+
+    def _trip(self, now):
+        self.state = self.OPEN
+        self._opened_at = now
+        BREAKER_TRIPS.inc()
+
+
+BREAKER = CircuitBreaker()
+
+
+# ------------------ Client protection ------------------ #
+def _attempt_timeout(method):
+    """The timeout of the next attempt: the budget left, or None outside a budget."""
+    left = remaining()
+    if left is not None and left < MIN_ATTEMPT_SECONDS:
+        FIRESTORE_BUDGET_EXCEEDED.inc((method,))
+        raise BudgetExceeded(f'No time left in the request budget for {method}')
+    return left
+
+
+def _backoff(attempt, method):
+    """Sleep before retry number `attempt` (1-based); False when the budget does not allow it."""
+    delay = random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempt - 1)))
+    left = remaining()
+    if left is not None and left - delay < MIN_ATTEMPT_SECONDS:
+        return False
+    FIRESTORE_RETRIES.inc((method,))
+    time.sleep(delay)
+    return True
+
+
+def _kwargs(kwargs, timeout, gapic):
+    kwargs = dict(kwargs)
+    if gapic:
+        # Ours replace the client's retries, which ignore the request budget
+        kwargs['retry'] = None
+    if timeout is not None:
+        kwargs['timeout'] = timeout
+    return kwargs
+
+
+def _retried(method, breaker, retry_on, gapic, call):
+    """Run call(kwargs) with the budget, retries and breaker; returns (result, attempts)."""
+    attempt = 0
+    while True:
+        attempt += 1
+        timeout = _attempt_timeout(method)
+        try:
+            probe = breaker.allow()
+        except CircuitOpen:
+            BREAKER_REJECTED.inc((method,))
+            raise
+        try:
+            result = call(timeout)
+        except TRANSIENT_ERRORS as e:
+            breaker.record(False, probe)
+            if attempt >= RETRY_ATTEMPTS or not isinstance(e, retry_on) or not _backoff(attempt, method):
+                raise
+            logger.info(f"Retrying Firestore {method} after {type(e).__name__}: {str(e)}")
+            continue
+        except BaseException:
+            breaker.record(True, probe)
+            raise
+        breaker.record(True, probe)
+        return result
+
+
+def _protected_call(method, fn, breaker, retry_on, gapic):
+    def wrapper(*args, **kwargs):
+        return _retried(method, breaker, retry_on, gapic,
+                        lambda timeout: fn(*args, **_kwargs(kwargs, timeout, gapic)))
+    return wrapper
+
+
+_END = object()
+
+
+def _protected_stream(method, fn, breaker, gapic):
+    """Like _protected_call for an RPC returning an iterator; only the wait for the first result is retried."""
+    def wrapper(*args, **kwargs):
+        def start(timeout):
+            iterator = iter(fn(*args, **_kwargs(kwargs, timeout, gapic)))
+            return iterator, next(iterator, _END)
+
+        iterator, first = _retried(method, breaker, TRANSIENT_ERRORS, gapic, start)
+
+        def stream():
+            if first is _END:
+                return
+            yield first
+            try:
+                yield from iterator
+            except TRANSIENT_ERRORS:
+                breaker.record(False)
+                raise
+        return stream()
+    return wrapper
+
+
+# GAPIC methods the google-cloud-firestore client calls, by result shape
+_GAPIC_UNARY = ('begin_transaction', 'rollback', 'list_collection_ids', 'list_documents', 'partition_query')
+_GAPIC_STREAMS = ('run_query', 'batch_get_documents', 'run_aggregation_query')
+
+
+def protect_client(db, breaker=None):
+    """Apply the budget, retries and `breaker` (default: the process's) to every RPC of `db`.
+
+    Call on a client metrics.instrument_client has already wrapped, so each
+    attempt is timed on its own. Safe to call once per client.
+    """
+    import memory_firestore
+
+    if getattr(db, '_resilience_protected', False):
+        return db
+    breaker = breaker or BREAKER
+    if isinstance(db, memory_firestore.Client):
+        db._snapshot = _protected_call('get_document', db._snapshot, breaker, TRANSIENT_ERRORS, False)
+        db._batch_get = _protected_call('batch_get_documents', db._batch_get, breaker, TRANSIENT_ERRORS, False)
+        db._commit = _protected_call('commit', db._commit, breaker, COMMIT_RETRY_ERRORS, False)
+        db._run_query = _protected_stream('run_query', db._run_query, breaker, False)
+    else:
+        api = db._firestore_api
+        for name in _GAPIC_UNARY:
+            setattr(api, name, _protected_call(name, getattr(api, name), breaker, TRANSIENT_ERRORS, True))
+        api.commit = _protected_call('commit', api.commit, breaker, COMMIT_RETRY_ERRORS, True)
+        for name in _GAPIC_STREAMS:
+            setattr(api, name, _protected_stream(name, getattr(api, name), breaker, True))
+    db._resilience_protected = True
+    return db
+
+
+# ------------------ Flask integration ------------------ #
+def init_app(app):
+    """Give every request a FIRESTORE_BUDGET_SECONDS deadline budget, ending when the view returns."""
+    from flask import g
+
+    app.config.setdefault('FIRESTORE_BUDGET', BUDGET_SECONDS)
+
+    @app.before_request
+    def start_request_budget():
+        g._budget_token = start_budget(app.config['FIRESTORE_BUDGET'])
+
+    def finish_request_budget(response=None):
+        token = g.pop('_budget_token', None)
+        if token is not None:
+            end_budget(token)
+        return response
+
+    # A streamed body runs after after_request; it is not bound by the view's budget
+    app.after_request(finish_request_budget)
+    app.teardown_request(lambda exc: finish_request_budget())
@@ -0,0 +1,372 @@
+# rollups.py
+#
+# Pre-aggregated totals for the dashboard. Every write to `sales` or `expenses`
+# also increments a small set of documents in the `rollups` collection:
+#
+#   rollups/totals          all-time totals
+#   rollups/month_YYYY-MM   totals for one month
+#   rollups/day_YYYY-MM-DD  totals for one day
+#
+# Each rollup document carries the four fields in ROLLUP_FIELDS, so the
+# dashboard reads one document instead of streaming both collections.
+#
+# The same writes bump a per-collection counter in versions/ledger. It
+# changes whenever a sale or expense does, so it can key HTTP validators
+# (see http_cache.py) without reading the collections themselves.
+#
+# Sales writes also update their customer's receivables document in the same
+# batch or transaction (see receivables.py).
+
+import logging
+import re
+from collections import defaultdict
+
+from firebase_admin import firestore
+from google.api_core import exceptions
+
+import models
+import receivables
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_COLLECTION = 'rollups'
+TOTALS_DOC = 'totals'
+ROLLUP_FIELDS = ('sales_paid', 'sales_pending', 'expenses_paid', 'expenses_pending')
+
+VERSION_COLLECTION = 'versions'
+VERSION_DOC = 'ledger'
+LEDGER_COLLECTIONS = ('sales', 'expenses')
+
+# Firestore allows at most 500 writes per batch
+BATCH_LIMIT = 500
+
+_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+def _field(kind, status):
+    return f"{kind}_{'paid' if status == 'Paid' else 'pending'}"
+
+
+def _rollup_docs(date_str):
+    """Return (doc_id, extra fields) for every rollup document a row on date_str touches."""
+    docs = [(TOTALS_DOC, {'period': 'all'})]
+    if isinstance(date_str, str) and _DATE_RE.match(date_str):
+        docs.append((f'month_{date_str[:7]}', {'period': 'month', 'key': date_str[:7]}))
+        docs.append((f'day_{date_str}', {'period': 'day', 'key': date_str}))
+    return docs
+
+
+def _amount(value):
+    try:
+        return float(value or 0)
+    except (ValueError, TypeError):
+        return 0.0
+
+
+def _record(writer, db, kind, date_str, status, amount):
+    """Queue increments on `writer` (a WriteBatch or Transaction)."""
+    if not amount:
+        return
+    field = _field(kind, status)
+    for doc_id, extra in _rollup_docs(date_str):
+        ref = db.collection(ROLLUP_COLLECTION).document(doc_id)
+        writer.set(ref, dict(extra, **{field: firestore.Increment(amount)}), merge=True)
+
+
+def record_sale(writer, db, sale, sign=1):
+    _record(writer, db, 'sales', sale.get('sale_date'), sale.get('status'),
+            sign * _amount(sale.get('sale_amount')))
+    receivables.record(writer, db, sale, sign)
+
+
+def record_expense(writer, db, expense, sign=1):
+    _record(writer, db, 'expenses', expense.get('date'), expense.get('status'),
+            sign * _amount(expense.get('amount')))
+
+
+_RECORDERS = {'sales': record_sale, 'expenses': record_expense}
+
+# (date field, amount field) of each ledger collection
+_LEDGER_FIELDS = {'sales': ('sale_date', 'sale_amount'), 'expenses': ('date', 'amount')}
+
+
+def _aggregate_fields(collection):
+    """The fields a row's rollup and receivables contributions depend on; reads that only need that select them."""
+    fields = models.LEDGER_MODELS[collection].AGGREGATE_FIELDS
+    if collection == 'sales':
+        fields = tuple(dict.fromkeys(fields + receivables.FIELDS))
+    return fields
+
+
+def rollup_doc_ids(date_str):
+    """Ids of the rollup documents a row dated date_str contributes to."""
+    return [doc_id for doc_id, _ in _rollup_docs(date_str)]
+
+
+def record_many(writer, db, collection, records, removed=()):
+    """Queue the rollup increments of many rows, and the reversal of `removed` rows,
+    summed into one write per rollup document (and per customer, for sales).
+
+    Returns the number of writes queued.
+    """
+    date_field, amount_field = _LEDGER_FIELDS[collection]
+    increments = {}
+    for sign, rows in ((1, records), (-1, removed)):
+        for data in rows:
+            amount = _amount(data.get(amount_field))
+            if not amount:
+                continue
+            field = _field(collection, data.get('status'))
+            for doc_id, extra in _rollup_docs(data.get(date_field)):
+                doc = increments.setdefault(doc_id, (extra, defaultdict(float)))
+                doc[1][field] += sign * amount
+    for doc_id, (extra, fields) in increments.items():
+        ref = db.collection(ROLLUP_COLLECTION).document(doc_id)
+        writer.set(ref, dict(extra, **{field: firestore.Increment(value) for field, value in fields.items()}),
+                   merge=True)
+    customers = receivables.record_many(writer, db, records, removed) if collection == 'sales' else 0
+    return len(increments) + customers
+
+
+def bump_version(writer, db, *collections):
+    """Queue an increment of the data version of each of `collections` on `writer`."""
+    ref = db.collection(VERSION_COLLECTION).document(VERSION_DOC)
+    writer.set(ref, {collection: firestore.Increment(1) for collection in collections}, merge=True)
+
+
+def read_versions(db):
+    """Return the current data version of each ledger collection, 0 if never written."""
+    snapshot = db.collection(VERSION_COLLECTION).document(VERSION_DOC).get()
+    data = snapshot.to_dict() if snapshot.exists else {}
+    return {collection: int(data.get(collection) or 0) for collection in LEDGER_COLLECTIONS}
+
+
+def add_to_totals(totals, collection, data):
+    """Add one sale or expense to `totals`, a dict keyed by ROLLUP_FIELDS."""
+    date_field, amount_field = _LEDGER_FIELDS[collection]
+    amount = _amount(data.get(amount_field))
+    if amount:
+        totals[_field(collection, data.get('status'))] += amount
+
+
+def add_document(db, collection, data):
+    """Add a sale or expense and update the rollups in one batch."""
+    batch = db.batch()
+    ref = db.collection(collection).document()
+    batch.set(ref, data)
+    _RECORDERS[collection](batch, db, data)
+    bump_version(batch, db, collection)
+    batch.commit()
+    return ref
+
+
+def delete_document(db, collection, doc_id):
+    """Delete a sale or expense and reverse its rollup contribution.
+
+    Returns False when the document does not exist.
+    """
+    ref = db.collection(collection).document(doc_id)
+
+    @firestore.transactional
+    def _delete(transaction):
+        snapshot = ref.get(_aggregate_fields(collection), transaction=transaction)
+        if not snapshot.exists:
+            return False
+        _RECORDERS[collection](transaction, db, snapshot.to_dict(), sign=-1)
+        bump_version(transaction, db, collection)
+        transaction.delete(ref)
+        return True
+
+    return _delete(db.transaction())
+
+
+def update_status(db, collection, doc_id, new_status):
+    """Change a sale's or expense's status and move its amount between the paid/pending totals.
+
+    Returns False when the document does not exist.
+    """
+    ref = db.collection(collection).document(doc_id)
+    record = _RECORDERS[collection]
+
+    @firestore.transactional
+    def _update(transaction):
+        snapshot = ref.get(_aggregate_fields(collection), transaction=transaction)
+        if not snapshot.exists:
+            return False
+        data = snapshot.to_dict()
+        if data.get('status') != new_status:
+            record(transaction, db, data, sign=-1)
+            record(transaction, db, dict(data, status=new_status))
+        transaction.update(ref, {'status': new_status})
+        bump_version(transaction, db, collection)
+        return True
+
+    return _update(db.transaction())
+
+
+# A row touches at most three rollup documents and one customer, so this many
+# rows, those writes and the version bump always fit in one batch
+BULK_CHUNK = (BATCH_LIMIT - 2) // 4
+
+# Re-reads after a concurrent write invalidated a chunk's preconditions
+BULK_ATTEMPTS = 3
+
+
+def _bulk(db, collection, doc_ids, change):
+    """Apply `change` to many documents: one get_all and one batch per chunk.
+
+    change(batch, ref, data, option) queues the write for one existing
+    document, guarded by `option` (its last update time), and returns the
+    row as it will read afterwards, None when it is deleted, or `data`
+    itself when its rollup contribution is unchanged. `data` holds only the
+    collection's aggregate fields. Returns (changed, missing) counts.
+    """
+    ids = list(dict.fromkeys(doc_ids))
+    target = db.collection(collection)
+    fields = _aggregate_fields(collection)
+    changed = missing = 0
+    for start in range(0, len(ids), BULK_CHUNK):
+        refs = [target.document(doc_id) for doc_id in ids[start:start + BULK_CHUNK]]
+        for attempt in range(BULK_ATTEMPTS):
+            snapshots = [snapshot for snapshot in db.get_all(refs, field_paths=fields) if snapshot.exists]
+            batch = db.batch()
+            before, after = [], []
+            for snapshot in snapshots:
+                data = snapshot.to_dict()
+                option = db.write_option(last_update_time=snapshot.update_time)
+                result = change(batch, snapshot.reference, data, option)
+                if result is not data:
+                    before.append(data)
+                    if result is not None:
+                        after.append(result)
+            if not snapshots:
+                break
+            record_many(batch, db, collection, after, removed=before)
+            bump_version(batch, db, collection)
+            try:
+                batch.commit()
+            except (exceptions.FailedPrecondition, exceptions.NotFound):
+                # Changed or deleted since the get_all: read the chunk again
+                if attempt == BULK_ATTEMPTS - 1:
+                    raise
+                continue
+            break
+        changed += len(snapshots)
+        missing += len(refs) - len(snapshots)
+    return changed, missing
+
+
+def bulk_update_status(db, collection, doc_ids, new_status):
+    """Set the status of many sales or expenses and move their amounts between totals.
+
+    Each chunk of ids is read with one get_all and written in one batch
+    whose updates are conditional on the documents not having changed since.
+    Returns (updated, missing).
+    """
+    def change(batch, ref, data, option):
+        # Written even when unchanged, so a concurrent status change still trips the precondition
+        batch.update(ref, {'status': new_status}, option=option)
+        return data if data.get('status') == new_status else dict(data, status=new_status)
+
+    return _bulk(db, collection, doc_ids, change)
+
+
+def bulk_delete(db, collection, doc_ids):
+    """Delete many sales or expenses and reverse their rollup contributions.
+
+    Returns (deleted, missing).
+    """
+    def change(batch, ref, data, option):
+        batch.delete(ref, option=option)
+        return None
+
+    return _bulk(db, collection, doc_ids, change)
+
+
+def read_totals(db):
+    """Return the all-time totals as a dict of floats."""
+    snapshot = db.collection(ROLLUP_COLLECTION).document(TOTALS_DOC).get()
+    data = snapshot.to_dict() if snapshot.exists else {}
+    return {field: _amount(data.get(field)) for field in ROLLUP_FIELDS}
+
+
+def read_months(db):
+    """Return the monthly rollups as a list of ('YYYY-MM', totals) sorted by month."""
+    query = db.collection(ROLLUP_COLLECTION).where(filter=firestore.FieldFilter('period', '==', 'month'))
+    months = []
+    for doc in query.stream():
+        data = doc.to_dict()
+        months.append((data.get('key', doc.id[len('month_'):]),
+                       {field: _amount(data.get(field)) for field in ROLLUP_FIELDS}))
+    months.sort(key=lambda item: item[0])
+    return months
+
+
+def compute(db):
+    """Recompute every rollup document from the raw collections."""
+    docs = {}
+
+    def add(kind, date_str, status, amount):
+        if not amount:
+            return
+        field = _field(kind, status)
+        for doc_id, extra in _rollup_docs(date_str):
+            doc = docs.setdefault(doc_id, dict(extra, **{f: 0.0 for f in ROLLUP_FIELDS}))
+            doc[field] += amount
+
+    for doc in db.collection('sales').select(_aggregate_fields('sales')).stream():
+        sale = doc.to_dict()
+        add('sales', sale.get('sale_date'), sale.get('status'), _amount(sale.get('sale_amount')))
+    for doc in db.collection('expenses').select(_aggregate_fields('expenses')).stream():
+        expense = doc.to_dict()
+        add('expenses', expense.get('date'), expense.get('status'), _amount(expense.get('amount')))
+
+    docs.setdefault(TOTALS_DOC, dict({'period': 'all'}, **{f: 0.0 for f in ROLLUP_FIELDS}))
+    return docs
+
+
+def rebuild(db):
+    """Overwrite the rollups collection with freshly computed totals.
+
+    Stale documents (periods that no longer have any rows) are deleted.
+    Writes made while the rebuild runs may be lost, so run it during a quiet
+    period. Returns the number of rollup documents written.
+    """
+    docs = compute(db)
+    collection = db.collection(ROLLUP_COLLECTION)
+    # Only the ids are needed
+    stale = [doc.reference for doc in collection.select([]).stream() if doc.id not in docs]
+
+    writes = [(ref, None) for ref in stale]
+    writes += [(collection.document(doc_id), data) for doc_id, data in docs.items()]
+    for start in range(0, len(writes), BATCH_LIMIT):
+        batch = db.batch()
+        for ref, data in writes[start:start + BATCH_LIMIT]:
+            if data is None:
+                batch.delete(ref)
+            else:
+                batch.set(ref, data)
+        batch.commit()
+    # The rollups behind cached pages may have changed
+    version_batch = db.batch()
+    bump_version(version_batch, db, *LEDGER_COLLECTIONS)
+    version_batch.commit()
+
+    logger.info(f"Rebuilt {len(docs)} rollup documents, removed {len(stale)} stale documents")
+    return len(docs)
+
+
+def reconcile(db, tolerance=0.005):
+    """Compare stored rollups with freshly computed ones without writing.
+
+    Returns {doc_id: (stored, expected)} for every document that drifted.
+    """
+    expected = compute(db)
+    stored = {doc.id: doc.to_dict() for doc in db.collection(ROLLUP_COLLECTION).stream()}
+    drift = {}
+    for doc_id in set(expected) | set(stored):
+        want = {f: _amount(expected.get(doc_id, {}).get(f)) for f in ROLLUP_FIELDS}
+        have = {f: _amount(stored.get(doc_id, {}).get(f)) for f in ROLLUP_FIELDS}
+        if any(abs(want[f] - have[f]) > tolerance for f in ROLLUP_FIELDS):
+            drift[doc_id] = (have, want)
+    return drift
@@ -0,0 +1,109 @@
+# search.py
+#
+# Server-side filters for the sales table and /api/sales: customer name
+# prefix (case-insensitive), status and sale date range.
+#
+# Firestore has no case-insensitive or prefix match that combines with a
+# date ordering, so every sale stores `customer_search`: the prefixes of its
+# normalized customer name (NFKC, case-folded, whitespace collapsed), up to
+# PREFIX_LENGTH characters. A prefix search is then an array-contains
+# equality that composes with the status filter, the date range and the
+# table's newest-first keyset pagination, served by the composite indexes
+# in firestore.indexes.json. A query reads only the matching documents.
+#
+# LedgerRepository.add and the CSV import write the field; sales saved
+# before it existed get it from `flask --app app index-customers`. Reads
+# served by the mirror filter in memory and normalize the name themselves,
+# so they do not depend on the backfill.
+
+import unicodedata
+from collections import namedtuple
+from datetime import datetime
+
+from firebase_admin import firestore
+
+FIELD = 'customer_search'
+# Longer names are indexed by their first PREFIX_LENGTH characters
+PREFIX_LENGTH = 32
+
+STATUSES = ('Paid', 'Pending')
+
+Filters = namedtuple('Filters', ['customer', 'status', 'start_date', 'end_date'])
+NO_FILTERS = Filters('', None, None, None)
+
+# Query argument -> Filters field
+ARGS = {'q': 'customer', 'status': 'status', 'start_date': 'start_date', 'end_date': 'end_date'}
+
+
+def normalize(name):
+    """The form of a customer name that searches compare: NFKC, case-folded, single spaces."""
+    return ' '.join(unicodedata.normalize('NFKC', name or '').casefold().split())
+
+
+def prefixes(name):
+    """Every prefix of the normalized name, shortest first, for the customer_search field."""
+    normalized = normalize(name)[:PREFIX_LENGTH].rstrip()
+    return [normalized[:length] for length in range(1, len(normalized) + 1)]
+
+
+def indexed(collection, data):
+    """`data` with the search field a document of `collection` needs; the dict itself is changed."""
+    if collection == 'sales':
+        data[FIELD] = prefixes(data.get('customer_name'))
+    return data
+
+
+def _date(value, name):
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f'{name} must be a date in YYYY-MM-DD format')
+
+
+def parse_filters(args):
+    """Filters from query arguments (q, status, start_date, end_date); ValueError when one is invalid."""
+    customer = normalize(args.get('q'))
+    if len(customer) > PREFIX_LENGTH:
+        raise ValueError(f'Search by at most {PREFIX_LENGTH} characters of the customer name')
+    status = args.get('status') or None
+    if status is not None and status not in STATUSES:
+        raise ValueError(f"status must be one of {', '.join(STATUSES)}")
+    start_date = _date(args.get('start_date'), 'start_date')
+    end_date = _date(args.get('end_date'), 'end_date')
+    if start_date and end_date and start_date > end_date:
+        raise ValueError('start_date must not be after end_date')
+    return Filters(customer, status, start_date, end_date)
+
+
+def query_args(filters):
+    """The query arguments that reproduce `filters`, for links that keep them."""
+    return {arg: getattr(filters, field) for arg, field in ARGS.items() if getattr(filters, field)}
+
+
+def apply(query, filters, date_field):
+    """`query` narrowed to `filters`. Ordering is left to the caller (see pagination.fetch_page)."""
+    if filters.customer:
+        query = query.where(filter=firestore.FieldFilter(FIELD, 'array_contains', filters.customer))
+    if filters.status:
+        query = query.where(filter=firestore.FieldFilter('status', '==', filters.status))
+    if filters.start_date:
+        query = query.where(filter=firestore.FieldFilter(date_field, '>=', filters.start_date))
+    if filters.end_date:
+        query = query.where(filter=firestore.FieldFilter(date_field, '<=', filters.end_date))
+    return query
+
+
+def matcher(filters, date_field):
+    """A predicate over document data for `filters`, for documents held in memory."""
+    def matches(data):
+        if filters.status and data.get('status') != filters.status:
+            return False
+        day = data.get(date_field)
+        if filters.start_date and not (isinstance(day, str) and day >= filters.start_date):
+            return False
+        if filters.end_date and not (isinstance(day, str) and day <= filters.end_date):
+            return False
+        return not filters.customer or normalize(data.get('customer_name')).startswith(filters.customer)
+    return matches
@@ -0,0 +1,85 @@
+# session_cache.py
+#
+# Caches the result of validating a logged-in session against Firebase Auth,
+# so before_request() does not make a remote Auth call on every request.
+#
+# Each worker process has its own cache. revoke() only reaches the process
+# it is called in; to reach the other workers of a host, callers pass a
+# `generation` (app.py reads one per user from the shared cache when
+# SHARED_CACHE=1) and bump it on revocation, which makes every worker's entry
+# stale at once. Without it, and on other hosts, a disabled user stays
+# logged in for up to `ttl` seconds.
+
+import threading
+import time
+
+import metrics
+
+SESSION_CACHE_LOOKUPS = metrics.REGISTRY.register(metrics.Counter(
+    'session_cache_lookups_total', 'Session validations answered from the cache (hit) or Firebase Auth (miss).',
+    ['result']))
+
+
+class SessionValidationCache:
+    """Thread-safe TTL cache of session validation results keyed by user id.
+
+    Valid results are kept for `ttl` seconds and invalid ones (deleted or
+    disabled users) for `negative_ttl` seconds. Errors are never cached.
+    """
+
+    def __init__(self, ttl=300, negative_ttl=30, max_entries=10000, clock=time.monotonic):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def is_valid(self, key, validate, generation=0):
+        """Return the cached result for key, calling validate() on a miss.
+
+        validate() must return True or False; exceptions propagate and
+        leave the cache untouched. An entry cached under another
+        `generation` is a miss.
+        """
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now and entry[2] == generation:
+                self.hits += 1
+                SESSION_CACHE_LOOKUPS.inc(('hit',))
+                return entry[0]
+            self.misses += 1
+        SESSION_CACHE_LOOKUPS.inc(('miss',))
+
+        valid = bool(validate())
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._evict(now)
+            self._entries[key] = (valid, now + (self.ttl if valid else self.negative_ttl), generation)
+        return valid
+
+    def revoke(self, key):
+        """Forget any cached result so the next request re-validates."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+    def _evict(self, now):
+        expired = [key for key, (_, expires_at, _) in self._entries.items() if expires_at <= now]
+        for key in expired:
+            del self._entries[key]
+        # Still full: drop the entries closest to expiry
+        overflow = len(self._entries) - self.max_entries + 1
+        if overflow > 0:
+            for key, _ in sorted(self._entries.items(), key=lambda item: item[1][1])[:overflow]:
+                del self._entries[key]
@@ -0,0 +1,299 @@
+# shared_cache.py
+#
+# Optional read cache shared by every worker process on a host
+# (SHARED_CACHE=1), in a SQLite database on local disk. It holds table
+# pages, task lists and computed aggregates (chart data, monthly and
+# all-time totals), so a page one worker has built is not read from
+# Firestore again by the next worker that gets the same request.
+#
+# Invalidation is by version: each (tenant, collection) scope has a counter
+# in the `versions` table, and an entry's key includes the counters of the
+# scopes it was computed from. The repositories bump a scope after every
+# write they make (datastore.TenantStore), so the next read misses and
+# recomputes; superseded entries are never read again and age out.
+# Counters are read before computing, so a write racing a computation only
+# leaves that entry under an old key.
+#
+# Writes this host does not see (another host, the Firebase console) show
+# up when the entry expires, after SHARED_CACHE_TTL seconds at most. Keys of
+# the sales and expenses reads also include the versions/ledger counters
+# the routes read for their ETags, which every writer bumps.
+#
+# Eviction: entries expire after the TTL; past SHARED_CACHE_MAX_MB the least
+# recently used go first.
+#
+# Single flight: one process per key holds a lease row in `flights` while it
+# computes, and one thread per process competes for it. Other threads wait
+# for that thread; other processes poll for the result. Only one Firestore
+# scan runs per key however many requests miss at once. A lease older than
+# SHARED_CACHE_LEASE_SECONDS (a crashed worker) is taken over; a waiter
+# that runs out of time computes without caching.
+#
+# Values are pickled, so the database lives in a directory only this user
+# can access. Any SQLite error degrades to computing the value uncached.
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+import uuid
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv('SHARED_CACHE', '0') == '1'
+TTL = float(os.getenv('SHARED_CACHE_TTL', 300))
+MAX_BYTES = int(float(os.getenv('SHARED_CACHE_MAX_MB', 64)) * 1024 * 1024)
+LEASE_SECONDS = float(os.getenv('SHARED_CACHE_LEASE_SECONDS', 10))
+
+# How often a process waiting on another's computation checks for the result
+POLL_SECONDS = 0.02
+# A hit refreshes an entry's LRU position at most this often
+TOUCH_SECONDS = 1.0
+
+SHARED_CACHE_REQUESTS = metrics.REGISTRY.register(metrics.Counter(
+    'shared_cache_requests_total', 'Shared cache lookups, by entry kind and result (hit, wait, miss).',
+    ['name', 'result']))
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL,
+    expires REAL NOT NULL, accessed REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE TABLE IF NOT EXISTS versions (scope TEXT PRIMARY KEY, version INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS flights (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL);
+'''
+
+_MISSING = object()
+
+
+def default_path():
+    """A cache file in a per-user directory under the system temp directory."""
+    return os.path.join(tempfile.gettempdir(), f'amornrat-cache-{os.getuid()}', 'cache.sqlite3')
+
+
+def private_directory(path):
+    """Create the directory of `path` for this user only; ValueError if someone else could write to it."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.stat(directory)
+    if info.st_uid != os.getuid() or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise ValueError(f'{directory} must be owned by this user and not writable by others')
+
+
+class SharedCache:
+    """Versioned LRU/TTL cache in a SQLite file shared by the processes of a host."""
+
+    def __init__(self, path, max_bytes=MAX_BYTES, ttl=TTL, lease_seconds=LEASE_SECONDS, per_process=False):
+        private_directory(path)
+        self.path = path
+        # Keep each process's entries and versions apart, for data that is not shared either
+        self.per_process = per_process
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lease_seconds = lease_seconds
+        self._owner = uuid.uuid4().hex
+        self._connections = threading.local()
+        self._lock = threading.Lock()
+        # key -> Event of the thread computing it in this process
+        self._flights = {}
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self):
+        """This thread's connection; a new one after a fork."""
+        local = self._connections
+        if getattr(local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            local.db, local.pid = db, os.getpid()
+        return local.db
+
+    def _scopes(self, scopes):
+        return [f'{os.getpid()}:{scope}' if self.per_process else scope for scope in scopes]
+
+    # -- versions --
+    def versions(self, scopes):
+        """Current counters of `scopes`, in order (0 for a scope never written)."""
+        scopes = self._scopes(scopes)
+        placeholders = ','.join('?' * len(scopes))
+        rows = dict(self._connection().execute(
+            f'SELECT scope, version FROM versions WHERE scope IN ({placeholders})', scopes))
+        return [rows.get(scope, 0) for scope in scopes]
+
+    def version(self, scope):
+        """The counter of one scope, or 0 when the database cannot be read."""
+        try:
+            return self.versions([scope])[0]
+        except sqlite3.Error as e:
+            logger.warning(f"Shared cache unavailable, reading {scope} as version 0: {str(e)}")
+            return 0
+
+    def bump(self, *scopes):
+        """Invalidate every entry computed from `scopes`. Call after the write."""
+        try:
+            self._connection().executemany(
+                'INSERT INTO versions (scope, version) VALUES (?, 1) '
+                'ON CONFLICT (scope) DO UPDATE SET version = version + 1', [(scope,) for scope in self._scopes(scopes)])
+        except sqlite3.Error as e:
+            logger.error(f"Could not invalidate the shared cache for {', '.join(scopes)}: {str(e)}")
+
+    # -- entries --
+    def get_or_compute(self, parts, scopes, compute, ttl=None):
+        """The cached value for `parts` at the current versions of `scopes`, computing it on a miss.
+
+        `parts` must be JSON-serialisable, parts[0] naming the kind of entry.
+        """
+        name = str(parts[0])
+        try:
+            versions = self.versions(scopes)
+        except sqlite3.Error as e:
+            logger.warning(f"Shared cache unavailable, computing {name} uncached: {str(e)}")
+            return compute()
+        namespace = os.getpid() if self.per_process else None
+        key = hashlib.sha256(json.dumps([namespace, parts, versions], default=str, separators=(',', ':'))
+                             .encode('utf-8')).hexdigest()
+        value = self._get(key)
+        if value is not _MISSING:
+            SHARED_CACHE_REQUESTS.inc((name, 'hit'))
+            return value
+
+        with self._lock:
+            event = self._flights.get(key)
+            leader = event is None
+            if leader:
+                event = self._flights[key] = threading.Event()
+        if not leader:
+            event.wait(self.lease_seconds)
+            value = self._get(key)
+            if value is not _MISSING:
+                SHARED_CACHE_REQUESTS.inc((name, 'wait'))
+                return value
+            SHARED_CACHE_REQUESTS.inc((name, 'miss'))
+            return compute()
+        try:
+            return self._lead(key, name, compute, self.ttl if ttl is None else ttl)
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            event.set()
+
+    def _lead(self, key, name, compute, ttl):
+        deadline = time.time() + self.lease_seconds
+        while True:
+            if self._lease(key):
+                try:
+                    # The previous holder may have finished since our miss
+                    value = self._get(key)
+                    if value is not _MISSING:
+                        SHARED_CACHE_REQUESTS.inc((name, 'wait'))
+                        return value
+                    SHARED_CACHE_REQUESTS.inc((name, 'miss'))
+                    value = compute()
+                    self._put(key, value, ttl)
+                    return value
+                finally:
+                    self._unlease(key)
+            time.sleep(POLL_SECONDS)
+            value = self._get(key)
+            if value is not _MISSING:
+                SHARED_CACHE_REQUESTS.inc((name, 'wait'))
+                return value
+            if time.time() >= deadline:
+                SHARED_CACHE_REQUESTS.inc((name, 'miss'))
+                return compute()
+
+    def _get(self, key):
+        now = time.time()
+        try:
+            db = self._connection()
+            row = db.execute('SELECT value, accessed FROM entries WHERE key = ? AND expires > ?',
+                             (key, now)).fetchone()
+            if row is None:
+                return _MISSING
+            if row[1] < now - TOUCH_SECONDS:
+                db.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+            return pickle.loads(row[0])
+        except (sqlite3.Error, pickle.UnpicklingError, AttributeError, EOFError) as e:
+            logger.warning(f"Shared cache read failed: {str(e)}")
+            return _MISSING
+
+    def _put(self, key, value, ttl):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_bytes // 4:
+            # One entry must not push out most of the others
+            return
+        now = time.time()
+        try:
+            db = self._connection()
+            db.execute('INSERT OR REPLACE INTO entries (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)',
+                       (key, blob, len(blob), now + ttl, now))
+            self._evict(db, now)
+        except sqlite3.Error as e:
+            logger.warning(f"Shared cache write failed: {str(e)}")
+
+    def _evict(self, db, now):
+        db.execute('DELETE FROM entries WHERE expires <= ?', (now,))
+        total = db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        while total > self.max_bytes:
+            oldest = db.execute('SELECT key, size FROM entries ORDER BY accessed LIMIT 32').fetchall()
+            if not oldest:
+                break
+            db.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key, _ in oldest])
+            total -= sum(size for _, size in oldest)
+
+    # -- single flight --
+    def _lease(self, key):
+        """Take the computation of `key` for this process; False while another holds it."""
+        now = time.time()
+        try:
+            db = self._connection()
+            if db.execute('INSERT OR IGNORE INTO flights (key, owner, expires) VALUES (?, ?, ?)',
+                          (key, self._owner, now + self.lease_seconds)).rowcount:
+                return True
+            # Taken over from a holder that died or stalled
+            return bool(db.execute('UPDATE flights SET owner = ?, expires = ? WHERE key = ? AND expires <= ?',
+                                   (self._owner, now + self.lease_seconds, key, now)).rowcount)
+        except sqlite3.Error as e:
+            logger.warning(f"Shared cache lease failed: {str(e)}")
+            return True
+
+    def _unlease(self, key):
+        try:
+            self._connection().execute('DELETE FROM flights WHERE key = ? AND owner = ?', (key, self._owner))
+        except sqlite3.Error as e:
+            logger.warning(f"Shared cache lease release failed: {str(e)}")
+
+    def clear(self):
+        db = self._connection()
+        db.execute('DELETE FROM entries')
+        db.execute('DELETE FROM flights')
+
+    def stats(self):
+        count, size = self._connection().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return {'entries': count, 'bytes': size, 'max_bytes': self.max_bytes}
+
+
+def from_env(backend):
+    """The SharedCache configured by SHARED_CACHE*, or None when disabled or unusable.
+
+    On the memory backend every process has its own data, so its entries are
+    kept per process too.
+    """
+    if not ENABLED:
+        return None
+    path = os.getenv('SHARED_CACHE_PATH') or default_path()
+    try:
+        cache = SharedCache(path, per_process=backend == 'memory')
+    except (OSError, ValueError, sqlite3.Error) as e:
+        logger.error(f"Shared cache disabled: {str(e)}")
+        return None
+    logger.info(f"Caching reads in {path}, shared by the workers of this host")
+    return cache
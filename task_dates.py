@@ -0,0 +1,138 @@
+# task_dates.py
+#
+# Due dates of calendar tasks. A task stores when it is due in `due`, a
+# Firestore timestamp, and whether a time of day was given in `has_time`;
+# the calendar loads one month or week at a time with a range query on
+# `due`. Dates and times are entered and shown in TASK_TIMEZONE
+# (Asia/Bangkok by default).
+#
+# Tasks written before this kept a free-form 'YYYY-MM-DD HH:MM' string in
+# `datetime` instead; `flask --app app migrate-task-dates` converts them.
+
+import calendar
+import os
+import re
+from datetime import date, datetime, time, timedelta
+
+import pytz
+
+TIMEZONE = pytz.timezone(os.getenv('TASK_TIMEZONE', 'Asia/Bangkok'))
+
+# Longest range the JSON feed serves in one request
+MAX_FEED_DAYS = 62
+
+_TIME_RE = re.compile(r'^([01]?\d|2[0-3]):([0-5]\d)$')
+_LEGACY_FORMATS = (
+    ('%Y-%m-%d %H:%M', True),
+    ('%Y-%m-%d %H:%M:%S', True),
+    ('%Y-%m-%d', False),
+    ('%Y/%m/%d %H:%M', True),
+    ('%Y/%m/%d', False),
+    ('%d/%m/%Y', False),
+)
+
+
+def parse_time(value):
+    """(hour, minute) from an 'HH:MM' string, None for a blank one; ValueError otherwise."""
+    value = (value or '').strip()
+    if not value:
+        return None
+    match = _TIME_RE.match(value)
+    if not match:
+        raise ValueError('Time must be in HH:MM format')
+    return int(match.group(1)), int(match.group(2))
+
+
+def due_fields(day, time_value=''):
+    """The `due` and `has_time` fields for a date and an optional 'HH:MM' time."""
+    hour_minute = parse_time(time_value)
+    local = TIMEZONE.localize(datetime.combine(day, time(*hour_minute) if hour_minute else time()))
+    return {'due': local.astimezone(pytz.utc), 'has_time': hour_minute is not None}
+
+
+def legacy_fields(value):
+    """due_fields for a legacy `datetime` string, or None if it cannot be parsed."""
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    for fmt, has_time in _LEGACY_FORMATS:
+        try:
+            parsed = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return due_fields(parsed.date(), parsed.strftime('%H:%M') if has_time else '')
+    return None
+
+
+def local_due(task):
+    """The due time of a models.Task in TIMEZONE, or None."""
+    due = task.due
+    if due is None:
+        return None
+    if due.tzinfo is None:
+        due = pytz.utc.localize(due)
+    return due.astimezone(TIMEZONE)
+
+
+def display(task):
+    """'YYYY-MM-DD HH:MM', or 'YYYY-MM-DD' without a time, as the calendar shows it."""
+    local = local_due(task)
+    if local is None:
+        # Not migrated yet
+        return task.legacy_datetime
+    return local.strftime('%Y-%m-%d %H:%M' if task.has_time else '%Y-%m-%d')
+
+
+def local_start(day):
+    """Midnight at the start of `day` in TIMEZONE, as a UTC datetime."""
+    return TIMEZONE.localize(datetime.combine(day, time())).astimezone(pytz.utc)
+
+
+def today():
+    return datetime.now(TIMEZONE).date()
+
+
+def month_view(year, month):
+    """(first day, first day of the next month, previous month's first day) of a month."""
+    first = date(year, month, 1)
+    following = first + timedelta(days=calendar.monthrange(year, month)[1])
+    previous = (first - timedelta(days=1)).replace(day=1)
+    return first, following, previous
+
+
+def week_view(day):
+    """(Monday, next Monday, previous Monday) of the week containing `day`."""
+    monday = day - timedelta(days=day.weekday())
+    return monday, monday + timedelta(days=7), monday - timedelta(days=7)
+
+
+def parse_feed_bound(value):
+    """A feed range bound: an ISO date (midnight in TIMEZONE) or an ISO datetime, as UTC."""
+    value = (value or '').strip()
+    if not value:
+        raise ValueError('start and end are required')
+    try:
+        if len(value) == 10:
+            return local_start(date.fromisoformat(value))
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError('start and end must be ISO dates or datetimes')
+    if parsed.tzinfo is None:
+        parsed = TIMEZONE.localize(parsed)
+    return parsed.astimezone(pytz.utc)
+
+
+def feed_event(task):
+    """One models.Task as a calendar feed event (the FullCalendar event object shape)."""
+    local = local_due(task)
+    return {
+        'id': task.id,
+        'title': task.name,
+        'start': local.isoformat() if task.has_time else local.date().isoformat(),
+        'allDay': not task.has_time,
+        'extendedProps': {
+            'priority': task.priority,
+            'done': task.done,
+            'price': task.price,
+        },
+    }
@@ -0,0 +1,143 @@
+# tenants.py
+#
+# Per-tenant partitioning of the business data. Every shop (tenant) keeps
+# its records in subcollections of its own document:
+#
+#   tenants/{tenant_id}/sales
+#   tenants/{tenant_id}/expenses
+#   tenants/{tenant_id}/calendar_tasks
+#   tenants/{tenant_id}/rollups      (see rollups.py)
+#   tenants/{tenant_id}/versions
+#
+# so every query, aggregate and listener touches one shop's records only,
+# and its cost follows that shop's volume however many shops there are.
+#
+# `users` stays global. users/{uid}.tenant_id names the shop a user works
+# for; a user without one is a shop of their own (tenant id = uid), which
+# is what registration sets up.
+#
+# Data written before partitioning sits in the global collections;
+# `flask --app app migrate-tenants --tenant ID` moves it into tenants.
+
+import logging
+import re
+
+from firebase_admin import firestore
+
+import receivables
+import rollups
+
+logger = logging.getLogger(__name__)
+
+TENANT_COLLECTION = 'tenants'
+USER_COLLECTION = 'users'
+
+# Collections that live under each tenant, and the ones the migration moves
+# (the rollups, versions and customers of a tenant are rebuilt rather than moved)
+PARTITIONED_COLLECTIONS = ('sales', 'expenses', 'calendar_tasks', rollups.ROLLUP_COLLECTION,
+                           rollups.VERSION_COLLECTION, receivables.CUSTOMER_COLLECTION)
+MIGRATED_COLLECTIONS = ('sales', 'expenses', 'calendar_tasks')
+
+# A moved document is one set and one delete
+MOVE_CHUNK = rollups.BATCH_LIMIT // 2
+
+_ID_RE = re.compile(r'^[A-Za-z0-9_-]{1,128}$')
+
+
+def valid_id(tenant_id):
+    return isinstance(tenant_id, str) and bool(_ID_RE.match(tenant_id))
+
+
+def tenant_of(uid, user_data):
+    """The tenant id of a user from their users/{uid} document."""
+    tenant_id = (user_data or {}).get('tenant_id')
+    return tenant_id if valid_id(tenant_id) else uid
+
+
+class TenantDB:
+    """A Firestore client whose collections are those of one tenant.
+
+    collection(name) resolves to tenants/{tenant_id}/{name}; everything else
+    (batch, transaction, get_all, write_option, ...) is the client's, so the
+    repositories and the modules below them work unchanged on either.
+    """
+
+    def __init__(self, client, tenant_id):
+        if not valid_id(tenant_id):
+            raise ValueError(f'Invalid tenant id {tenant_id!r}')
+        self.client = client
+        self.tenant_id = tenant_id
+        self.document = client.collection(TENANT_COLLECTION).document(tenant_id)
+
+    def collection(self, name):
+        return self.document.collection(name)
+
+    def path(self, name):
+        """Full path of one of the tenant's collections."""
+        return f'{TENANT_COLLECTION}/{self.tenant_id}/{name}'
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def ensure(db, tenant_id, **fields):
+    """Create or update the tenants/{tenant_id} document, so list_ids() finds the tenant."""
+    db.collection(TENANT_COLLECTION).document(tenant_id).set(
+        dict(fields, updated_at=firestore.SERVER_TIMESTAMP), merge=True)
+
+
+def list_ids(db):
+    return [doc.id for doc in db.collection(TENANT_COLLECTION).select([]).stream()]
+
+
+def migrate(db, default_tenant, dry_run=False):
+    """Move the global sales, expenses and calendar_tasks into tenants.
+
+    A document with a valid `tenant_id` field moves to that tenant (without
+    the field), any other to `default_tenant`. Each document is copied and
+    deleted in the same batch, so an interrupted run can simply be rerun.
+    Users without a tenant_id are assigned to `default_tenant`, as everyone
+    shared the global data before.
+
+    Returns (report, tenants): report maps each collection to {tenant_id:
+    documents moved}, tenants is the set of tenants that received data. The
+    caller rebuilds their rollups.
+    """
+    if not valid_id(default_tenant):
+        raise ValueError(f'Invalid tenant id {default_tenant!r}')
+    report = {}
+    tenants = set()
+    for collection in MIGRATED_COLLECTIONS:
+        counts = report[collection] = {}
+        query = db.collection(collection).order_by('__name__').limit(MOVE_CHUNK)
+        last = None
+        while True:
+            docs = list((query.start_after(last) if last is not None else query).stream())
+            if not docs:
+                break
+            last = docs[-1]
+            batch = db.batch()
+            for doc in docs:
+                data = doc.to_dict()
+                tenant_id = data.pop('tenant_id', None)
+                if not valid_id(tenant_id):
+                    tenant_id = default_tenant
+                counts[tenant_id] = counts.get(tenant_id, 0) + 1
+                tenants.add(tenant_id)
+                batch.set(TenantDB(db, tenant_id).collection(collection).document(doc.id), data)
+                batch.delete(doc.reference)
+            if not dry_run:
+                batch.commit()
+            logger.info(f"{collection}: {sum(counts.values())} documents {'to move' if dry_run else 'moved'}")
+
+    assigned = 0
+    for doc in db.collection(USER_COLLECTION).stream():
+        if not valid_id(doc.to_dict().get('tenant_id')):
+            assigned += 1
+            if not dry_run:
+                doc.reference.update({'tenant_id': default_tenant})
+    report[USER_COLLECTION] = {default_tenant: assigned}
+    if not dry_run:
+        for tenant_id in tenants | {default_tenant}:
+            ensure(db, tenant_id)
+    return report, tenants